@@ -0,0 +1,184 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+from astrbot.api import logger
+
+
+class AdmissionTicket:
+    """
+    一次生成请求的准入凭证。
+
+    通过 `async with ticket:` 等待获得执行名额，退出时自动释放；
+    release() 可重复调用，用于请求在排队阶段被取消时的清理。
+    """
+
+    __slots__ = ("controller", "group_id", "enqueued_at", "admitted_at", "released", "_future")
+
+    def __init__(self, controller: "AdmissionController", group_id: str):
+        self.controller = controller
+        self.group_id = group_id
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.released = False
+        self._future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @property
+    def admitted(self) -> bool:
+        return self.admitted_at is not None
+
+    def position(self) -> int:
+        """当前排队位置 (从 1 开始)，已获得名额时返回 0。"""
+        return self.controller.position_of(self)
+
+    def estimated_wait_seconds(self) -> Optional[float]:
+        return self.controller.estimate_wait(self.position())
+
+    async def __aenter__(self) -> "AdmissionTicket":
+        try:
+            await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    生成请求的全局准入控制。
+
+    - 限制全局同时进行的生成数量；
+    - 各群组 (私聊按用户) 分别排队，按加权轮询出队，避免单个繁忙群组占满名额；
+    - 根据近期请求耗时估算排队等待时间。
+    max_in_flight <= 0 表示不限制并发。
+    """
+
+    def __init__(self, max_in_flight: int, group_weights: Optional[Dict[str, int]] = None, ewma_alpha: float = 0.2):
+        self.max_in_flight = max_in_flight
+        self.group_weights = group_weights or {}
+        self.ewma_alpha = ewma_alpha
+        self.in_flight = 0
+        self.admitted_total = 0
+        # 有排队请求的群组，按轮询顺序排列
+        self._queues: "OrderedDict[str, Deque[AdmissionTicket]]" = OrderedDict()
+        # 当前轮询到的群组本轮剩余可出队数量
+        self._credits: Dict[str, int] = {}
+        self._service_time_ewma: Optional[float] = None
+
+    @staticmethod
+    def parse_group_weights(raw_weights: List[str]) -> Dict[str, int]:
+        """解析配置中形如 "群号:权重" 的列表。"""
+        weights = {}
+        for item in raw_weights or []:
+            group_id, sep, weight = str(item).rpartition(":")
+            if not sep:
+                continue
+            try:
+                weights[group_id.strip()] = max(1, int(weight))
+            except ValueError:
+                logger.warning(f"AdmissionController: 无法解析群组权重配置 '{item}'，已忽略。")
+        return weights
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _weight(self, group_id: str) -> int:
+        return self.group_weights.get(group_id, 1)
+
+    def enqueue(self, group_id: str) -> AdmissionTicket:
+        ticket = AdmissionTicket(self, group_id)
+        self._queues.setdefault(group_id, deque()).append(ticket)
+        self._dispatch()
+        if not ticket.admitted:
+            logger.info(f"AdmissionController: 群组 {group_id} 的生成请求进入排队 (第 {ticket.position()} 位，进行中 {self.in_flight}/{self.max_in_flight})")
+        return ticket
+
+    def _has_capacity(self) -> bool:
+        return self.max_in_flight <= 0 or self.in_flight < self.max_in_flight
+
+    def _pop_next(self, queues: "OrderedDict[str, Deque[AdmissionTicket]]", credits: Dict[str, int]) -> AdmissionTicket:
+        """按加权轮询规则从 queues 中取出下一个凭证；同一群组每轮最多连续出队其权重次。"""
+        group_id, queue = next(iter(queues.items()))
+        credit = credits.get(group_id) or self._weight(group_id)
+        ticket = queue.popleft()
+        credit -= 1
+        if not queue:
+            del queues[group_id]
+            credits.pop(group_id, None)
+        elif credit <= 0:
+            queues.move_to_end(group_id)
+            credits.pop(group_id, None)
+        else:
+            credits[group_id] = credit
+        return ticket
+
+    def _dispatch(self) -> None:
+        while self._queues and self._has_capacity():
+            ticket = self._pop_next(self._queues, self._credits)
+            ticket.admitted_at = time.monotonic()
+            self.in_flight += 1
+            self.admitted_total += 1
+            if not ticket._future.done():
+                ticket._future.set_result(None)
+
+    def _release(self, ticket: AdmissionTicket) -> None:
+        if ticket.admitted:
+            self.in_flight -= 1
+            service_time = time.monotonic() - ticket.admitted_at
+            if self._service_time_ewma is None:
+                self._service_time_ewma = service_time
+            else:
+                self._service_time_ewma = self.ewma_alpha * service_time + (1 - self.ewma_alpha) * self._service_time_ewma
+        else:
+            queue = self._queues.get(ticket.group_id)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.group_id]
+                    self._credits.pop(ticket.group_id, None)
+            if not ticket._future.done():
+                ticket._future.cancel()
+        self._dispatch()
+
+    def position_of(self, ticket: AdmissionTicket) -> int:
+        if ticket.admitted:
+            return 0
+        # 在队列副本上模拟出队顺序
+        queues = OrderedDict((group_id, deque(queue)) for group_id, queue in self._queues.items())
+        credits = dict(self._credits)
+        position = 0
+        while queues:
+            position += 1
+            if self._pop_next(queues, credits) is ticket:
+                return position
+        return 0
+
+    def estimate_wait(self, position: int) -> Optional[float]:
+        """按平均耗时估算排在第 position 位的请求还需等待多久；尚无耗时数据时返回 None。"""
+        if position <= 0:
+            return 0.0
+        if self._service_time_ewma is None or self.max_in_flight <= 0:
+            return None
+        return math.ceil(position / self.max_in_flight) * self._service_time_ewma
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_groups": len(self._queues),
+            "max_in_flight": self.max_in_flight,
+            "admitted_total": self.admitted_total,
+            "avg_service_seconds": round(self._service_time_ewma, 2) if self._service_time_ewma is not None else None,
+        }
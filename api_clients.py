@@ -0,0 +1,100 @@
+import asyncio
+from typing import Dict, Tuple
+
+import httpx
+from google import genai
+from google.genai.types import HttpOptions
+from openai import AsyncOpenAI
+
+from astrbot.api import logger
+
+
+class ApiClientPool:
+    """
+    按 API Key 缓存长期复用的异步 SDK 客户端。
+
+    所有客户端共享同一个 httpx.AsyncClient 连接池，避免每次调用都重新建立 TLS 连接，
+    同时使用 SDK 的原生异步接口，不再占用默认线程池。
+    base_url 变化时旧客户端会被关闭并按需重建。
+    """
+
+    def __init__(self, max_connections: int = 32):
+        self.max_connections = max_connections
+        self._http_client: httpx.AsyncClient = self._new_http_client()
+        self._gemini_clients: Dict[Tuple[str, str], genai.Client] = {}
+        self._openai_clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+
+    def _new_http_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            # 生图耗时较长，读超时放宽；整体截止时间由调用方控制
+            timeout=httpx.Timeout(300.0, connect=15.0),
+            follow_redirects=True,
+        )
+
+    def _ensure_http_client(self) -> httpx.AsyncClient:
+        if self._http_client.is_closed:
+            self._http_client = self._new_http_client()
+        return self._http_client
+
+    def get_gemini_client(self, api_key: str, base_url: str) -> genai.Client:
+        key = (api_key, base_url)
+        client = self._gemini_clients.get(key)
+        if client is None:
+            self._drop_stale(self._gemini_clients, base_url)
+            http_options_kwargs = {"base_url": base_url}
+            # 旧版 google-genai 不支持注入自定义 httpx 客户端，此时退回 SDK 自带的连接池
+            if "httpx_async_client" in HttpOptions.model_fields:
+                http_options_kwargs["httpx_async_client"] = self._ensure_http_client()
+            client = genai.Client(api_key=api_key, http_options=HttpOptions(**http_options_kwargs))
+            self._gemini_clients[key] = client
+            logger.debug(f"ApiClientPool: 已创建 Gemini 客户端 (base_url: {base_url}, 共 {len(self._gemini_clients)} 个)")
+        return client
+
+    def get_openai_client(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        key = (api_key, base_url)
+        client = self._openai_clients.get(key)
+        if client is None:
+            self._drop_stale(self._openai_clients, base_url)
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self._ensure_http_client())
+            self._openai_clients[key] = client
+            logger.debug(f"ApiClientPool: 已创建 OpenAI 客户端 (base_url: {base_url}, 共 {len(self._openai_clients)} 个)")
+        return client
+
+    def _drop_stale(self, clients: Dict[Tuple[str, str], object], base_url: str) -> None:
+        """移除 base_url 已变化的客户端；其底层连接由共享连接池统一管理。"""
+        stale_keys = [key for key in clients if key[1] != base_url]
+        for key in stale_keys:
+            client = clients.pop(key)
+            if isinstance(client, genai.Client):
+                asyncio.create_task(self._close_gemini_client(client))
+        if stale_keys:
+            logger.info(f"ApiClientPool: base_url 已变更，移除 {len(stale_keys)} 个旧客户端。")
+
+    @staticmethod
+    async def _close_gemini_client(client: genai.Client) -> None:
+        try:
+            # 异步部分使用共享连接池时 aclose 不会关闭它，只释放 SDK 自身持有的资源
+            aclose = getattr(client.aio, "aclose", None)
+            if aclose:
+                await aclose()
+            close = getattr(client, "close", None)
+            if close:
+                close()
+        except Exception as e:
+            logger.debug(f"ApiClientPool: 关闭 Gemini 客户端时出错: {e}")
+
+    async def aclose(self) -> None:
+        """关闭全部客户端与共享连接池。"""
+        gemini_clients = list(self._gemini_clients.values())
+        self._gemini_clients.clear()
+        # AsyncOpenAI.close() 会关闭传入的共享 http_client，因此只需关闭共享连接池本身
+        self._openai_clients.clear()
+        for client in gemini_clients:
+            await self._close_gemini_client(client)
+        if not self._http_client.is_closed:
+            await self._http_client.aclose()
+        logger.info("ApiClientPool: 已关闭全部 API 客户端与共享连接池。")
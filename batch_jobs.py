@@ -0,0 +1,219 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from astrbot.api import logger
+
+# 单条提示词的状态
+ITEM_PENDING = "pending"
+ITEM_RUNNING = "running"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+
+# 任务状态
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+
+
+class BatchJob:
+    """
+    批量生成任务：提示词列表、共享参考图引用、投递目标 (unified_msg_origin) 与每条提示词的进度。
+    每条提示词记录状态、生成的图片 (已存入任务目录)、文本、错误与是否已投递。
+    """
+
+    def __init__(self, job_id: str, prompts: List[str], image_refs: List[str], origin: str, delivery: str, created: Optional[float] = None):
+        self.job_id = job_id
+        self.prompts = prompts
+        self.image_refs = image_refs
+        self.origin = origin
+        self.delivery = delivery
+        self.created = created if created is not None else time.time()
+        self.finished: Optional[float] = None
+        self.status = JOB_RUNNING
+        self.items: List[Dict[str, Any]] = [
+            {"status": ITEM_PENDING, "images": [], "text": "", "error": None, "delivered": False}
+            for _ in prompts
+        ]
+
+    @classmethod
+    def create(cls, prompts: List[str], image_refs: List[str], origin: str, delivery: str) -> "BatchJob":
+        return cls(uuid.uuid4().hex[:8], prompts, image_refs, origin, delivery)
+
+    def pending_indices(self) -> List[int]:
+        return [idx for idx, item in enumerate(self.items) if item["status"] in (ITEM_PENDING, ITEM_RUNNING)]
+
+    def counts(self) -> Dict[str, int]:
+        counts = {ITEM_PENDING: 0, ITEM_RUNNING: 0, ITEM_DONE: 0, ITEM_FAILED: 0}
+        for item in self.items:
+            counts[item["status"]] += 1
+        counts["total"] = len(self.items)
+        return counts
+
+    def dumps(self) -> str:
+        """序列化当前状态，供写入检查点；应在事件循环中调用，得到与并发修改无关的快照。"""
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "prompts": self.prompts,
+            "image_refs": self.image_refs,
+            "origin": self.origin,
+            "delivery": self.delivery,
+            "created": self.created,
+            "finished": self.finished,
+            "status": self.status,
+            "items": self.items,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BatchJob":
+        job = cls(data["job_id"], data["prompts"], data.get("image_refs", []), data["origin"], data.get("delivery", "nodes"), data.get("created"))
+        job.finished = data.get("finished")
+        job.status = data.get("status", JOB_RUNNING)
+        job.items = data["items"]
+        return job
+
+
+class BatchJobStore:
+    """
+    任务检查点：每个任务一个目录 <jobs_dir>/<job_id>/，包含 job.json 与生成的图片。
+    job.json 先写唯一命名的临时文件再原子替换，进程中途退出或并发保存时不会损坏。
+    所有方法均为同步阻塞实现，应通过 asyncio.to_thread 调用。
+    """
+
+    JOB_FILENAME = "job.json"
+
+    def __init__(self, jobs_dir: str):
+        self.jobs_dir = jobs_dir
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def save(self, job_id: str, payload: str) -> None:
+        """写入 BatchJob.dumps() 得到的快照。"""
+        job_dir = self.job_dir(job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=self.JOB_FILENAME, suffix=".tmp", dir=job_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, os.path.join(job_dir, self.JOB_FILENAME))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def load_all(self) -> List[BatchJob]:
+        jobs = []
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            path = os.path.join(self.jobs_dir, job_id, self.JOB_FILENAME)
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    jobs.append(BatchJob.from_dict(json.load(f)))
+            except Exception as e:
+                logger.warning(f"BatchJobStore: 读取任务检查点 {path} 失败: {e}")
+        return jobs
+
+    def adopt_image(self, job_id: str, index: int, seq: int, src_path: str) -> str:
+        """
+        把生成的图片链接 (或复制) 到任务目录，使其不受临时文件清理影响。
+        不移动原文件：合并请求或结果缓存命中时，临时文件可能仍被其他请求使用。
+        """
+        _, ext = os.path.splitext(src_path)
+        dst_path = os.path.join(self.job_dir(job_id), f"{index + 1:04d}_{seq}{ext}")
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        try:
+            os.link(src_path, dst_path)
+        except OSError:
+            shutil.copyfile(src_path, dst_path)
+        return dst_path
+
+    def write_archive(self, job: BatchJob) -> str:
+        """将已生成的图片与结果清单打包为 zip，返回文件路径。"""
+        archive_path = os.path.join(self.job_dir(job.job_id), f"draw_job_{job.job_id}.zip")
+        manifest = []
+        with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED) as archive:
+            for idx, (prompt, item) in enumerate(zip(job.prompts, job.items)):
+                names = []
+                for image_path in item["images"]:
+                    if os.path.isfile(image_path):
+                        name = os.path.basename(image_path)
+                        archive.write(image_path, name)
+                        names.append(name)
+                manifest.append({"index": idx + 1, "prompt": prompt, "status": item["status"], "images": names, "text": item["text"], "error": item["error"]})
+            archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+        return archive_path
+
+    def remove_job(self, job_id: str) -> None:
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def remove_outputs(self, job: BatchJob) -> None:
+        """投递完成后删除任务目录中除 job.json 以外的文件。"""
+        job_dir = self.job_dir(job.job_id)
+        if not os.path.isdir(job_dir):
+            return
+        for name in os.listdir(job_dir):
+            # 保留检查点及其正在写入的临时文件
+            if name.startswith(self.JOB_FILENAME):
+                continue
+            try:
+                os.remove(os.path.join(job_dir, name))
+            except OSError as e:
+                logger.warning(f"BatchJobStore: 删除任务文件 {name} 失败: {e}")
+
+
+class BatchJobRunner:
+    """
+    执行批量任务中的提示词：所有任务共享同一个并发上限与速率上限 (每分钟启动的提示词数，0 表示不限制)，
+    使批量任务的吞吐受 API Key 配额而不是聊天往返限制，同时不会无限占用配额。
+    """
+
+    def __init__(self, concurrency: int, rate_per_minute: float = 0):
+        self.concurrency = max(1, concurrency)
+        self.min_interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._rate_lock = asyncio.Lock()
+        self._next_start = 0.0
+        self.started_items = 0
+
+    async def _wait_for_rate(self) -> None:
+        if not self.min_interval:
+            return
+        async with self._rate_lock:
+            now = time.monotonic()
+            if self._next_start > now:
+                await asyncio.sleep(self._next_start - now)
+            self._next_start = max(now, self._next_start) + self.min_interval
+
+    async def run(self, job: BatchJob, process_item: Callable[[BatchJob, int], Awaitable[None]]) -> None:
+        """按上限并发执行 job 中所有未完成的提示词；任务被取消 (status 为 cancelled) 后不再启动新的提示词。"""
+
+        async def worker(index: int) -> None:
+            async with self._semaphore:
+                await self._wait_for_rate()
+                if job.status == JOB_CANCELLED:
+                    return
+                self.started_items += 1
+                await process_item(job, index)
+
+        # 单条提示词的意外错误不应中断其他提示词，也不应让任务停在未完成状态
+        results = await asyncio.gather(*(worker(index) for index in job.pending_indices()), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"BatchJobRunner: 批量任务 {job.job_id} 的提示词处理出错: {result}", exc_info=result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"concurrency": self.concurrency, "min_interval_seconds": round(self.min_interval, 3), "started_items": self.started_items}
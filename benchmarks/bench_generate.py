@@ -0,0 +1,173 @@
+"""
+离线基准测试：在独立进程中启动假上游，把 api_base_url 指向它，测量插件自身在
+gemini_generate / openrouter_generate 上的吞吐、延迟分位数、CPU 与峰值内存。
+
+在插件目录下运行 (需要装有 AstrBot 的 Python 环境)：
+    python benchmarks/bench_generate.py --requests 200 --concurrency 16 --output bench.json
+    python benchmarks/bench_generate.py --baseline bench.json   # 与上次结果对比
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+from PIL import Image as PILImage
+
+from common import (
+    PLUGIN_PACKAGE,
+    ResourceSampler,
+    bench_config,
+    compare_reports,
+    fetch_upstream_stats,
+    import_plugin_module,
+    latency_summary,
+    quiet_plugin_logs,
+    remove_bench_data,
+    write_report,
+)
+from fake_upstream import add_upstream_arguments, start_in_subprocess, stop_subprocess, upstream_config_from_args
+
+SCENARIOS = {
+    "gemini_generate": ("Google", False),
+    "gemini_generate_stream": ("Google", True),
+    "openrouter_generate": ("OpenRouter", False),
+}
+COMPARED_METRICS = ["throughput_rps", "latency.p50_ms", "latency.p95_ms", "latency.p99_ms", "overhead_ms", "resources.cpu_seconds", "resources.peak_rss_mb"]
+
+
+def make_reference_images(count: int, side: int, seed: int) -> List[PILImage.Image]:
+    rng = random.Random(seed)
+    return [PILImage.frombytes("RGB", (side, side), rng.randbytes(side * side * 3)) for _ in range(count)]
+
+
+async def run_scenario(name: str, artist_cls, base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    api_type, streaming = SCENARIOS[name]
+    config = bench_config(api_type, base_url, args.keys, args.concurrency, image_worker_count=args.image_workers)
+    artist = artist_cls(None, config)
+    generate = artist.gemini_generate if api_type == "Google" else artist.openrouter_generate
+    reference_images = make_reference_images(args.reference_images, args.reference_side, args.seed or 0)
+    latencies: List[float] = []
+    outcomes: Counter = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def on_part(kind: str, payload: str) -> None:
+        pass
+
+    async def one_call(index: int, record: bool) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            kwargs = {"on_part": on_part} if streaming else {}
+            try:
+                result = await generate(f"benchmark prompt {index}", reference_images, **kwargs)
+            except Exception as e:
+                outcome = type(e).__name__
+            else:
+                outcome = "success" if result.get("image_paths") else "no_image"
+                # 生成的图片不需要保留，避免磁盘占用随请求数增长
+                artist._discard_partial_images(result)
+            if record:
+                latencies.append(time.perf_counter() - started)
+                outcomes[outcome] += 1
+
+    try:
+        # 预热：建立连接、初始化 SDK 与工作池
+        await asyncio.gather(*(one_call(i, False) for i in range(min(args.warmup, args.requests))))
+        await fetch_upstream_stats(base_url, reset=True)
+        async with ResourceSampler() as sampler:
+            await asyncio.gather(*(one_call(i, True) for i in range(args.requests)))
+        upstream = await fetch_upstream_stats(base_url)
+    finally:
+        await artist.terminate()
+        remove_bench_data(config)
+
+    latency = latency_summary(latencies)
+    stages = {
+        stage: {"count": s["count"], "avg_ms": round(s["avg"] * 1000, 2), "p95_ms": round(s["p95"] * 1000, 2)}
+        for (stage,), s in sorted(artist.metrics.stage_seconds.summary().items())
+    }
+    return {
+        "name": name,
+        "throughput_rps": round(len(latencies) / sampler.wall_seconds, 2) if sampler.wall_seconds else 0.0,
+        "latency": latency,
+        # 客户端平均延迟减去假上游平均服务时间，即插件与 SDK 自身的开销 (含重试)
+        "overhead_ms": round(latency["avg_ms"] - upstream["avg_service_ms"], 2),
+        "outcomes": dict(outcomes),
+        "resources": sampler.summary(),
+        "stages": stages,
+        "upstream": {k: v for k, v in upstream.items() if k != "config"},
+    }
+
+
+def print_scenario(result: Dict[str, Any]) -> None:
+    latency, resources = result["latency"], result["resources"]
+    print(f"== {result['name']} ==")
+    print(f"  吞吐: {result['throughput_rps']} req/s  结果: {result['outcomes']}")
+    print(f"  延迟 (ms): p50 {latency['p50_ms']}  p95 {latency['p95_ms']}  p99 {latency['p99_ms']}  max {latency['max_ms']}  插件开销 {result['overhead_ms']}")
+    print(f"  CPU: {resources['cpu_seconds']} 秒 ({resources['cpu_percent']}%)  RSS: {resources['start_rss_mb']} -> 峰值 {resources['peak_rss_mb']} MB")
+    for stage, s in result["stages"].items():
+        print(f"  阶段 {stage}: {s['count']} 次，平均 {s['avg_ms']} ms，p95 {s['p95_ms']} ms")
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    quiet_plugin_logs(args.verbose)
+    artist_cls = import_plugin_module("main").GeminiArtist
+    upstream_config = upstream_config_from_args(args)
+    process, base_url = start_in_subprocess(upstream_config)
+    try:
+        scenarios = []
+        for name in args.scenarios:
+            result = await run_scenario(name, artist_cls, base_url, args)
+            print_scenario(result)
+            scenarios.append(result)
+    finally:
+        stop_subprocess(process)
+    return {
+        "plugin": PLUGIN_PACKAGE,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "parameters": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "keys": args.keys,
+            "reference_images": args.reference_images,
+            "reference_side": args.reference_side,
+            "upstream": vars(upstream_config),
+        },
+        "scenarios": scenarios,
+    }
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Gemini Artist 离线基准测试")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=["gemini_generate", "openrouter_generate"])
+    parser.add_argument("--requests", type=int, default=100, help="每个场景计入统计的请求数")
+    parser.add_argument("--warmup", type=int, default=5, help="每个场景不计入统计的预热请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的请求数")
+    parser.add_argument("--keys", type=int, default=3, help="假 API Key 数量")
+    parser.add_argument("--reference-images", type=int, default=1, help="每个请求附带的参考图数量")
+    parser.add_argument("--reference-side", type=int, default=1024, help="参考图边长 (像素)")
+    parser.add_argument("--image-workers", type=int, default=2, help="插件图片工作池大小")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--verbose", action="store_true", help="输出插件日志")
+    add_upstream_arguments(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    cli_args = parse_args(sys.argv[1:])
+    report = asyncio.run(main(cli_args))
+    if cli_args.output:
+        write_report(cli_args.output, report)
+        print(f"结果已写入 {cli_args.output}")
+    if cli_args.baseline:
+        with open(cli_args.baseline, encoding="utf-8") as f:
+            baseline_report = json.load(f)
+        print("== 与基线对比 ==")
+        for line in compare_reports(report, baseline_report, COMPARED_METRICS):
+            print(f"  {line}")
@@ -0,0 +1,198 @@
+"""基准测试与压测共用的工具：加载插件、构造测试配置、统计延迟分位数与进程资源占用。"""
+import asyncio
+import importlib
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCH_DIR)
+PLUGIN_PACKAGE = os.path.basename(PLUGIN_DIR)
+
+
+def import_plugin_module(name: str = "main"):
+    """以包的形式导入插件模块 (插件内部使用相对导入)，需要运行在装有 AstrBot 的环境中。"""
+    parent_dir = os.path.dirname(PLUGIN_DIR)
+    if parent_dir not in sys.path:
+        sys.path.insert(0, parent_dir)
+    return importlib.import_module(f"{PLUGIN_PACKAGE}.{name}")
+
+
+def quiet_plugin_logs(verbose: bool) -> None:
+    from astrbot.api import logger
+
+    logger.setLevel(logging.DEBUG if verbose else logging.WARNING)
+
+
+def bench_config(api_type: str, base_url: str, key_count: int, concurrency: int, **overrides) -> Dict[str, Any]:
+    """
+    指向假上游的插件配置：关闭后台清理、指标服务与慢请求日志，缩短重试等待。
+    数据目录指向新建的临时目录，不会读写运行中机器人的临时文件与持久化数据；用完后调用 remove_bench_data。
+    """
+    config: Dict[str, Any] = {
+        "data_dir": tempfile.mkdtemp(prefix="gemini_artist_bench_"),
+        "api_type": api_type,
+        "api_key": [f"bench-key-{i}" for i in range(key_count)],
+        # OpenAI 兼容接口的 base_url 需包含 /v1
+        "api_base_url": base_url if api_type == "Google" else f"{base_url}/v1",
+        "model": "bench-image-model",
+        "api_max_connections": max(32, concurrency * 2),
+        "max_concurrent_generations": 0,
+        "temp_cleanup_interval_seconds": 0,
+        "download_cache_max_mb": 0,
+        "metrics_port": 0,
+        "slow_request_threshold_seconds": 0,
+        "request_timeout_seconds": 0,
+        "retry_base_delay_seconds": 0.05,
+        "retry_max_delay_seconds": 0.5,
+        "key_rate_limit_cooldown_seconds": 1,
+        "key_circuit_open_seconds": 1,
+        "enable_hinting": False,
+    }
+    config.update(overrides)
+    return config
+
+
+def remove_bench_data(config: Dict[str, Any]) -> None:
+    """删除 bench_config 创建的临时数据目录 (在插件 terminate 之后调用)。"""
+    shutil.rmtree(config["data_dir"], ignore_errors=True)
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """线性插值的分位数，sorted_values 需已排序。"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "avg_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+def current_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class ResourceSampler:
+    """
+    记录一段时间内本进程的 CPU 时间与峰值 RSS。
+    有 /proc 时后台定期采样当前 RSS，得到这段时间内的峰值；否则退回进程生命周期内的 ru_maxrss。
+    """
+
+    def __init__(self, interval_seconds: float = 0.05):
+        self.interval_seconds = interval_seconds
+        self.peak_rss: Optional[int] = None
+        self.start_rss: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cpu_started = 0.0
+        self._wall_started = 0.0
+        self.cpu_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    async def __aenter__(self) -> "ResourceSampler":
+        self.start_rss = current_rss_bytes()
+        self.peak_rss = self.start_rss
+        self._cpu_started = time.process_time()
+        self._wall_started = time.perf_counter()
+        if self.start_rss is not None:
+            self._task = asyncio.create_task(self._sample())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.cpu_seconds = time.process_time() - self._cpu_started
+        self.wall_seconds = time.perf_counter() - self._wall_started
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._update_peak()
+        else:
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Linux 单位为 KB，macOS 为字节
+            self.peak_rss = max_rss if sys.platform == "darwin" else max_rss * 1024
+
+    def _update_peak(self) -> None:
+        rss = current_rss_bytes()
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    async def _sample(self) -> None:
+        while True:
+            self._update_peak()
+            await asyncio.sleep(self.interval_seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "wall_seconds": round(self.wall_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "cpu_percent": round(self.cpu_seconds / self.wall_seconds * 100, 1) if self.wall_seconds else 0.0,
+            "start_rss_mb": round(self.start_rss / 1048576, 1) if self.start_rss is not None else None,
+            "peak_rss_mb": round(self.peak_rss / 1048576, 1) if self.peak_rss is not None else None,
+        }
+
+
+async def fetch_upstream_stats(base_url: str, reset: bool = False) -> Dict[str, Any]:
+    import httpx
+
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.get(f"{base_url}/__reset" if reset else f"{base_url}/__stats")
+        return response.json()
+
+
+def write_report(path: str, report: Dict[str, Any]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def compare_reports(current: Dict[str, Any], baseline: Dict[str, Any], metrics: List[str]) -> List[str]:
+    """按场景名对比两份报告中的指标，返回带变化百分比的文字行。"""
+    lines = []
+    baseline_scenarios = {s["name"]: s for s in baseline.get("scenarios", [])}
+    for scenario in current.get("scenarios", []):
+        previous = baseline_scenarios.get(scenario["name"])
+        if previous is None:
+            lines.append(f"{scenario['name']}: 基线中没有该场景")
+            continue
+        parts = []
+        for metric in metrics:
+            now, before = _lookup(scenario, metric), _lookup(previous, metric)
+            if not isinstance(now, (int, float)) or not isinstance(before, (int, float)):
+                continue
+            change = f"{(now - before) / before * 100:+.1f}%" if before else "n/a"
+            parts.append(f"{metric} {before} -> {now} ({change})")
+        lines.append(f"{scenario['name']}: " + "; ".join(parts))
+    return lines
+
+
+def _lookup(data: Dict[str, Any], dotted: str) -> Any:
+    for part in dotted.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
@@ -0,0 +1,335 @@
+"""
+本地假上游服务：模拟 Gemini generateContent / streamGenerateContent 与 OpenAI (OpenRouter) chat completions 接口，
+并在 GET /images/<任意路径> 上充当图片托管服务，供基准测试与压测在无网络环境下使用。
+延迟、错误率与返回图片大小均可配置。
+
+单独运行：python benchmarks/fake_upstream.py --port 8765 --latency-ms 800 --image-kb 512
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import multiprocessing
+import random
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from PIL import Image as PILImage
+
+
+@dataclass
+class UpstreamConfig:
+    latency_ms: float = 500.0
+    # 延迟在 latency_ms * (1 ± jitter) 内均匀分布
+    jitter: float = 0.2
+    # 返回 500 / 429 / 无图片 / 安全拦截 的概率
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    no_image_rate: float = 0.0
+    safety_rate: float = 0.0
+    # 每次返回的图片数与单张图片的大致字节数
+    images_per_response: int = 1
+    image_kb: int = 256
+    # 图片托管 (GET /images/...) 的响应延迟
+    download_latency_ms: float = 20.0
+    seed: Optional[int] = None
+
+
+def make_png_payload(approx_bytes: int, seed: Optional[int] = None) -> bytes:
+    """生成大小约为 approx_bytes 的 PNG (随机噪声几乎不可压缩)。"""
+    side = max(8, int(math.sqrt(max(approx_bytes, 192) / 3)))
+    rng = random.Random(seed)
+    img = PILImage.frombytes("RGB", (side, side), rng.randbytes(side * side * 3))
+    buffer = BytesIO()
+    img.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class FakeUpstream:
+    """基于 asyncio 的最小 HTTP/1.1 服务，支持 keep-alive 与分块传输的流式响应。"""
+
+    def __init__(self, config: UpstreamConfig, host: str = "127.0.0.1", port: int = 0):
+        self.config = config
+        self.host = host
+        self.port = port
+        self._rng = random.Random(config.seed)
+        self._image_png = make_png_payload(config.image_kb * 1024, config.seed)
+        self._image_b64 = base64.b64encode(self._image_png).decode("ascii")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.responses: Counter = Counter()
+        self.service_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def stats(self) -> Dict[str, object]:
+        total = sum(self.responses.values())
+        # 平均服务时间只统计生成接口
+        generations = total - sum(count for (route, _), count in self.responses.items() if route == "image_host")
+        return {
+            "requests": total,
+            "responses": {f"{route} {status}": count for (route, status), count in sorted(self.responses.items())},
+            "avg_service_ms": round(self.service_seconds / generations * 1000, 2) if generations else 0.0,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "config": asdict(self.config),
+        }
+
+    def reset(self) -> None:
+        self.responses.clear()
+        self.service_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target = request_line.decode("latin-1").split()[:2]
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                body += await reader.readexactly(size)
+                await reader.readline()
+            body = bytes(body)
+        else:
+            body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+        return method, target, headers, body
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                self.bytes_in += len(body)
+                path = target.split("?")[0]
+                if path == "/__stats":
+                    await self._send_json(writer, 200, self.stats())
+                elif path == "/__reset":
+                    self.reset()
+                    await self._send_json(writer, 200, {"ok": True})
+                elif method == "GET" and path.startswith("/images/"):
+                    await self._serve_image(writer)
+                elif method == "POST" and path.endswith(":generateContent"):
+                    await self._serve(writer, "gemini", False)
+                elif method == "POST" and path.endswith(":streamGenerateContent"):
+                    await self._serve(writer, "gemini", True)
+                elif method == "POST" and path.endswith("/chat/completions"):
+                    await self._serve(writer, "openai", False)
+                else:
+                    await self._send_json(writer, 404, {"error": {"code": 404, "message": f"unknown route {path}"}})
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _latency(self) -> float:
+        jitter = self.config.jitter
+        return max(0.0, self.config.latency_ms / 1000 * self._rng.uniform(1 - jitter, 1 + jitter))
+
+    def _pick_outcome(self) -> str:
+        roll = self._rng.random()
+        for outcome, rate in (
+            ("error", self.config.error_rate),
+            ("rate_limit", self.config.rate_limit_rate),
+            ("no_image", self.config.no_image_rate),
+            ("safety", self.config.safety_rate),
+        ):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return "ok"
+
+    async def _serve(self, writer: asyncio.StreamWriter, api: str, stream: bool) -> None:
+        started = time.monotonic()
+        outcome = self._pick_outcome()
+        latency = self._latency()
+        if stream and outcome in ("ok", "no_image"):
+            status = await self._serve_gemini_stream(writer, latency, outcome)
+        else:
+            await asyncio.sleep(latency)
+            status, payload, extra_headers = self._build_response(api, outcome)
+            await self._send_json(writer, status, payload, extra_headers)
+        self.responses[(f"{api}{'_stream' if stream else ''}", status)] += 1
+        self.service_seconds += time.monotonic() - started
+
+    async def _serve_image(self, writer: asyncio.StreamWriter) -> None:
+        await asyncio.sleep(self.config.download_latency_ms / 1000)
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: image/png\r\nContent-Length: {len(self._image_png)}\r\n\r\n".encode("latin-1") + self._image_png
+        )
+        self.bytes_out += len(self._image_png)
+        await writer.drain()
+        self.responses[("image_host", 200)] += 1
+
+    def _build_response(self, api: str, outcome: str) -> Tuple[int, Dict[str, object], Dict[str, str]]:
+        if outcome == "error":
+            status, error_status = 500, "INTERNAL"
+        elif outcome == "rate_limit":
+            status, error_status = 429, "RESOURCE_EXHAUSTED"
+        else:
+            status = 200
+        if status != 200:
+            if api == "gemini":
+                payload = {"error": {"code": status, "message": "fake upstream error", "status": error_status}}
+            else:
+                payload = {"error": {"message": "fake upstream error", "type": error_status.lower(), "code": status}}
+            return status, payload, ({"Retry-After": "0"} if status == 429 else {})
+
+        image_count = 0 if outcome in ("no_image", "safety") else self.config.images_per_response
+        if api == "gemini":
+            parts = [{"text": "fake generated image"}]
+            parts += [{"inlineData": {"mimeType": "image/png", "data": self._image_b64}} for _ in range(image_count)]
+            candidate = {"content": {"role": "model", "parts": parts}, "finishReason": "SAFETY" if outcome == "safety" else "STOP", "index": 0}
+            if outcome == "safety":
+                candidate.pop("content")
+            return 200, {"candidates": [candidate]}, {}
+        message = {
+            "role": "assistant",
+            "content": "fake generated image",
+            "images": [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{self._image_b64}"}} for _ in range(image_count)],
+        }
+        choice = {"index": 0, "message": message, "finish_reason": "content_filter" if outcome == "safety" else "stop"}
+        return 200, {
+            "id": f"fake-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "fake-image-model",
+            "choices": [choice],
+        }, {}
+
+    async def _serve_gemini_stream(self, writer: asyncio.StreamWriter, latency: float, outcome: str) -> int:
+        """以 SSE 分块发送：先文字，之后每张图片一个事件，最后一个事件带 finishReason。"""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n"
+        )
+        image_count = 0 if outcome == "no_image" else self.config.images_per_response
+        events = [[{"text": "fake generated image\n\n"}]]
+        events += [[{"inlineData": {"mimeType": "image/png", "data": self._image_b64}}] for _ in range(image_count)]
+        step = latency / len(events)
+        for index, parts in enumerate(events):
+            await asyncio.sleep(step)
+            candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+            if index == len(events) - 1:
+                candidate["finishReason"] = "STOP"
+            data = b"data: " + json.dumps({"candidates": [candidate]}).encode("utf-8") + b"\r\n\r\n"
+            writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+            self.bytes_out += len(data)
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return 200
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, payload: object, extra_headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}.get(status, "Error")
+        head = f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        for name, value in (extra_headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        writer.write((head + "\r\n").encode("latin-1") + body)
+        self.bytes_out += len(body)
+        await writer.drain()
+
+
+def _serve_forever(config: UpstreamConfig, host: str, port: int, port_conn) -> None:
+    async def main() -> None:
+        upstream = FakeUpstream(config, host, port)
+        bound_port = await upstream.start()
+        if port_conn is not None:
+            port_conn.send(bound_port)
+            port_conn.close()
+        else:
+            print(f"fake upstream listening on http://{host}:{bound_port}", flush=True)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def start_in_subprocess(config: UpstreamConfig, host: str = "127.0.0.1") -> Tuple[multiprocessing.Process, str]:
+    """在独立进程中启动假上游，使其 CPU 与内存不计入被测进程；返回 (进程, base_url)。"""
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_serve_forever, args=(config, host, 0, child_conn), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 30
+    while not parent_conn.poll(0.1):
+        if not process.is_alive() or time.monotonic() > deadline:
+            process.terminate()
+            raise RuntimeError(f"fake upstream failed to start (exit code {process.exitcode})")
+    port = parent_conn.recv()
+    return process, f"http://{host}:{port}"
+
+
+def stop_subprocess(process: multiprocessing.Process) -> None:
+    process.terminate()
+    process.join(timeout=5)
+
+
+def add_upstream_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = UpstreamConfig()
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="假上游的平均响应延迟 (毫秒)")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="延迟抖动比例")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="返回 500 的概率")
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate, help="返回 429 的概率")
+    parser.add_argument("--no-image-rate", type=float, default=defaults.no_image_rate, help="只返回文字的概率")
+    parser.add_argument("--safety-rate", type=float, default=defaults.safety_rate, help="返回安全拦截的概率")
+    parser.add_argument("--images-per-response", type=int, default=defaults.images_per_response, help="每次返回的图片数")
+    parser.add_argument("--image-kb", type=int, default=defaults.image_kb, help="返回图片的大致大小 (KB)")
+    parser.add_argument("--download-latency-ms", type=float, default=defaults.download_latency_ms, help="图片托管的响应延迟 (毫秒)")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子，便于复现")
+
+
+def upstream_config_from_args(args: argparse.Namespace) -> UpstreamConfig:
+    return UpstreamConfig(
+        latency_ms=args.latency_ms,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        no_image_rate=args.no_image_rate,
+        safety_rate=args.safety_rate,
+        images_per_response=args.images_per_response,
+        image_kb=args.image_kb,
+        download_latency_ms=args.download_latency_ms,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地假 Gemini / OpenRouter 上游服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_upstream_arguments(parser)
+    cli_args = parser.parse_args()
+    _serve_forever(upstream_config_from_args(cli_args), cli_args.host, cli_args.port, None)
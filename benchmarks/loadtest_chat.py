@@ -0,0 +1,395 @@
+"""
+群聊压测：用假的消息事件模拟大量用户与群组的聊天流量，经由插件的消息入口 (on_message → cache_user_images /
+collect_user_inputs)、/draw 会话与 gemini_draw 工具调用，图片托管与生成接口均由本地假上游提供。
+报告每条消息的处理开销、image_history_cache / user_inputs 的内存增长与生成吞吐。
+
+在插件目录下运行 (需要装有 AstrBot 的 Python 环境)：
+    python benchmarks/loadtest_chat.py --users 5000 --groups 300 --messages 50000 --rate 800 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Any, AsyncGenerator, Dict, List
+
+from common import (
+    PLUGIN_PACKAGE,
+    ResourceSampler,
+    bench_config,
+    compare_reports,
+    current_rss_bytes,
+    fetch_upstream_stats,
+    import_plugin_module,
+    latency_summary,
+    quiet_plugin_logs,
+    remove_bench_data,
+    write_report,
+)
+from fake_upstream import add_upstream_arguments, start_in_subprocess, stop_subprocess, upstream_config_from_args
+
+BOT_ID = "10000"
+COMPARED_METRICS = [
+    "message_rate",
+    "handler.text.p99_ms",
+    "handler.image.p99_ms",
+    "generation.throughput_per_second",
+    "generation.latency.p95_ms",
+    "memory.rss_growth_mb",
+    "memory.history_bytes_end",
+]
+
+
+class FakeMessageObj:
+    """AstrBotMessage 中插件用到的字段。"""
+
+    def __init__(self, group_id: str, self_id: str, message: List[Any]):
+        self.type = "GroupMessage" if group_id else "FriendMessage"
+        self.group_id = group_id
+        self.self_id = self_id
+        self.message = message
+
+
+class FakeEvent:
+    """
+    AstrMessageEvent 的替身：只实现插件调用的方法，结果以 ("plain", 文本) / ("chain", 消息链) 返回，
+    不经过任何平台适配器。
+    """
+
+    def __init__(self, user_id: str, group_id: str, chain: List[Any], text: str):
+        self.message_obj = FakeMessageObj(group_id, BOT_ID, chain)
+        self.message_str = text
+        self._user_id = user_id
+        self._chain = chain
+        self.stopped = False
+
+    def get_sender_id(self) -> str:
+        return self._user_id
+
+    def get_sender_name(self) -> str:
+        return f"user{self._user_id}"
+
+    def get_messages(self) -> List[Any]:
+        return self._chain
+
+    def plain_result(self, text: str):
+        return "plain", text
+
+    def chain_result(self, chain: List[Any]):
+        return "chain", chain
+
+    def stop_event(self) -> None:
+        self.stopped = True
+
+
+class ChatLoadTest:
+    def __init__(self, artist, components, base_url: str, args: argparse.Namespace):
+        self.artist = artist
+        self.Image, self.Plain, self.Reply, self.Nodes = components
+        self.base_url = base_url
+        self.args = args
+        self.rng = random.Random(args.seed or 0)
+        self.users = [str(100000 + i) for i in range(args.users)]
+        self.groups = [str(900000 + i) for i in range(args.groups)]
+        self.image_counter = 0
+        self.recent_urls: List[str] = []
+        self.handler_seconds: Dict[str, List[float]] = defaultdict(list)
+        self.generation_seconds: Dict[str, List[float]] = defaultdict(list)
+        self.generation_outcomes: Counter = Counter()
+        self.message_kinds: Counter = Counter()
+        self.schedule_lag: List[float] = []
+        self.samples: List[Dict[str, Any]] = []
+        self.messages_sent = 0
+        self.started = 0.0
+
+    # ---- 流量生成 ----
+
+    def _context(self) -> tuple:
+        user_id = self.rng.choice(self.users)
+        if self.rng.random() < self.args.private_rate:
+            return user_id, ""
+        # 每个用户固定属于少数几个群，模拟真实的群活跃分布
+        home = int(user_id) % len(self.groups)
+        return user_id, self.groups[(home + self.rng.randrange(3)) % len(self.groups)]
+
+    def _image_url(self, group_id: str) -> str:
+        if self.recent_urls and self.rng.random() < self.args.image_reuse:
+            return self.rng.choice(self.recent_urls)
+        self.image_counter += 1
+        url = f"{self.base_url}/images/{group_id or 'private'}/{self.image_counter}.png"
+        self.recent_urls.append(url)
+        if len(self.recent_urls) > 200:
+            self.recent_urls.pop(0)
+        return url
+
+    def _image_components(self, group_id: str, count: int) -> List[Any]:
+        components = []
+        for _ in range(count):
+            url = self._image_url(group_id)
+            components.append(self.Image(file=url, url=url))
+        return components
+
+    def _pick_kind(self) -> str:
+        roll = self.rng.random()
+        for kind, rate in (
+            ("tool_call", self.args.tool_rate),
+            ("reply_edit", self.args.reply_rate),
+            ("draw_session", self.args.draw_rate),
+            ("image", self.args.image_rate),
+        ):
+            if roll < rate:
+                return kind
+            roll -= rate
+        return "text"
+
+    # ---- 处理器调用 ----
+
+    async def _drain(self, results: AsyncGenerator) -> int:
+        """消费处理器产出的全部结果，返回发出的图片数。"""
+        images = 0
+        async for item in results:
+            if isinstance(item, tuple) and item[0] == "chain":
+                for component in item[1]:
+                    if isinstance(component, self.Image):
+                        images += 1
+                    elif isinstance(component, self.Nodes):
+                        images += sum(1 for node in component.nodes for part in node.content if isinstance(part, self.Image))
+        return images
+
+    async def _message(self, kind: str, user_id: str, group_id: str, chain: List[Any], text: str) -> int:
+        event = FakeEvent(user_id, group_id, chain, text)
+        started = time.perf_counter()
+        images = await self._drain(self.artist.on_message(event))
+        self.handler_seconds[kind].append(time.perf_counter() - started)
+        return images
+
+    async def _generation(self, kind: str, coro) -> None:
+        started = time.perf_counter()
+        try:
+            images = await coro
+        except Exception as e:
+            self.generation_outcomes[f"{kind} {type(e).__name__}"] += 1
+            return
+        self.generation_seconds[kind].append(time.perf_counter() - started)
+        self.generation_outcomes[f"{kind} {'images' if images else 'no_images'}"] += 1
+
+    async def _run_flow(self, kind: str) -> None:
+        user_id, group_id = self._context()
+        if kind == "text":
+            await self._message("text", user_id, group_id, [self.Plain(f"hello {self.rng.random():.6f}")], "hello")
+        elif kind == "image":
+            chain = self._image_components(group_id, self.rng.randint(1, 3))
+            await self._message("image", user_id, group_id, chain, "")
+        elif kind == "tool_call":
+            # LLM 调用工具时，触发消息本身也会先经过 on_message
+            text = "画一只猫"
+            await self._message("text", user_id, group_id, [self.Plain(text)], text)
+            event = FakeEvent(user_id, group_id, [self.Plain(text)], text)
+            image_index = self.rng.choice([0, 0, 1, 2])
+            reference_bot = image_index > 0 and self.rng.random() < 0.3
+            await self._generation("tool_call", self._drain(self.artist.gemini_draw(event, "a cat in watercolor", image_index, reference_bot)))
+        elif kind == "reply_edit":
+            replied = self._image_components(group_id, self.rng.randint(1, 2))
+            chain = [self.Reply(id=str(self.rng.randrange(1 << 30)), chain=replied), self.Plain("把背景换成海边")]
+            await self._message("reply", user_id, group_id, chain, "把背景换成海边")
+            event = FakeEvent(user_id, group_id, chain, "把背景换成海边")
+            await self._generation("reply_edit", self._drain(self.artist.gemini_draw(event, "change the background to a beach")))
+        elif kind == "draw_session":
+            await self._generation("draw", self._draw_session(user_id, group_id))
+
+    async def _draw_session(self, user_id: str, group_id: str) -> int:
+        await self._drain(self.artist.initiate_creation_session(FakeEvent(user_id, group_id, [self.Plain("/draw")], "/draw")))
+        await asyncio.sleep(self.rng.uniform(0.2, 1.0))
+        chain = [self.Plain("a lighthouse at night")] + self._image_components(group_id, self.rng.randint(0, 2))
+        await self._message("draw_input", user_id, group_id, chain, "a lighthouse at night")
+        await asyncio.sleep(self.rng.uniform(0.2, 1.0))
+        # 开始指令会触发生成，耗时计入生成而非消息处理
+        return await self._drain(self.artist.on_message(FakeEvent(user_id, group_id, [self.Plain("开始")], "开始")))
+
+    # ---- 采样与驱动 ----
+
+    def _sample(self) -> None:
+        history = self.artist.image_history_cache.stats()
+        admission = self.artist.admission.stats()
+        rss = current_rss_bytes()
+        self.samples.append({
+            "t": round(time.perf_counter() - self.started, 2),
+            "messages": self.messages_sent,
+            "rss_mb": round(rss / 1048576, 1) if rss is not None else None,
+            "history_keys": history["keys"],
+            "history_entries": history["entries"],
+            "history_bytes": history["approx_bytes"],
+            "draw_sessions": len(self.artist.waiting_users),
+            "user_inputs": len(self.artist.user_inputs),
+            "user_inputs_bytes": sum(session.get("bytes", 0) for session in self.artist.user_inputs.values()),
+            "in_flight": admission["in_flight"],
+            "queued": admission["queued"],
+        })
+
+    async def _sampler(self) -> None:
+        while True:
+            self._sample()
+            await asyncio.sleep(self.args.sample_interval)
+
+    async def run(self) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        pending: set = set()
+        interval = 1.0 / self.args.rate
+        self.started = time.perf_counter()
+        sampler = asyncio.create_task(self._sampler())
+        try:
+            async with ResourceSampler() as resources:
+                scheduled = loop.time()
+                for _ in range(self.args.messages):
+                    scheduled += interval
+                    delay = scheduled - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    # 驱动落后于计划的时间反映事件循环的拥塞程度
+                    self.schedule_lag.append(max(0.0, -delay))
+                    kind = self._pick_kind()
+                    self.message_kinds[kind] += 1
+                    self.messages_sent += 1
+                    task = asyncio.create_task(self._run_flow(kind))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                send_seconds = time.perf_counter() - self.started
+                # 等待进行中的生成完成
+                if pending:
+                    _, still_pending = await asyncio.wait(set(pending), timeout=self.args.drain_timeout)
+                    for task in still_pending:
+                        task.cancel()
+                    await asyncio.gather(*still_pending, return_exceptions=True)
+        finally:
+            sampler.cancel()
+            await asyncio.gather(sampler, return_exceptions=True)
+        self._sample()
+        return self._report(send_seconds, resources)
+
+    def _report(self, send_seconds: float, resources: ResourceSampler) -> Dict[str, Any]:
+        first, last = self.samples[0], self.samples[-1]
+
+        def peak(field: str):
+            return max((s[field] for s in self.samples if s[field] is not None), default=None)
+
+        all_generations = [seconds for values in self.generation_seconds.values() for seconds in values]
+        return {
+            "name": "chat_load",
+            "message_rate": round(self.messages_sent / send_seconds, 1) if send_seconds else 0.0,
+            "message_kinds": dict(self.message_kinds),
+            "schedule_lag": latency_summary(self.schedule_lag),
+            "handler": {kind: latency_summary(values) for kind, values in sorted(self.handler_seconds.items())},
+            "generation": {
+                "completed": len(all_generations),
+                "throughput_per_second": round(len(all_generations) / resources.wall_seconds, 3) if resources.wall_seconds else 0.0,
+                "latency": latency_summary(all_generations),
+                "by_kind": {kind: latency_summary(values) for kind, values in sorted(self.generation_seconds.items())},
+                "outcomes": dict(self.generation_outcomes),
+            },
+            "memory": {
+                "rss_growth_mb": round(last["rss_mb"] - first["rss_mb"], 1) if last["rss_mb"] is not None and first["rss_mb"] is not None else None,
+                "history_entries_end": last["history_entries"],
+                "history_bytes_end": last["history_bytes"],
+                "history_bytes_peak": peak("history_bytes"),
+                "user_inputs_peak": peak("user_inputs"),
+                "user_inputs_bytes_peak": peak("user_inputs_bytes"),
+                "queued_peak": peak("queued"),
+            },
+            "resources": resources.summary(),
+            "samples": self.samples,
+        }
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"== 群聊压测 == 实际消息速率 {result['message_rate']} 条/秒  {result['message_kinds']}")
+    lag = result["schedule_lag"]
+    print(f"  调度滞后 (ms): p50 {lag['p50_ms']}  p99 {lag['p99_ms']}  max {lag['max_ms']}")
+    for kind, s in result["handler"].items():
+        print(f"  消息处理 {kind}: {s['count']} 条，p50 {s['p50_ms']} ms  p95 {s['p95_ms']} ms  p99 {s['p99_ms']} ms")
+    generation = result["generation"]
+    latency = generation["latency"]
+    print(f"  生成: 完成 {generation['completed']} 次，{generation['throughput_per_second']} 次/秒，p50 {latency['p50_ms']} ms  p95 {latency['p95_ms']} ms  结果 {generation['outcomes']}")
+    memory, resources = result["memory"], result["resources"]
+    print(f"  内存: RSS 增长 {memory['rss_growth_mb']} MB (峰值 {resources['peak_rss_mb']} MB)，图片历史 {memory['history_entries_end']} 条 / {memory['history_bytes_end']} 字节 (峰值 {memory['history_bytes_peak']})，"
+          f"/draw 会话峰值 {memory['user_inputs_peak']} 个 / {memory['user_inputs_bytes_peak']} 字节，排队峰值 {memory['queued_peak']}")
+    print(f"  CPU: {resources['cpu_seconds']} 秒 ({resources['cpu_percent']}%)")
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    quiet_plugin_logs(args.verbose)
+    artist_cls = import_plugin_module("main").GeminiArtist
+    from astrbot.api.message_components import Image, Nodes, Plain, Reply
+
+    upstream_config = upstream_config_from_args(args)
+    process, base_url = start_in_subprocess(upstream_config)
+    artist = None
+    config = None
+    try:
+        config = bench_config(
+            args.api_type, base_url, args.keys, args.max_concurrent_generations,
+            robot_self_id=BOT_ID,
+            max_concurrent_generations=args.max_concurrent_generations,
+            request_timeout_seconds=args.request_timeout,
+            download_cache_max_mb=args.download_cache_mb,
+            wait_time=30,
+            enable_hinting=True,
+        )
+        artist = artist_cls(None, config)
+        result = await ChatLoadTest(artist, (Image, Plain, Reply, Nodes), base_url, args).run()
+        result["upstream"] = {k: v for k, v in (await fetch_upstream_stats(base_url)).items() if k != "config"}
+    finally:
+        if artist is not None:
+            await artist.terminate()
+        if config is not None:
+            remove_bench_data(config)
+        stop_subprocess(process)
+    print_report(result)
+    return {
+        "plugin": PLUGIN_PACKAGE,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "verbose")},
+        "scenarios": [result],
+    }
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Gemini Artist 群聊流量压测")
+    parser.add_argument("--users", type=int, default=5000, help="模拟用户数")
+    parser.add_argument("--groups", type=int, default=300, help="模拟群组数")
+    parser.add_argument("--messages", type=int, default=20000, help="发送的消息总数")
+    parser.add_argument("--rate", type=float, default=500, help="目标消息速率 (条/秒)")
+    parser.add_argument("--private-rate", type=float, default=0.05, help="私聊消息比例")
+    parser.add_argument("--image-rate", type=float, default=0.15, help="图片消息比例")
+    parser.add_argument("--image-reuse", type=float, default=0.2, help="图片消息复用近期图片URL的比例 (命中下载缓存)")
+    parser.add_argument("--tool-rate", type=float, default=0.004, help="gemini_draw 工具调用比例")
+    parser.add_argument("--reply-rate", type=float, default=0.002, help="回复图片进行编辑的工具调用比例")
+    parser.add_argument("--draw-rate", type=float, default=0.002, help="/draw 会话比例")
+    parser.add_argument("--api-type", choices=["Google", "OpenRouter"], default="Google")
+    parser.add_argument("--keys", type=int, default=3, help="假 API Key 数量")
+    parser.add_argument("--max-concurrent-generations", type=int, default=4)
+    parser.add_argument("--request-timeout", type=float, default=120, help="插件的端到端请求超时 (秒)")
+    parser.add_argument("--download-cache-mb", type=int, default=64, help="插件下载缓存容量，0 表示禁用")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="内存与队列采样间隔 (秒)")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="发送结束后等待进行中生成的时间 (秒)")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--verbose", action="store_true", help="输出插件日志")
+    add_upstream_arguments(parser)
+    parser.set_defaults(image_kb=128)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    cli_args = parse_args(sys.argv[1:])
+    report = asyncio.run(main(cli_args))
+    if cli_args.output:
+        write_report(cli_args.output, report)
+        print(f"结果已写入 {cli_args.output}")
+    if cli_args.baseline:
+        with open(cli_args.baseline, encoding="utf-8") as f:
+            baseline_report = json.load(f)
+        print("== 与基线对比 ==")
+        for line in compare_reports(report, baseline_report, COMPARED_METRICS):
+            print(f"  {line}")
@@ -0,0 +1,50 @@
+import asyncio
+import time
+from typing import Awaitable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class RequestTimeoutError(asyncio.TimeoutError):
+    """请求超过端到端截止时间。"""
+
+
+class RequestDeadline:
+    """
+    单个绘图请求的端到端截止时间，覆盖参考图下载、预处理、各 API Key 的尝试与结果保存。
+    timeout_seconds <= 0 表示不限制。
+    """
+
+    __slots__ = ("timeout_seconds", "started_at", "expires_at")
+
+    def __init__(self, timeout_seconds: float):
+        self.timeout_seconds = timeout_seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + timeout_seconds if timeout_seconds > 0 else None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> Optional[float]:
+        """剩余秒数；不限制时返回 None。"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def error(self) -> RequestTimeoutError:
+        return RequestTimeoutError(f"请求超过 {self.timeout_seconds} 秒的截止时间")
+
+    async def run(self, awaitable: Awaitable[T]) -> T:
+        """在剩余时间内等待 awaitable，超时则取消它并抛出 RequestTimeoutError。"""
+        remaining = self.remaining()
+        if remaining is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError as e:
+            if self.expired():
+                raise self.error() from e
+            raise
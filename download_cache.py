@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from astrbot.api import logger
+
+
+class DownloadCache:
+    """
+    以内容哈希寻址的磁盘下载缓存。
+
+    - 文件以 sha256 命名存放，相同内容只保存一份；
+    - 同时维护 URL -> sha256 的索引，重复引用同一URL时跳过网络下载；
+    - 超出字节预算时按 LRU 淘汰；
+    - 命中时校验文件大小与哈希，损坏的条目会被丢弃并计为未命中。
+    所有方法均为同步阻塞实现，调用方应通过 asyncio.to_thread 调用。
+    """
+
+    INDEX_FILENAME = "index.json"
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # sha256 -> {'file': 文件名, 'size': 字节数, 'atime': 最近访问时间}，按访问顺序排列
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._url_to_digest: Dict[str, str] = {}
+        self._digest_to_urls: Dict[str, Set[str]] = {}
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.integrity_failures = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def _hash_file(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _load_index(self) -> None:
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        if not os.path.exists(index_path):
+            return
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"下载缓存索引读取失败，将重建空索引: {e}")
+            return
+        entries = sorted(data.get("entries", {}).items(), key=lambda item: item[1].get("atime", 0))
+        for digest, entry in entries:
+            file_path = os.path.join(self.cache_dir, entry.get("file", ""))
+            if not os.path.isfile(file_path) or os.path.getsize(file_path) != entry.get("size"):
+                continue
+            self._entries[digest] = entry
+            self._total_bytes += entry["size"]
+        for url, digest in data.get("urls", {}).items():
+            if digest in self._entries:
+                self._url_to_digest[url] = digest
+                self._digest_to_urls.setdefault(digest, set()).add(url)
+        logger.info(f"下载缓存已加载 {len(self._entries)} 个文件 ({self._total_bytes} 字节) @ {self.cache_dir}")
+        self._evict_over_budget()
+
+    def _save_index(self) -> None:
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        tmp_path = index_path + ".tmp"
+        data = {"entries": dict(self._entries), "urls": self._url_to_digest}
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, index_path)
+        except Exception as e:
+            logger.warning(f"写入下载缓存索引失败: {e}")
+
+    def _drop_entry(self, digest: str) -> None:
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return
+        self._total_bytes -= entry["size"]
+        for url in self._digest_to_urls.pop(digest, set()):
+            self._url_to_digest.pop(url, None)
+        try:
+            os.remove(os.path.join(self.cache_dir, entry["file"]))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"删除下载缓存文件 {entry['file']} 失败: {e}")
+
+    def _evict_over_budget(self) -> None:
+        while self._entries and self._total_bytes > self.max_bytes:
+            digest = next(iter(self._entries))
+            self._drop_entry(digest)
+            self.evictions += 1
+
+    def lookup(self, url: str) -> Optional[str]:
+        """
+        按URL查找缓存文件，命中且校验通过时返回本地路径，否则返回 None。
+        """
+        with self._lock:
+            digest = self._url_to_digest.get(url)
+            entry = self._entries.get(digest) if digest else None
+            if entry is None:
+                self.misses += 1
+                return None
+            file_path = os.path.join(self.cache_dir, entry["file"])
+            try:
+                valid = os.path.getsize(file_path) == entry["size"] and self._hash_file(file_path) == digest
+            except OSError:
+                valid = False
+            if not valid:
+                logger.warning(f"下载缓存文件校验失败，已丢弃: {file_path}")
+                self._drop_entry(digest)
+                self.integrity_failures += 1
+                self.misses += 1
+                self._save_index()
+                return None
+            entry["atime"] = time.time()
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return file_path
+
+    def store(self, url: str, downloaded_path: str, ext: str) -> str:
+        """
+        将刚下载的文件移入缓存并记录URL索引，返回缓存中的文件路径。
+        若相同内容已存在，则删除 downloaded_path 并复用已有文件；
+        单个文件超过整个预算时不缓存，原样返回 downloaded_path。
+        """
+        size = os.path.getsize(downloaded_path)
+        if size > self.max_bytes:
+            return downloaded_path
+        digest = self._hash_file(downloaded_path)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                os.remove(downloaded_path)
+                entry["atime"] = time.time()
+                self._entries.move_to_end(digest)
+            else:
+                filename = f"{digest}{ext}"
+                os.replace(downloaded_path, os.path.join(self.cache_dir, filename))
+                entry = {"file": filename, "size": size, "atime": time.time()}
+                self._entries[digest] = entry
+                self._total_bytes += size
+            old_digest = self._url_to_digest.get(url)
+            if old_digest and old_digest != digest:
+                self._digest_to_urls.get(old_digest, set()).discard(url)
+            self._url_to_digest[url] = digest
+            self._digest_to_urls.setdefault(digest, set()).add(url)
+            # 刚写入的条目位于 LRU 末尾，不会被本次淘汰
+            self._evict_over_budget()
+            self._save_index()
+            return os.path.join(self.cache_dir, entry["file"])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "integrity_failures": self.integrity_failures,
+                "files": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
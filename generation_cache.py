@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import os
+import random
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image as PILImage
+
+from astrbot.api import logger
+
+
+def normalize_prompt(prompt: str) -> str:
+    """折叠空白并忽略大小写，使仅有格式差异的提示词得到相同的键。"""
+    return re.sub(r"\s+", " ", prompt or "").strip().casefold()
+
+
+def image_digest(image: PILImage.Image) -> str:
+    """计算 PIL 图片像素内容的摘要 (包含尺寸与模式)。"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def image_digests(images: List[PILImage.Image]) -> List[str]:
+    return [image_digest(image) for image in images]
+
+
+def generation_cache_key(api_type: str, model: str, prompt: str, image_digests: List[str]) -> str:
+    """由后端、模型、规范化后的提示词与参考图摘要组成生成请求的键。"""
+    raw = "\x1f".join([api_type, model, normalize_prompt(prompt), *image_digests])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    合并相同键的并发请求：同一时刻只有一个上游调用，其余请求等待并共享其结果。
+    上游调用在独立任务中执行，首个请求方被取消不会影响其他等待者；
+    所有等待者都离开后才取消上游调用。
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行 func 或加入已有的同键调用。返回 (结果, 是否为共享结果)。
+        """
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            flight = _Flight(asyncio.create_task(func()))
+            self._flights[key] = flight
+            self.leaders += 1
+
+            def _forget(_task: asyncio.Task, key=key, flight=flight) -> None:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+            flight.task.add_done_callback(_forget)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
+
+
+class ResultCache:
+    """
+    生成结果缓存：按生成请求的键保存生成的图片文件与文本。
+
+    - 条目在 ttl_seconds 后过期，缓存图片总字节数超过 max_bytes 时淘汰最久未使用的
+      (图片大小差异很大，按字节而不是条目数限制磁盘占用)；
+    - 图片文件单独保存在 cache_dir 中，不受临时目录定时清理影响；
+    - 命中时把缓存文件复制为 temp_dir() 返回的临时文件分片目录中的新文件，与新生成的图片一样进入历史缓存并按临时文件管理。
+    所有方法均为同步阻塞实现，调用方应通过 asyncio.to_thread 调用。
+    """
+
+    def __init__(self, cache_dir: str, temp_dir: Callable[[], str], ttl_seconds: int, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.temp_dir = temp_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max(1, max_bytes)
+        self._lock = threading.Lock()
+        # key -> {'text': str, 'files': [文件名], 'bytes': int, 'created': 时间戳}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # 索引只在内存中，启动时清理上次遗留的文件
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _link_or_copy(src: str, dst: str) -> None:
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._total_bytes -= entry["bytes"]
+        for filename in entry["files"]:
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"删除结果缓存文件 {filename} 失败: {e}")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.time() - entry["created"] > self.ttl_seconds:
+                self._drop(key)
+                self.misses += 1
+                return None
+            image_paths = []
+            try:
+                for filename in entry["files"]:
+                    _, ext = os.path.splitext(filename)
+                    temp_fp = os.path.join(self.temp_dir(), f"result_cache_hit_{time.time()}_{random.randint(100,999)}{ext}")
+                    self._link_or_copy(os.path.join(self.cache_dir, filename), temp_fp)
+                    image_paths.append(temp_fp)
+            except OSError as e:
+                logger.warning(f"结果缓存文件不可用，已丢弃该条目: {e}")
+                for temp_fp in image_paths:
+                    try:
+                        os.remove(temp_fp)
+                    except OSError:
+                        pass
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {"text": entry["text"], "image_paths": image_paths}
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        image_paths = [p for p in result.get("image_paths", []) if p and os.path.isfile(p)]
+        if not image_paths:
+            return
+        with self._lock:
+            self._drop(key)
+            files = []
+            size = 0
+            try:
+                for idx, image_path in enumerate(image_paths):
+                    _, ext = os.path.splitext(image_path)
+                    filename = f"{key[:32]}_{idx}{ext}"
+                    self._link_or_copy(image_path, os.path.join(self.cache_dir, filename))
+                    files.append(filename)
+                    size += os.path.getsize(os.path.join(self.cache_dir, filename))
+            except OSError as e:
+                logger.warning(f"写入结果缓存失败: {e}")
+                self._entries[key] = {"text": "", "files": files, "bytes": 0, "created": 0}
+                self._drop(key)
+                return
+            self._entries[key] = {"text": result.get("text", ""), "files": files, "bytes": size, "created": time.time()}
+            self._total_bytes += size
+            # 单个条目超过上限时也会被淘汰，不缓存
+            while self._entries and self._total_bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total_bytes, "hits": self.hits, "misses": self.misses}
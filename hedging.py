@@ -0,0 +1,65 @@
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    对冲请求策略。
+
+    - 记录最近成功请求的耗时，以指定分位数作为对冲延迟；
+    - 采用令牌桶限制对冲流量：每个主请求累积 budget_ratio 个令牌，每次对冲消耗 1 个，
+      因此对冲请求数长期不超过主请求数的 budget_ratio 倍。
+    """
+
+    MIN_SAMPLES = 10
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        budget_ratio: float = 0.1,
+        fallback_delay_seconds: float = 30.0,
+        min_delay_seconds: float = 1.0,
+        window_size: int = 200,
+    ):
+        self.percentile = min(max(percentile, 1.0), 99.9)
+        self.budget_ratio = max(budget_ratio, 0.0)
+        self.fallback_delay_seconds = fallback_delay_seconds
+        self.min_delay_seconds = min_delay_seconds
+        self._latencies: deque = deque(maxlen=window_size)
+        # 令牌上限，避免长时间空闲后集中爆发对冲
+        self._max_tokens = max(1.0, self.budget_ratio * 10)
+        self._tokens = 0.0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.hedges_denied = 0
+
+    def record_latency(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def delay(self) -> float:
+        """返回首个请求等待多久后发出对冲请求。样本不足时使用兜底延迟。"""
+        if len(self._latencies) < self.MIN_SAMPLES:
+            return self.fallback_delay_seconds
+        ordered = sorted(self._latencies)
+        rank = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))
+        return max(self.min_delay_seconds, ordered[rank])
+
+    def note_request(self) -> None:
+        self._tokens = min(self._max_tokens, self._tokens + self.budget_ratio)
+
+    def try_acquire(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            self.hedges_sent += 1
+            return True
+        self.hedges_denied += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "delay_seconds": round(self.delay(), 2),
+            "samples": len(self._latencies),
+            "tokens": round(self._tokens, 2),
+            "hedges_sent": self.hedges_sent,
+            "hedges_won": self.hedges_won,
+            "hedges_denied": self.hedges_denied,
+        }
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from astrbot.api import logger
+
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS image_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        group_id TEXT NOT NULL,
+        is_bot INTEGER NOT NULL DEFAULT 0,
+        ref TEXT NOT NULL,
+        filename TEXT,
+        created_at REAL NOT NULL
+    )
+    """,
+    # 旧版索引包含 is_bot 列，无法在不限定 is_bot 的查询中按 id 排序
+    "DROP INDEX IF EXISTS idx_image_history_key",
+    "CREATE INDEX IF NOT EXISTS idx_image_history_user_key ON image_history (user_id, group_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_image_history_created ON image_history (created_at)",
+)
+
+
+class HistoryDatabase:
+    """
+    图片历史的 SQLite 持久化存储。
+
+    - 按 (用户ID, 会话ID, id) 建立索引，启动时只建表不扫描，按键懒加载；
+    - 写入先进入内存缓冲，由后台任务批量提交，消息处理路径不会等待磁盘；
+      提交时每个键只保留最新的 max_rows_per_key 条，记录不过期时表也不会无限增长；
+    - 所有数据库操作在单独的单线程执行器中串行执行。
+    """
+
+    def __init__(self, db_path: str, max_rows_per_key: int = 5, flush_interval_seconds: float = 1.0, max_batch_size: int = 200):
+        self.db_path = db_path
+        self.max_rows_per_key = max(1, max_rows_per_key)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_batch_size = max_batch_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini_artist_history_db")
+        self._pending: List[Tuple[str, str, int, str, Optional[str], float]] = []
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self.rows_written = 0
+        self.rows_loaded = 0
+        self.write_errors = 0
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def start(self) -> None:
+        """启动后台批量写入任务。数据库连接在首次读写时于执行器线程中建立。"""
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"HistoryDatabase: 图片历史将持久化到 {self.db_path}")
+
+    def add(self, user_id, group_id, is_bot: bool, ref: str, filename: Optional[str]) -> None:
+        """记录一条图片历史，只写入内存缓冲，不阻塞。"""
+        self._pending.append((str(user_id), str(group_id), int(is_bot), ref, filename, time.time()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush_wakeup.set()
+
+    def _write_batch(self, rows) -> None:
+        conn = self._connect()
+        conn.executemany(
+            "INSERT INTO image_history (user_id, group_id, is_bot, ref, filename, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        for user_id, group_id in {(row[0], row[1]) for row in rows}:
+            conn.execute(
+                "DELETE FROM image_history WHERE user_id = ? AND group_id = ? AND id <= ("
+                "SELECT id FROM image_history WHERE user_id = ? AND group_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (user_id, group_id, user_id, group_id, self.max_rows_per_key),
+            )
+        conn.commit()
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await self._call(self._write_batch, rows)
+            self.rows_written += len(rows)
+        except Exception as e:
+            self.write_errors += 1
+            logger.error(f"HistoryDatabase: 批量写入 {len(rows)} 条图片历史失败: {e}", exc_info=True)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), timeout=self.flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            await self.flush()
+
+    def _load_recent(self, user_id: str, group_id: str, limit: int, created_after: float, created_before: float, is_bot: Optional[bool]):
+        sql = ("SELECT ref, filename, created_at FROM image_history "
+               "WHERE user_id = ? AND group_id = ? AND created_at >= ? AND created_at < ?")
+        params: List[Any] = [user_id, group_id, created_after, created_before]
+        if is_bot is not None:
+            sql += " AND is_bot = ?"
+            params.append(int(is_bot))
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        return self._connect().execute(sql, params).fetchall()
+
+    async def load_recent(
+        self,
+        user_id,
+        group_id,
+        limit: int,
+        created_after: float = 0.0,
+        created_before: Optional[float] = None,
+        is_bot: Optional[bool] = None,
+    ) -> List[Tuple[str, Optional[str], float]]:
+        """按键读取最新的 limit 条记录 [(引用, 文件名, 创建时间)]，顺序为从新到旧。"""
+        rows = await self._call(
+            self._load_recent, str(user_id), str(group_id), limit, created_after,
+            time.time() if created_before is None else created_before, is_bot
+        )
+        self.rows_loaded += len(rows)
+        return rows
+
+    def _prune(self, created_before: float) -> int:
+        conn = self._connect()
+        deleted = conn.execute("DELETE FROM image_history WHERE created_at < ?", (created_before,)).rowcount
+        conn.commit()
+        return deleted
+
+    async def prune(self, older_than_seconds: float) -> int:
+        """删除早于 older_than_seconds 的记录，返回删除的条数。"""
+        return await self._call(self._prune, time.time() - older_than_seconds)
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await self._call(self._close)
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "rows_written": self.rows_written,
+            "rows_loaded": self.rows_loaded,
+            "write_errors": self.write_errors,
+        }
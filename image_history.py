@@ -0,0 +1,228 @@
+import os
+import shutil
+import sys
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, List, Optional, Tuple
+
+from astrbot.api import logger
+
+from .image_utils import remove_file_quietly, write_data_url_image
+
+# 每条记录除字符串本身外的估计开销 (对象头、槽位、deque 引用等)
+_ENTRY_OVERHEAD_BYTES = 120
+
+
+def _is_local_ref(ref: str) -> bool:
+    return not ref.startswith(("http://", "https://", "data:"))
+
+
+def _intern(value: Hashable) -> Hashable:
+    """字符串形式的用户/群组ID在大量记录间共享同一对象。"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class HistoryEntry:
+    """一条图片历史记录。ref 为图片 URL、本地路径，或溢出到磁盘后的文件路径。"""
+
+    __slots__ = ("ref", "filename", "created", "size", "spilled")
+
+    def __init__(self, ref: str, filename: Optional[str], size: int, spilled: bool, created: Optional[float] = None):
+        self.ref = ref
+        self.filename = filename
+        self.created = time.monotonic() if created is None else created
+        self.size = size
+        self.spilled = spilled
+
+
+class ImageHistoryStore:
+    """
+    全局图片历史存储，按 (用户ID, 会话ID) 记录最近的图片引用。
+
+    - 每个键最多保留 per_key_limit 条；
+    - 全局总条数与估计内存占用分别受 max_entries、max_bytes 限制，
+      超出时从最久未使用的键开始淘汰最旧的记录；
+    - 记录超过 ttl_seconds 后失效 (0 表示不过期)；
+    - 超过 spill_threshold 字节的 data URL 可先由调用方在线程中通过 spill() 解码写入 spill_dir，
+      再以 spilled=True 添加，内存中只保留文件路径。
+    溢出文件不做持久化 (历史数据库不记录 data URL)，因此启动时清空 spill_dir 不会留下失效的引用。
+    """
+
+    def __init__(
+        self,
+        per_key_limit: int,
+        max_entries: int,
+        max_bytes: int,
+        ttl_seconds: float,
+        spill_dir: str,
+        spill_threshold: int = 8192,
+    ):
+        self.per_key_limit = max(1, per_key_limit)
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self.ttl_seconds = ttl_seconds
+        self.spill_dir = spill_dir
+        self.spill_threshold = spill_threshold
+        # 键按最近使用顺序排列，最久未使用的在前
+        self._histories: "OrderedDict[Tuple[Hashable, Hashable], Deque[HistoryEntry]]" = OrderedDict()
+        self.total_entries = 0
+        self.total_bytes = 0
+        self.spilled_files = 0
+        self.evictions = 0
+        self.expirations = 0
+        # 已从持久化存储加载过的键，数量与总条数上限相同
+        self._loaded_keys: "OrderedDict[Tuple[Hashable, Hashable], None]" = OrderedDict()
+        # 本地文件引用计数，供临时文件清理判断文件是否仍在使用
+        self._local_refs: Dict[str, int] = {}
+        # 溢出文件的索引只在内存中，启动时清理上次遗留的文件
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+    def __len__(self) -> int:
+        return self.total_entries
+
+    def references(self, path: str) -> bool:
+        """本地文件是否仍被某条历史记录引用。"""
+        return path in self._local_refs
+
+    def _track(self, entry: HistoryEntry) -> None:
+        self.total_entries += 1
+        self.total_bytes += entry.size
+        if _is_local_ref(entry.ref):
+            self._local_refs[entry.ref] = self._local_refs.get(entry.ref, 0) + 1
+
+    def needs_load(self, user_id: Hashable, group_id: Hashable) -> bool:
+        """该键是否尚未从持久化存储加载过。"""
+        return (user_id, group_id) not in self._loaded_keys
+
+    def mark_loaded(self, user_id: Hashable, group_id: Hashable) -> None:
+        self._loaded_keys[(_intern(user_id), _intern(group_id))] = None
+        while len(self._loaded_keys) > self.max_entries:
+            self._loaded_keys.popitem(last=False)
+
+    def seed(self, user_id: Hashable, group_id: Hashable, rows: List[Tuple[str, Optional[str], float]]) -> None:
+        """
+        用持久化存储中较早的记录 [(引用, 文件名, 创建时间戳)] (从新到旧) 补充到该键已有记录之前，
+        总数不超过 per_key_limit。已在内存中的引用不会重复添加 (加载标记被淘汰后再次加载时)。
+        """
+        if not rows:
+            return
+        key = (_intern(user_id), _intern(group_id))
+        history = self._histories.get(key)
+        if history is None:
+            history = deque()
+            self._histories[key] = history
+        monotonic_now, wall_now = time.monotonic(), time.time()
+        known_refs = {entry.ref for entry in history}
+        for ref, filename, created_at in rows:
+            if len(history) >= self.per_key_limit:
+                break
+            if ref in known_refs:
+                continue
+            entry = HistoryEntry(ref, filename, len(ref) + len(filename or "") + _ENTRY_OVERHEAD_BYTES, False,
+                                 monotonic_now - max(0.0, wall_now - created_at))
+            history.appendleft(entry)
+            self._track(entry)
+        if not history:
+            del self._histories[key]
+        self._evict()
+
+    def should_spill(self, ref: str) -> bool:
+        return len(ref) > self.spill_threshold and ref.startswith("data:image")
+
+    def spill(self, ref: str) -> Optional[str]:
+        """
+        把 data URL 解码写入 spill_dir，返回文件路径；失败时返回 None，调用方保留原 data URL。
+        阻塞实现，应通过 asyncio.to_thread 调用，避免大图解码阻塞事件循环。
+        """
+        try:
+            return write_data_url_image(ref, self.spill_dir, "history")
+        except Exception as e:
+            logger.warning(f"ImageHistoryStore: data URL 溢出到磁盘失败，保留在内存中: {e}")
+            return None
+
+    def _drop_entry(self, entry: HistoryEntry) -> None:
+        self.total_entries -= 1
+        self.total_bytes -= entry.size
+        if _is_local_ref(entry.ref):
+            remaining = self._local_refs.pop(entry.ref, 1) - 1
+            if remaining > 0:
+                self._local_refs[entry.ref] = remaining
+        if entry.spilled:
+            self.spilled_files -= 1
+            remove_file_quietly(entry.ref)
+
+    def add(self, user_id: Hashable, group_id: Hashable, ref: str, filename: Optional[str] = None, spilled: bool = False) -> int:
+        """添加一条记录，返回该键当前的记录数。spilled 表示 ref 是 spill() 写出的文件，淘汰时一并删除。"""
+        key = (_intern(user_id), _intern(group_id))
+        history = self._histories.get(key)
+        if history is None:
+            history = deque()
+            self._histories[key] = history
+        else:
+            self._histories.move_to_end(key)
+        entry = HistoryEntry(ref, filename, len(ref) + len(filename or "") + _ENTRY_OVERHEAD_BYTES, spilled)
+        if spilled:
+            self.spilled_files += 1
+        history.append(entry)
+        self._track(entry)
+        if len(history) > self.per_key_limit:
+            self._drop_entry(history.popleft())
+        self._evict()
+        return len(self._histories.get(key, ()))
+
+    def _evict(self) -> None:
+        while self._histories and (self.total_entries > self.max_entries or self.total_bytes > self.max_bytes):
+            key, history = next(iter(self._histories.items()))
+            self._drop_entry(history.popleft())
+            self.evictions += 1
+            if not history:
+                del self._histories[key]
+
+    def _expire(self, key: Tuple[Hashable, Hashable], history: Deque[HistoryEntry], now: float) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        while history and now - history[0].created > self.ttl_seconds:
+            self._drop_entry(history.popleft())
+            self.expirations += 1
+        if not history:
+            del self._histories[key]
+
+    def recent(self, user_id: Hashable, group_id: Hashable, count: int) -> List[str]:
+        """返回最新的 count 条图片引用，顺序为从新到旧。"""
+        key = (user_id, group_id)
+        history = self._histories.get(key)
+        if not history or count <= 0:
+            return []
+        self._expire(key, history, time.monotonic())
+        if key not in self._histories:
+            return []
+        self._histories.move_to_end(key)
+        return [entry.ref for entry in list(reversed(history))[:count]]
+
+    def purge_expired(self) -> int:
+        """清理所有过期记录，返回清理的条数。"""
+        before = self.expirations
+        now = time.monotonic()
+        for key, history in list(self._histories.items()):
+            self._expire(key, history, now)
+        return self.expirations - before
+
+    def clear(self) -> None:
+        for history in self._histories.values():
+            while history:
+                self._drop_entry(history.popleft())
+        self._histories.clear()
+        self._loaded_keys.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keys": len(self._histories),
+            "entries": self.total_entries,
+            "max_entries": self.max_entries,
+            "approx_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "spilled_files": self.spilled_files,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
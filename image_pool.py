@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from astrbot.api import logger
+
+
+def _timed_call(func: Callable, args: tuple, kwargs: dict) -> tuple:
+    """在工作线程/进程中执行 func，并返回 (开始执行时间, 结果)，用于统计排队等待时间。"""
+    started_at = time.time()
+    return started_at, func(*args, **kwargs)
+
+
+class ImageWorkerPool:
+    """
+    图片处理工作池，承担 PIL 解码、格式转换、编码等 CPU 密集型工作，避免阻塞事件循环。
+
+    - mode 为 "thread" 时使用线程池；为 "process" 时使用进程池，
+      此时提交的函数必须是模块级函数，参数与返回值必须可 pickle；
+    - 同时未完成的任务数 (执行中 + 排队中) 不超过 max_workers + max_queue，
+      队列已满时提交方等待空位，形成背压；
+    - 统计提交到开始执行之间的等待时间。
+    """
+
+    def __init__(self, mode: str = "thread", max_workers: int = 2, max_queue: int = 32, ewma_alpha: float = 0.2):
+        self.mode = "process" if str(mode).lower() == "process" else "thread"
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.ewma_alpha = ewma_alpha
+        self._executor: Executor = self._create_executor()
+        self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        self.outstanding = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.queue_full_waits = 0
+        self._wait_ewma = 0.0
+        self._wait_max = 0.0
+        logger.info(f"ImageWorkerPool: 已启动图片处理{'进程' if self.mode == 'process' else '线程'}池，工作者 {self.max_workers} 个，队列上限 {self.max_queue}。")
+
+    def _create_executor(self) -> Executor:
+        if self.mode == "process":
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gemini_artist_image")
+
+    def _record_wait(self, wait: float) -> None:
+        wait = max(0.0, wait)
+        self._wait_max = max(self._wait_max, wait)
+        if self.completed + self.failed == 0:
+            self._wait_ewma = wait
+        else:
+            self._wait_ewma = self.ewma_alpha * wait + (1 - self.ewma_alpha) * self._wait_ewma
+
+    async def run(self, func: Callable, *args, discard: Optional[Callable[[Any], None]] = None, **kwargs) -> Any:
+        """
+        在工作池中执行 func(*args, **kwargs) 并返回结果。
+        已开始执行的任务无法中止；若调用方在任务完成前被取消且提供了 discard，
+        任务完成后以其结果调用 discard (例如删除已写入的文件)。
+        """
+        submitted_at = time.time()
+        if self._slots.locked():
+            self.queue_full_waits += 1
+        async with self._slots:
+            self.submitted += 1
+            self.outstanding += 1
+            try:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(
+                    self._executor, functools.partial(_timed_call, func, args, kwargs)
+                )
+                if discard is None:
+                    started_at, result = await future
+                else:
+                    try:
+                        started_at, result = await asyncio.shield(future)
+                    except asyncio.CancelledError:
+                        future.add_done_callback(functools.partial(self._discard_result, discard))
+                        raise
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.outstanding -= 1
+            self._record_wait(started_at - submitted_at)
+            self.completed += 1
+            return result
+
+    @staticmethod
+    def _discard_result(discard: Callable[[Any], None], future: asyncio.Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            discard(future.result()[1])
+        except Exception as e:
+            logger.warning(f"ImageWorkerPool: 清理已取消任务的结果失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "workers": self.max_workers,
+            "outstanding": self.outstanding,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "queue_full_waits": self.queue_full_waits,
+            "avg_wait_ms": round(self._wait_ewma * 1000, 1),
+            "max_wait_ms": round(self._wait_max * 1000, 1),
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,183 @@
+import base64
+import math
+import os
+import random
+import time
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image as PILImage
+
+from astrbot.api import logger
+
+from .retry_policy import InvalidImageDataError
+
+
+def parse_model_image_limits(raw_limits: List[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    解析配置中形如 "模型名:最长边:最大像素数" 的列表。
+    模型名本身可能包含冒号 (例如 OpenRouter 的 ":free" 后缀)，因此从右侧拆分。
+    """
+    limits = {}
+    for item in raw_limits or []:
+        parts = str(item).rsplit(":", 2)
+        if len(parts) != 3:
+            logger.warning(f"无法解析参考图尺寸限制配置 '{item}'，应为 模型名:最长边:最大像素数，已忽略。")
+            continue
+        model, max_side, max_pixels = parts
+        try:
+            limits[model.strip()] = (int(max_side), int(max_pixels))
+        except ValueError:
+            logger.warning(f"无法解析参考图尺寸限制配置 '{item}'，已忽略。")
+    return limits
+
+
+def load_image_file(path: str) -> PILImage.Image:
+    """完整加载本地图片文件并转换为 RGBA 模式。"""
+    image = PILImage.open(path)
+    image.load()
+    return image.convert("RGBA") if image.mode != "RGBA" else image
+
+
+def decode_data_url_image(data_url: str) -> PILImage.Image:
+    """解码 data:image/...;base64 形式的图片并转换为 RGBA 模式。"""
+    _, encoded = data_url.split(",", 1)
+    image = PILImage.open(BytesIO(base64.b64decode(encoded)))
+    return image.convert("RGBA") if image.mode != "RGBA" else image
+
+
+def has_transparency(image: PILImage.Image) -> bool:
+    if image.mode in ("RGBA", "LA"):
+        return image.getchannel("A").getextrema()[0] < 255
+    if image.mode == "P":
+        return "transparency" in image.info
+    return False
+
+
+def downscale_image(image: PILImage.Image, max_side: int, max_pixels: int) -> PILImage.Image:
+    """按最长边与总像素数上限等比缩小图片，未超限时原样返回。"""
+    width, height = image.size
+    scale = 1.0
+    if max_side > 0 and max(width, height) > max_side:
+        scale = min(scale, max_side / max(width, height))
+    if max_pixels > 0 and width * height > max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    if scale >= 1.0:
+        return image
+    new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return image.resize(new_size, PILImage.LANCZOS)
+
+
+def encode_reference_image(
+    image: PILImage.Image,
+    max_side: int,
+    max_pixels: int,
+    alpha_format: str = "PNG",
+    jpeg_quality: int = 90,
+) -> Tuple[bytes, str]:
+    """
+    缩小并重新编码一张参考图，返回 (图片字节, MIME 类型)。
+    不透明图片编码为 JPEG；带透明通道的图片编码为 alpha_format (PNG 或 WEBP)，保留透明度。
+    """
+    original_size = image.size
+    image = downscale_image(image, max_side, max_pixels)
+    buffered = BytesIO()
+    if has_transparency(image):
+        image_format = alpha_format.upper()
+        if image.mode not in ("RGBA", "LA"):
+            image = image.convert("RGBA")
+        if image_format == "WEBP":
+            image.save(buffered, format="WEBP", quality=jpeg_quality, method=4)
+        else:
+            image.save(buffered, format="PNG", optimize=False, compress_level=6)
+    else:
+        image_format = "JPEG"
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(buffered, format="JPEG", quality=jpeg_quality, optimize=True)
+    data = buffered.getvalue()
+    logger.debug(f"参考图预处理: {original_size} -> {image.size}, {image_format}, {len(data)} 字节")
+    return data, f"image/{image_format.lower()}"
+
+
+def encode_reference_images(
+    images: List[PILImage.Image],
+    max_side: int,
+    max_pixels: int,
+    alpha_format: str = "PNG",
+    jpeg_quality: int = 90,
+) -> List[Tuple[bytes, str]]:
+    """批量处理参考图，处理失败的图片会被跳过。"""
+    encoded = []
+    for idx, image in enumerate(images):
+        try:
+            encoded.append(encode_reference_image(image, max_side, max_pixels, alpha_format, jpeg_quality))
+        except Exception as e:
+            logger.error(f"处理参考图片 {idx + 1} 失败: {e}")
+    return encoded
+
+
+# 常见图片格式的文件头，用于在不解码的情况下校验生成结果
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+)
+
+_MIME_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/bmp": "bmp",
+}
+
+
+def sniff_image_extension(data: bytes) -> Optional[str]:
+    """仅根据文件头判断图片格式，返回扩展名；无法识别时返回 None。"""
+    if len(data) >= 12 and data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    for signature, ext in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    return None
+
+
+def remove_file_quietly(path: Optional[str]) -> None:
+    """删除文件，忽略文件不存在等错误。"""
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_image_bytes(data: bytes, temp_dir: str, prefix: str, mime_type: Optional[str] = None) -> str:
+    """
+    将 API 返回的图片原始字节直接写入临时文件，不做解码与重新编码。
+    扩展名取自 MIME 类型；若与文件头不符则以文件头为准，文件头无法识别时抛出 InvalidImageDataError。
+    """
+    sniffed_ext = sniff_image_extension(data)
+    if sniffed_ext is None:
+        raise InvalidImageDataError(f"返回的数据不是可识别的图片 (MIME: {mime_type}, {len(data)} 字节)")
+    ext = _MIME_EXTENSIONS.get((mime_type or "").split(";")[0].strip().lower())
+    if ext != sniffed_ext:
+        if ext:
+            logger.debug(f"图片 MIME 类型 {mime_type} 与文件头 ({sniffed_ext}) 不符，按文件头保存。")
+        ext = sniffed_ext
+    os.makedirs(temp_dir, exist_ok=True)
+    temp_fp = os.path.join(temp_dir, f"{prefix}_{time.time()}_{random.randint(100,999)}.{ext}")
+    with open(temp_fp, "wb") as f:
+        f.write(data)
+    return temp_fp
+
+
+def write_data_url_image(data_url: str, temp_dir: str, prefix: str) -> str:
+    """解码 data:image/...;base64 形式的图片并写入临时文件。"""
+    header, encoded = data_url.split(",", 1)
+    mime_type = header[len("data:"):].split(";")[0]
+    return write_image_bytes(base64.b64decode(encoded), temp_dir, prefix, mime_type)
@@ -0,0 +1,63 @@
+from typing import FrozenSet, List, Optional, Tuple
+
+from astrbot.api.event import AstrMessageEvent
+from astrbot.api.message_components import Image
+
+
+class IngressMessage:
+    """
+    对一条消息只做一次的规范化结果：发送者、会话上下文 (群号，私聊为用户ID) 与消息中的图片。
+    """
+
+    __slots__ = ("user_id", "context_id", "is_group", "image_refs")
+
+    def __init__(self, user_id: str, context_id: str, is_group: bool, image_refs: List[Tuple[str, Optional[str]]]):
+        self.user_id = user_id
+        self.context_id = context_id
+        self.is_group = is_group
+        # [(图片URL, 原始文件名)]
+        self.image_refs = image_refs
+
+    @property
+    def session_key(self) -> Tuple[str, str]:
+        return self.user_id, str(self.context_id)
+
+
+class IngressFilter:
+    """
+    消息入口过滤：白名单与机器人ID在初始化时预先转换为集合/字符串，
+    每条消息只需一次集合查询即可判定是否处理。
+    """
+
+    def __init__(self, group_whitelist: Optional[List] = None, robot_id: Optional[str] = None):
+        self.whitelist: FrozenSet[str] = frozenset(str(item) for item in group_whitelist or [])
+        self.robot_id = str(robot_id) if robot_id else None
+
+    def allows(self, context_id) -> bool:
+        """白名单为空时放行所有会话。"""
+        return not self.whitelist or str(context_id) in self.whitelist
+
+    def is_robot(self, user_id) -> bool:
+        return self.robot_id is not None and str(user_id) == self.robot_id
+
+    def normalize(self, event: AstrMessageEvent) -> Optional[IngressMessage]:
+        """
+        规范化消息；机器人自身消息、白名单外的消息或缺少 message_obj 的事件返回 None。
+        """
+        message_obj = getattr(event, "message_obj", None)
+        if message_obj is None or not hasattr(message_obj, "type"):
+            return None
+        user_id = event.get_sender_id()
+        if self.is_robot(user_id):
+            return None
+        group_id = getattr(message_obj, "group_id", None)
+        is_group = group_id is not None and group_id != ""
+        context_id = group_id if is_group else user_id
+        if not self.allows(context_id):
+            return None
+        image_refs = [
+            (component.url, getattr(component, "file", None))
+            for component in event.get_messages()
+            if isinstance(component, Image) and getattr(component, "url", None)
+        ]
+        return IngressMessage(user_id, context_id, is_group, image_refs)
@@ -0,0 +1,232 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import openai
+
+from astrbot.api import logger
+
+
+# 错误分类
+ERROR_RATE_LIMIT = "rate_limit"
+ERROR_SERVER = "server"
+ERROR_AUTH = "auth"
+ERROR_NETWORK = "network"
+ERROR_CLIENT = "client"
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头，支持秒数和 HTTP 日期两种格式。"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def classify_api_error(error: BaseException) -> Tuple[str, Optional[float]]:
+    """
+    将 SDK 抛出的异常归类，并尽量从响应头中取出 Retry-After 秒数。
+    兼容 openai.APIStatusError (status_code) 与 google.genai.errors.APIError (code)。
+    """
+    status = getattr(error, "status_code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "code", None)
+    retry_after = None
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            retry_after = _parse_retry_after(headers.get("retry-after"))
+        except Exception:
+            retry_after = None
+
+    if isinstance(status, int):
+        if status == 429:
+            return ERROR_RATE_LIMIT, retry_after
+        if status in (401, 403):
+            return ERROR_AUTH, retry_after
+        if status >= 500:
+            return ERROR_SERVER, retry_after
+        if status >= 400:
+            return ERROR_CLIENT, retry_after
+    if "RESOURCE_EXHAUSTED" in str(error):
+        return ERROR_RATE_LIMIT, retry_after
+    if isinstance(error, (httpx.TransportError, openai.APIConnectionError, asyncio.TimeoutError, TimeoutError)):
+        return ERROR_NETWORK, retry_after
+    return ERROR_CLIENT, retry_after
+
+
+class KeyHealth:
+    """单个 API Key 的健康状态。"""
+
+    __slots__ = (
+        "successes", "failures", "consecutive_failures", "consecutive_rate_limits",
+        "success_ewma", "latency_ewma", "cooldown_until", "circuit_open_until", "circuit_open_count",
+    )
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.consecutive_rate_limits = 0
+        # 近期成功率 (EWMA)，未使用过的 Key 视为完全健康
+        self.success_ewma = 1.0
+        self.latency_ewma: Optional[float] = None
+        self.cooldown_until = 0.0
+        self.circuit_open_until = 0.0
+        self.circuit_open_count = 0
+
+    def available_at(self) -> float:
+        return max(self.cooldown_until, self.circuit_open_until)
+
+
+class ApiKeyScheduler:
+    """
+    基于健康度的 API Key 调度器。
+
+    - 记录每个 Key 的近期成功率与延迟 (EWMA)；
+    - 429 限流时按 Retry-After 或指数退避进入冷却期；
+    - 连续失败达到阈值时熔断一段时间，到期后放行探测请求，再次失败则熔断时长翻倍；
+    - 健康且速度相近的 Key 之间保持原有的轮询/随机顺序以分摊负载。
+    """
+
+    # 得分不低于最佳得分该比例的 Key 视为同一梯队
+    PREFERRED_TIER_RATIO = 0.8
+    MAX_COOLDOWN_SECONDS = 600.0
+
+    def __init__(
+        self,
+        num_keys: int,
+        random_selection: bool = False,
+        failure_threshold: int = 3,
+        circuit_open_seconds: float = 60.0,
+        rate_limit_cooldown_seconds: float = 30.0,
+        ewma_alpha: float = 0.3,
+    ):
+        self.num_keys = num_keys
+        self.random_selection = random_selection
+        self.failure_threshold = max(1, failure_threshold)
+        self.circuit_open_seconds = circuit_open_seconds
+        self.rate_limit_cooldown_seconds = rate_limit_cooldown_seconds
+        self.ewma_alpha = ewma_alpha
+        self.next_index = 0
+        self.health: List[KeyHealth] = [KeyHealth() for _ in range(num_keys)]
+
+    def _rotation(self) -> List[int]:
+        indices = list(range(self.num_keys))
+        if self.random_selection:
+            random.shuffle(indices)
+            return indices
+        return [(self.next_index + i) % self.num_keys for i in indices]
+
+    def _score(self, idx: int, default_latency: float) -> float:
+        health = self.health[idx]
+        latency = health.latency_ewma if health.latency_ewma is not None else default_latency
+        return health.success_ewma / max(latency, 0.001)
+
+    def order(self, spread: int = 0) -> List[int]:
+        """
+        返回本次请求应依次尝试的 Key 索引。
+        冷却或熔断中的 Key 会被跳过；若全部不可用，则只返回最早恢复的那个。
+        spread 将首选梯队轮转若干位，使同时发起的多个请求 (如多个变体) 从不同的 Key 开始。
+        """
+        if self.num_keys == 0:
+            return []
+        now = time.monotonic()
+        rotation = self._rotation()
+        available = [idx for idx in rotation if self.health[idx].available_at() <= now]
+        if not available:
+            earliest = min(rotation, key=lambda idx: self.health[idx].available_at())
+            logger.warning(f"ApiKeyScheduler: 所有API密钥均处于冷却或熔断中，尝试最早恢复的密钥索引 {earliest}。")
+            return [earliest]
+
+        known_latencies = [self.health[idx].latency_ewma for idx in available if self.health[idx].latency_ewma is not None]
+        default_latency = sum(known_latencies) / len(known_latencies) if known_latencies else 1.0
+        scores = {idx: self._score(idx, default_latency) for idx in available}
+        best_score = max(scores.values())
+        preferred = [idx for idx in available if scores[idx] >= best_score * self.PREFERRED_TIER_RATIO]
+        if spread:
+            shift = spread % len(preferred)
+            preferred = preferred[shift:] + preferred[:shift]
+        rest = sorted((idx for idx in available if idx not in preferred), key=lambda idx: scores[idx], reverse=True)
+        return preferred + rest
+
+    def _update_success(self, health: KeyHealth, succeeded: bool) -> None:
+        health.success_ewma = self.ewma_alpha * (1.0 if succeeded else 0.0) + (1 - self.ewma_alpha) * health.success_ewma
+
+    def _update_latency(self, health: KeyHealth, latency: float) -> None:
+        if health.latency_ewma is None:
+            health.latency_ewma = latency
+        else:
+            health.latency_ewma = self.ewma_alpha * latency + (1 - self.ewma_alpha) * health.latency_ewma
+
+    def record_success(self, idx: int, latency: float) -> None:
+        health = self.health[idx]
+        health.successes += 1
+        health.consecutive_failures = 0
+        health.consecutive_rate_limits = 0
+        health.circuit_open_count = 0
+        health.circuit_open_until = 0.0
+        self._update_success(health, True)
+        self._update_latency(health, latency)
+        if not self.random_selection:
+            self.next_index = (idx + 1) % self.num_keys
+
+    def record_failure(self, idx: int, latency: float, error: BaseException) -> str:
+        """记录一次失败并返回错误类别。参数错误等与 Key 无关的失败不会影响其健康度。"""
+        health = self.health[idx]
+        kind, retry_after = classify_api_error(error)
+        now = time.monotonic()
+        if kind == ERROR_CLIENT:
+            return kind
+
+        health.failures += 1
+        self._update_success(health, False)
+        if kind == ERROR_RATE_LIMIT:
+            health.consecutive_rate_limits += 1
+            cooldown = retry_after
+            if cooldown is None:
+                cooldown = self.rate_limit_cooldown_seconds * (2 ** (health.consecutive_rate_limits - 1))
+            cooldown = min(cooldown, self.MAX_COOLDOWN_SECONDS)
+            health.cooldown_until = now + cooldown
+            logger.warning(f"ApiKeyScheduler: 密钥索引 {idx} 被限流，冷却 {cooldown:.1f} 秒。")
+            return kind
+
+        self._update_latency(health, latency)
+        health.consecutive_failures += 1
+        if kind == ERROR_AUTH or health.consecutive_failures >= self.failure_threshold:
+            health.circuit_open_count += 1
+            open_seconds = min(
+                self.circuit_open_seconds * (2 ** (health.circuit_open_count - 1)),
+                self.MAX_COOLDOWN_SECONDS,
+            )
+            if retry_after is not None:
+                open_seconds = max(open_seconds, min(retry_after, self.MAX_COOLDOWN_SECONDS))
+            health.circuit_open_until = now + open_seconds
+            logger.warning(f"ApiKeyScheduler: 密钥索引 {idx} 连续失败 {health.consecutive_failures} 次 ({kind})，熔断 {open_seconds:.1f} 秒。")
+        return kind
+
+    def snapshot(self) -> List[Dict]:
+        now = time.monotonic()
+        return [
+            {
+                "index": idx,
+                "successes": health.successes,
+                "failures": health.failures,
+                "success_ewma": round(health.success_ewma, 3),
+                "latency_ewma": round(health.latency_ewma, 3) if health.latency_ewma is not None else None,
+                "cooldown_remaining": round(max(0.0, health.cooldown_until - now), 1),
+                "circuit_open_remaining": round(max(0.0, health.circuit_open_until - now), 1),
+            }
+            for idx, health in enumerate(self.health)
+        ]
@@ -1,25 +1,50 @@
-from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
+from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult, MessageChain
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 from astrbot.api.all import *
-from astrbot.api.message_components import Node, Plain, Image, Nodes, Reply, BaseMessageComponent
+from astrbot.api.message_components import Node, Plain, Image, Nodes, Reply, File, BaseMessageComponent
 import asyncio
-from io import BytesIO
 import time
 import os
 import random
 from google import genai
 from PIL import Image as PILImage
-from google.genai.types import HttpOptions
 from astrbot.core.utils.io import download_file
 import functools
+from contextlib import contextmanager
 from typing import List, Optional, Dict, Tuple, AsyncGenerator, Any
-from openai import OpenAI
 from collections import deque
 import base64
 import json
 from pathlib import Path
 import re
+import inspect
+import math
+from .download_cache import DownloadCache
+from .history_db import HistoryDatabase
+from .image_history import ImageHistoryStore
+from .ingress import IngressFilter, IngressMessage
+from .api_clients import ApiClientPool
+from .key_scheduler import ApiKeyScheduler
+from .hedging import HedgePolicy
+from .deadline import RequestDeadline, RequestTimeoutError
+from .temp_storage import TempStorage
+from .retry_policy import GenerationContentError, InvalidImageDataError, NoImageError, RetryPolicy, SafetyBlockedError, classify_retry_error
+from .admission import AdmissionController, AdmissionTicket
+from .generation_cache import ResultCache, SingleFlight, generation_cache_key, image_digests
+from .image_pool import ImageWorkerPool
+from .metrics import ArtistMetrics, MetricsServer
+from .tracing import Tracer, current_trace, record_event, record_span, span, trace_tag
+from .batch_jobs import BatchJob, BatchJobRunner, BatchJobStore, ITEM_DONE, ITEM_FAILED, ITEM_PENDING, ITEM_RUNNING, JOB_CANCELLED, JOB_DONE, JOB_RUNNING
+from .image_utils import (
+    decode_data_url_image,
+    encode_reference_images,
+    load_image_file,
+    parse_model_image_limits,
+    remove_file_quietly,
+    write_data_url_image,
+    write_image_bytes,
+)
 
 
 
@@ -37,33 +62,141 @@ class GeminiArtist(Star):
         self.model_name_from_config = config.get("model", "gemini-2.0-flash-exp")
         self.group_whitelist = config.get("group_whitelist", [])
         self.robot_id_from_config = config.get("robot_self_id") 
+        # 白名单与机器人ID预先转换为集合/字符串，消息入口只需一次查询
+        self.ingress_filter = IngressFilter(self.group_whitelist, self.robot_id_from_config)
         self.random_api_key_selection = config.get("random_api_key_selection", False)
         self.enable_base_reference_image = config.get("enable_base_reference_image", False)
         self.base_reference_image_path = config.get("base_reference_image_path", "")
         # 存储正在等待输入的用户，键为 (user_id, group_id)
         self.waiting_users = {}  # {(user_id, group_id): expiry_time}
         # 存储用户收集到的文本和图片，键为 (user_id, group_id)
-        self.user_inputs = {} # {(user_id, group_id): {'messages': [{'text': '', 'images': [], 'timestamp': float}]}}
+        # 会话中只保存图片引用 (URL / 路径)，收到开始指令后才并发下载解码
+        self.user_inputs = {} # {(user_id, group_id): {'messages': [{'text': '', 'images': [image_ref], 'timestamp': float}], 'bytes': int}}
         self.wait_time_from_config = config.get("wait_time", 30)
+        # 单个 /draw 会话保存的文本与图片引用的字节上限
+        self.draw_session_max_bytes = max(1, int(self.config.get("draw_session_max_kb", 1024))) * 1024
 
-        # 存储用户发送的图片URL缓存
-        self.image_history_cache: Dict[Tuple[str, str], deque[Tuple[str, Optional[str]]]] = {}
+        # 每个 (用户, 会话) 保留的图片URL数量，全局存储在临时目录创建后初始化
         self.max_cached_images = self.config.get("max_cached_images", 5)
+        # 并发下载参考图片的数量上限
+        self.reference_fetch_concurrency = max(1, int(self.config.get("reference_fetch_concurrency", 4)))
 
-        # 设置插件的临时文件目录
-        shared_data_path = Path(__file__).resolve().parent.parent.parent
+        # 设置插件的临时文件目录；data_dir 可把临时文件与持久化数据整体移到其他目录 (默认为 AstrBot 的 data 目录)
+        shared_data_path = self.config.get("data_dir") or Path(__file__).resolve().parent.parent.parent
         self.plugin_temp_base_dir = os.path.join(shared_data_path, "gemini_artist_temp")
         os.makedirs(self.plugin_temp_base_dir, exist_ok=True)
         self.temp_dir = self.plugin_temp_base_dir
 
+        # 以内容哈希寻址的下载缓存，0 表示禁用
+        self.download_cache_max_mb = self.config.get("download_cache_max_mb", 256)
+        self.download_cache: Optional[DownloadCache] = None
+        if self.download_cache_max_mb > 0:
+            self.download_cache = DownloadCache(
+                os.path.join(self.plugin_temp_base_dir, "download_cache"),
+                self.download_cache_max_mb * 1024 * 1024
+            )
+
+        # 存储用户发送的图片URL缓存：全局条数、内存与有效期均有上限，大的 data URL 溢出到磁盘
+        self.image_history_cache = ImageHistoryStore(
+            per_key_limit=self.max_cached_images,
+            max_entries=self.config.get("image_history_max_entries", 2000),
+            max_bytes=self.config.get("image_history_max_mb", 16) * 1024 * 1024,
+            ttl_seconds=self.config.get("image_history_ttl_seconds", 86400 * 3),
+            spill_dir=os.path.join(self.plugin_temp_base_dir, "history_spill"),
+        )
+        # 可选的图片历史持久化 (SQLite)，重启后按需懒加载
+        self.history_db: Optional[HistoryDatabase] = None
+        self._history_started_at = time.time()
+        # 正在从数据库加载的键 -> 加载任务
+        self._history_loads: Dict[Tuple[str, str], asyncio.Future] = {}
+        if self.config.get("persist_image_history", False):
+            self.history_db = HistoryDatabase(os.path.join(shared_data_path, "gemini_artist_data", "image_history.db"), self.max_cached_images)
+            self.history_db.start()
+
         self.enable_hinting = self.config.get("enable_hinting", True)
+        # 单个绘图请求的端到端截止时间，0 表示不限制
+        self.request_timeout_seconds = self.config.get("request_timeout_seconds", 300)
+        # 流式生成：图片与文字段落一生成就立即发送 (仅 Google API)
+        self.enable_streaming = self.config.get("enable_streaming", False)
+
+        # 参考图上传前的缩放与重新编码限制，可按模型单独配置
+        self.reference_image_max_side = self.config.get("reference_image_max_side", 2048)
+        self.reference_image_max_pixels = self.config.get("reference_image_max_pixels", 4194304)
+        self.reference_image_jpeg_quality = self.config.get("reference_image_jpeg_quality", 90)
+        self.reference_image_model_limits = parse_model_image_limits(self.config.get("reference_image_model_limits", []))
 
         self.api_keys = [
             key.strip()
             for key in api_key_list_from_config
             if isinstance(key, str) and key.strip()
         ]
-        self.current_api_key_index = 0
+        # 基于健康度的 API Key 调度器，取代原先的随机/轮询选择
+        self.key_scheduler = ApiKeyScheduler(
+            len(self.api_keys),
+            random_selection=self.random_api_key_selection,
+            failure_threshold=self.config.get("key_failure_threshold", 3),
+            circuit_open_seconds=self.config.get("key_circuit_open_seconds", 60),
+            rate_limit_cooldown_seconds=self.config.get("key_rate_limit_cooldown_seconds", 30),
+        )
+        # 对冲请求：首个请求超过分位数延迟仍未完成时，在另一个 Key 上并行发起第二个请求
+        self.hedge_policy: Optional[HedgePolicy] = None
+        if self.config.get("enable_hedged_requests", False):
+            self.hedge_policy = HedgePolicy(
+                percentile=self.config.get("hedge_delay_percentile", 95),
+                budget_ratio=self.config.get("hedge_budget_ratio", 0.1),
+                fallback_delay_seconds=self.config.get("hedge_fallback_delay_seconds", 30),
+            )
+        # 全局准入控制：限制同时进行的生成数量，并在各群组之间公平排队
+        self.admission = AdmissionController(
+            self.config.get("max_concurrent_generations", 4),
+            AdmissionController.parse_group_weights(self.config.get("admission_group_weights", [])),
+        )
+        # 多变体生成：单次调用最多生成的变体数，以及同一请求同时进行的上游调用数
+        self.max_variants = max(1, int(self.config.get("max_variants", 4)))
+        self.variant_concurrency = max(1, int(self.config.get("variant_concurrency", 2)))
+        # 请求合并：相同后端、模型、提示词与参考图的并发请求共享一次上游调用
+        self.request_coalescer: Optional[SingleFlight] = SingleFlight() if self.config.get("enable_request_coalescing", False) else None
+        # 生成结果缓存：有效期内相同的请求直接返回之前生成的图片，0 表示禁用
+        self.result_cache: Optional[ResultCache] = None
+        self.result_cache_groups = {str(group) for group in self.config.get("result_cache_groups", [])}
+        result_cache_ttl = self.config.get("result_cache_ttl_seconds", 0)
+        # 仅对 result_cache_groups 中列出的会话启用，列表为空时不启用
+        if result_cache_ttl > 0 and self.result_cache_groups:
+            self.result_cache = ResultCache(
+                os.path.join(self.plugin_temp_base_dir, "result_cache"),
+                # 命中时的副本与其他临时文件一样写入分片目录 (temp_storage 在下文创建)
+                lambda: self.temp_storage.shard_dir(),
+                result_cache_ttl,
+                max(1, int(self.config.get("result_cache_max_mb", 256))) * 1024 * 1024,
+            )
+        # 图片解码、转换与编码等 CPU 密集型工作交给独立的工作池，避免阻塞事件循环
+        self.image_pool = ImageWorkerPool(
+            mode=self.config.get("image_worker_mode", "thread"),
+            max_workers=self.config.get("image_worker_count", 2),
+            max_queue=self.config.get("image_worker_queue_size", 32),
+        )
+        # 统一重试策略：指数退避 + 全抖动，各错误类别独立计数，整个请求共用截止时间
+        self.retry_policy = RetryPolicy(
+            base_delay_seconds=self.config.get("retry_base_delay_seconds", 1),
+            max_delay_seconds=self.config.get("retry_max_delay_seconds", 30),
+            deadline_seconds=self.config.get("retry_deadline_seconds", 240),
+            budgets=RetryPolicy.parse_budgets(self.config.get("retry_budgets", [])),
+        )
+        # 每个 API Key 一个长期复用的异步客户端，共享连接池
+        self.api_client_pool = ApiClientPool(max_connections=self.config.get("api_max_connections", 32))
+        # 批量生成任务：所有任务共享并发与速率上限 (并发默认等于API密钥数)，进度写入检查点，重启后继续执行
+        self.batch_max_prompts = max(1, int(self.config.get("batch_max_prompts", 100)))
+        self.batch_delivery = self.config.get("batch_delivery", "nodes")
+        self.batch_nodes_size = max(1, int(self.config.get("batch_nodes_size", 10)))
+        self.batch_runner = BatchJobRunner(
+            int(self.config.get("batch_concurrency", 0) or 0) or len(self.api_keys),
+            float(self.config.get("batch_rate_per_minute", 0) or 0),
+        )
+        self.batch_store = BatchJobStore(os.path.join(shared_data_path, "gemini_artist_data", "batch_jobs"))
+        self.batch_jobs: Dict[str, BatchJob] = {}
+        self._batch_tasks: Dict[str, asyncio.Task] = {}
+        self._batch_delivery_locks: Dict[str, asyncio.Lock] = {}
+        self._batch_save_locks: Dict[str, asyncio.Lock] = {}
 
         if not self.api_keys:
             logger.warning("Gemini API密钥未配置或配置为空。插件可能无法正常工作。")
@@ -72,6 +205,38 @@ class GeminiArtist(Star):
         self.cleanup_interval_seconds = self.config.get("temp_cleanup_interval_seconds", 3600 * 6)
         self.cleanup_older_than_seconds = self.config.get("temp_cleanup_files_older_than_seconds", 86400 * 3)
         self._background_cleanup_task = None
+        # 临时文件清单：分片存放，按年龄与总大小配额淘汰，跳过仍被图片历史引用的文件
+        self.temp_storage = TempStorage(
+            self.plugin_temp_base_dir,
+            max_bytes=max(0, int(self.config.get("temp_max_mb", 1024))) * 1024 * 1024,
+            max_age_seconds=self.cleanup_older_than_seconds,
+            is_referenced=self.image_history_cache.references,
+        )
+        # 启动时扫描一次现有文件，之后的清理只处理清单
+        self._temp_rebuild_task = asyncio.create_task(asyncio.to_thread(self.temp_storage.rebuild))
+
+        # 各阶段耗时、上游调用与并发状态指标；配置端口后以 Prometheus 文本格式发布在本地
+        self.metrics = ArtistMetrics()
+        self.metrics.add_state_gauges({
+            "gemini_artist_in_flight": ("正在进行的生成数", lambda: self.admission.stats()["in_flight"]),
+            "gemini_artist_queued": ("排队等待的生成数", lambda: self.admission.stats()["queued"]),
+            "gemini_artist_image_pool_outstanding": ("图片工作池未完成的任务数", lambda: self.image_pool.outstanding),
+            "gemini_artist_draw_sessions": ("进行中的 /draw 会话数", lambda: len(self.waiting_users)),
+            "gemini_artist_history_entries": ("图片历史记录数", lambda: len(self.image_history_cache)),
+            "gemini_artist_temp_bytes": ("临时文件总字节数", lambda: self.temp_storage.stats()["bytes"]),
+            "gemini_artist_batch_jobs": ("进行中的批量任务数", lambda: len(self._batch_tasks)),
+        })
+        self.metrics_server: Optional[MetricsServer] = None
+        # 每次调用的追踪记录；超过阈值的慢请求以 JSON 写入 gemini_artist_data/slow_requests.jsonl
+        self.tracer = Tracer(
+            float(self.config.get("slow_request_threshold_seconds", 60) or 0),
+            os.path.join(shared_data_path, "gemini_artist_data", "slow_requests.jsonl"),
+            enable_otel=self.config.get("enable_otel_export", False),
+        )
+        metrics_port = int(self.config.get("metrics_port", 0) or 0)
+        if metrics_port > 0:
+            self.metrics_server = MetricsServer(self.metrics, self.config.get("metrics_host", "127.0.0.1"), metrics_port)
+            asyncio.create_task(self._start_metrics_server())
 
         # 启动后台定时清理任务
         if self.cleanup_interval_seconds > 0:
@@ -80,30 +245,10 @@ class GeminiArtist(Star):
         else:
             logger.info("GeminiArtist: 定时清理功能已禁用 (temp_cleanup_interval_seconds <= 0)。")
 
-    def _blocking_cleanup_temp_dir_logic(self, older_than_seconds: int) -> Tuple[int, int]:
-        """
-        同步执行临时目录清理的逻辑，移除旧文件。
-        """
-        if not os.path.isdir(self.temp_dir):
-            return 0, 0
-        now, cleaned_count, error_count = time.time(), 0, 0
-        try:
-            for filename in os.listdir(self.temp_dir):
-                file_path = os.path.join(self.temp_dir, filename)
-                try:
-                    if os.path.isfile(file_path) or os.path.islink(file_path):
-                        if (now - os.path.getmtime(file_path)) > older_than_seconds:
-                            os.remove(file_path)
-                            cleaned_count += 1
-                except Exception as e_file:
-                    logger.error(f"清理临时文件 {file_path} 时出错: {e_file}")
-                    error_count += 1
-        except Exception as e_list:
-            logger.error(f"列出目录 {self.temp_dir} 进行清理时出错: {e_list}")
-            error_count += 1
-        if cleaned_count > 0 or error_count > 0:
-            logger.info(f"临时目录清理: 移除 {cleaned_count} 文件, 发生 {error_count} 错误 @ {self.temp_dir}")
-        return cleaned_count, error_count
+        # 及时清理超时的 /draw 会话，而不是等用户再次发言
+        self._draw_session_sweeper_task = asyncio.create_task(self._sweep_draw_sessions())
+        # 继续执行重启前未完成的批量任务
+        self._batch_resume_task = asyncio.create_task(self._resume_batch_jobs())
 
     async def _periodic_temp_dir_cleanup(self):
         """
@@ -113,28 +258,104 @@ class GeminiArtist(Star):
             await asyncio.sleep(self.cleanup_interval_seconds)
             logger.info(f"定时清理触发: {self.temp_dir}")
             try:
-                cleanup_func = functools.partial(self._blocking_cleanup_temp_dir_logic, self.cleanup_older_than_seconds)
-                await asyncio.to_thread(cleanup_func)
+                await asyncio.to_thread(self.temp_storage.evict)
+                logger.info(f"临时文件统计: {self.temp_storage.stats()}")
+                expired_count = self.image_history_cache.purge_expired()
+                logger.info(f"图片历史缓存统计: {self.image_history_cache.stats()} (本次清理过期 {expired_count} 条)")
+                if self.history_db:
+                    if self.image_history_cache.ttl_seconds > 0:
+                        await self.history_db.prune(self.image_history_cache.ttl_seconds)
+                    logger.info(f"图片历史数据库统计: {self.history_db.stats()}")
+                if self.download_cache:
+                    logger.info(f"下载缓存统计: {self.download_cache.stats()}")
+                logger.info(f"API密钥健康状态: {self.key_scheduler.snapshot()}")
+                if self.hedge_policy:
+                    logger.info(f"对冲请求统计: {self.hedge_policy.stats()}")
+                logger.info(f"生成准入统计: {self.admission.stats()}")
+                logger.info(f"重试统计: {self.retry_policy.stats()}")
+                logger.info(f"图片工作池统计: {self.image_pool.stats()}")
+                if self.request_coalescer:
+                    logger.info(f"请求合并统计: {self.request_coalescer.stats()}")
+                if self.result_cache:
+                    logger.info(f"生成结果缓存统计: {self.result_cache.stats()}")
+                await self._prune_batch_jobs()
             except asyncio.CancelledError:
                 logger.info("定时清理任务已取消。")
                 break
             except Exception as e:
                 logger.error(f"定时清理任务出错: {e}", exc_info=True)
 
-    def store_user_image(self, user_id: str, group_id: str, image_url: str, original_filename: Optional[str] = None) -> None:
+    @contextmanager
+    def _stage(self, name: str, **attrs):
+        """同时记入阶段耗时指标与当前追踪的跨度，产出跨度 (不在追踪中时为 None) 以便补充属性。"""
+        with self.metrics.stage(name), span(name, **attrs) as trace_span:
+            yield trace_span
+
+    def _observe_stage(self, name: str, started: float, **attrs) -> None:
+        """记录从 started (time.monotonic()) 到现在的阶段耗时。"""
+        seconds = time.monotonic() - started
+        self.metrics.observe_stage(name, seconds)
+        record_span(name, started, seconds, **attrs)
+
+    def _finish_trace(self) -> None:
+        """结束当前上下文中的追踪 (若已开始)，结果取生成阶段的结果。"""
+        trace = current_trace()
+        if trace is not None:
+            self.tracer.finish(trace, trace.result or "no_generation")
+
+    async def _start_metrics_server(self) -> None:
+        try:
+            await self.metrics_server.start()
+        except Exception as e:
+            logger.error(f"启动指标服务失败 (端口 {self.metrics_server.port}): {e}", exc_info=True)
+
+    def _end_draw_session(self, session_key: Tuple[str, str]) -> None:
+        self.waiting_users.pop(session_key, None)
+        self.user_inputs.pop(session_key, None)
+
+    async def _sweep_draw_sessions(self):
+        """
+        周期性移除已超时的 /draw 会话。
         """
-        将用户发送的图片URL存储到缓存中。
+        interval = max(1.0, min(5.0, self.wait_time_from_config / 2))
+        while True:
+            await asyncio.sleep(interval)
+            if not self.waiting_users:
+                continue
+            now = time.time()
+            expired_keys = [key for key, expiry_time in self.waiting_users.items() if now > expiry_time]
+            for key in expired_keys:
+                self._end_draw_session(key)
+            if expired_keys:
+                logger.debug(f"已清理 {len(expired_keys)} 个超时的 /draw 会话。")
+
+    def store_user_image(self, user_id: str, group_id: str, image_url: str, original_filename: Optional[str] = None, is_bot: bool = False, spill_path: Optional[str] = None) -> None:
         """
-        key = (user_id, group_id)
-        if key not in self.image_history_cache:
-            self.image_history_cache[key] = deque(maxlen=self.max_cached_images)
-        self.image_history_cache[key].append((image_url, original_filename))
-        logger.debug(f"已存储用户 {user_id} group_id {group_id} 图片URL: {image_url} (缓存 {len(self.image_history_cache[key])}/{self.max_cached_images})")
+        将用户发送的图片URL (或机器人生成图片的本地路径，is_bot=True) 存储到缓存中。
+        spill_path 为大的 data URL 已溢出到磁盘的文件路径，缓存中以它代替 data URL。
+        """
+        cached_count = self.image_history_cache.add(user_id, group_id, spill_path or image_url, original_filename, spilled=spill_path is not None)
+        # data URL 体积大且溢出文件不跨重启保留，不做持久化
+        if self.history_db and not image_url.startswith("data:"):
+            self.history_db.add(user_id, group_id, is_bot, image_url, original_filename)
+        logger.debug(f"已存储用户 {user_id} group_id {group_id} 图片URL: {image_url[:100]} (缓存 {cached_count}/{self.max_cached_images})")
 
     async def download_pil_image_from_url(self, image_url: str, context_description: str = "图片") -> Optional[PILImage.Image]:
         """
         从给定的URL下载图片并返回PIL Image对象。
         """
+        # 优先命中下载缓存，跳过网络下载与写盘
+        if self.download_cache:
+            cached_path = await asyncio.to_thread(self.download_cache.lookup, image_url)
+            if cached_path:
+                try:
+                    with self._stage("image_decode"):
+                        img_pil = await self.image_pool.run(load_image_file, cached_path)
+                    logger.info(f"下载缓存命中 {context_description} URL: {image_url} (本地文件: {cached_path})")
+                    return img_pil
+                except Exception as e_cached:
+                    logger.warning(f"加载下载缓存文件 {cached_path} 失败，改为重新下载: {e_cached}")
+
         logger.info(f"尝试使用 astrbot.core.utils.io.download_file 下载 {context_description} URL: {image_url}")
 
         # 尝试从URL中获取文件扩展名
@@ -154,20 +375,34 @@ class GeminiArtist(Star):
             logger.debug(f"从URL {image_url} 获取扩展名时出错: {e_ext}，使用默认扩展名 {ext}")
 
         filename = f"gemini_artist_temp_{time.time()}_{random.randint(1000,9999)}{ext}"
-        target_file_path = os.path.join(self.temp_dir, filename)
+        target_file_path = os.path.join(self.temp_storage.shard_dir(), filename)
 
-        os.makedirs(self.temp_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
 
         try:
-            await download_file(url=image_url, path=target_file_path, show_progress=False)
+            with self._stage("reference_download") as trace_span:
+                await download_file(url=image_url, path=target_file_path, show_progress=False)
+                if trace_span is not None and os.path.exists(target_file_path):
+                    trace_span.attrs["bytes"] = os.path.getsize(target_file_path)
 
             if os.path.exists(target_file_path) and os.path.isfile(target_file_path) and os.path.getsize(target_file_path) > 0:
-                img_pil = PILImage.open(target_file_path)
-                img_pil.load()
-                if img_pil.mode != 'RGBA':
-                    img_pil = img_pil.convert('RGBA')
-                logger.info(f"图片从 {img_pil.mode} 转换为 RGBA 模式: {target_file_path}")
-
+                self.metrics.bytes.inc(os.path.getsize(target_file_path), direction="in", kind="reference_download")
+                with self._stage("image_decode") as trace_span:
+                    img_pil = await self.image_pool.run(load_image_file, target_file_path)
+                    if trace_span is not None:
+                        trace_span.attrs["size"] = f"{img_pil.width}x{img_pil.height}"
+                logger.info(f"图片已加载并转换为 RGBA 模式: {target_file_path}")
+
+                stored_path = target_file_path
+                if self.download_cache:
+                    try:
+                        stored_path = await asyncio.to_thread(self.download_cache.store, image_url, target_file_path, ext)
+                    except Exception as e_cache:
+                        logger.warning(f"写入下载缓存失败 (URL: {image_url}): {e_cache}")
+                # 未移入下载缓存的文件作为临时文件管理
+                if stored_path == target_file_path:
+                    self.temp_storage.register(target_file_path)
+                target_file_path = stored_path
 
                 logger.info(f"成功使用 download_file 下载并加载 {context_description} 从 {image_url} (本地文件: {target_file_path})")
                 return img_pil
@@ -180,6 +415,10 @@ class GeminiArtist(Star):
                         pass
                 return None
 
+        except asyncio.CancelledError:
+            # 请求超时被取消时删除未完成的下载文件
+            remove_file_quietly(target_file_path)
+            raise
         except FileNotFoundError:
             logger.error(f"尝试写入下载文件时发生 FileNotFoundError，请检查临时目录 '{self.temp_dir}' 是否有效且可写。 URL: {image_url}", exc_info=True)
             return None
@@ -200,7 +439,7 @@ class GeminiArtist(Star):
                     pass
             return None
 
-    def _load_base_reference_image(self) -> Optional[PILImage.Image]:
+    async def _load_base_reference_image(self) -> Optional[PILImage.Image]:
         """
         从配置的路径加载默认的基础参考图。
         """
@@ -216,10 +455,8 @@ class GeminiArtist(Star):
         if image_path.exists() and image_path.is_file():
             try:
                 logger.info(f"正在加载默认参考图: {image_path}")
-                img_pil = PILImage.open(image_path)
-                img_pil.load()  # 确保图片数据已加载
-                # 转换为RGBA以获得最佳兼容性
-                return img_pil.convert('RGBA') if img_pil.mode != 'RGBA' else img_pil
+                # 完整加载并转换为RGBA以获得最佳兼容性
+                return await self.image_pool.run(load_image_file, str(image_path))
             except Exception as e:
                 logger.error(f"加载默认参考图失败: {image_path}, 错误: {e}")
                 return None
@@ -227,75 +464,138 @@ class GeminiArtist(Star):
             logger.warning(f"配置的默认参考图路径不存在或不是一个文件: {image_path}")
             return None
 
-    async def get_user_recent_image_pil_from_cache(self, user_id: str, group_id: str, index: int = 1) -> Optional[PILImage.Image]:
+    async def _load_pil_from_image_ref(self, image_ref_str: str, context_description: str = "缓存图片") -> Optional[PILImage.Image]:
         """
-        从用户图片缓存中获取指定索引的图片并下载为PIL Image对象。
+        将缓存中的图片引用 (Data URL / HTTP URL / 本地路径) 解析为PIL Image对象。
         """
-        key = (user_id, group_id)
-        if key not in self.image_history_cache or not self.image_history_cache[key]:
-            logger.debug(f"缓存中未找到用户 {user_id} group_id {group_id} 的图片URL。")
-            return None
-        cached_items = list(self.image_history_cache[key])
-        if not (0 < index <= len(cached_items)):
-            logger.debug(f"请求的图片URL索引 {index} 超出用户 {user_id} group_id {group_id} 缓存范围 ({len(cached_items)} 条)。")
-            return None
-        image_ref_str, _ = cached_items[-index]
         if image_ref_str.startswith("data:image"):
-            logger.info(f"从缓存加载Base64 Data URL (用户 {user_id}, 上下文 {group_id}, 索引 {index})")
             try:
-                header, encoded = image_ref_str.split(",", 1)
-                image_bytes = base64.b64decode(encoded)
-                pil_image = PILImage.open(BytesIO(image_bytes))
-                return pil_image.convert('RGBA') if pil_image.mode != 'RGBA' else pil_image
+                with self._stage("image_decode"):
+                    return await self.image_pool.run(decode_data_url_image, image_ref_str)
             except Exception as e:
                 logger.error(f"从缓存的Data URL解码图片失败: {e}")
                 return None
         elif image_ref_str.startswith("http://") or image_ref_str.startswith("https://"):
-            logger.info(f"从缓存加载HTTP URL并下载 (用户 {user_id}, 上下文 {group_id}, 索引 {index}): {image_ref_str}")
-            return await self.download_pil_image_from_url(image_ref_str, f"缓存图片 (HTTP)")
+            return await self.download_pil_image_from_url(image_ref_str, f"{context_description} (HTTP)")
         elif os.path.exists(image_ref_str): # 假设是本地文件路径
-             logger.info(f"从缓存加载本地文件路径 (用户 {user_id}, 上下文 {group_id}, 索引 {index}): {image_ref_str}")
-             try:
-                pil_image = PILImage.open(image_ref_str)
-                return pil_image.convert('RGBA') if pil_image.mode != 'RGBA' else pil_image
-             except Exception as e:
+            try:
+                with self._stage("image_decode"):
+                    return await self.image_pool.run(load_image_file, image_ref_str)
+            except Exception as e:
                 logger.error(f"从缓存的本地路径加载图片失败: {e}")
                 return None
         else:
             logger.warning(f"缓存中的图片引用格式未知或无效: {image_ref_str[:100]}...")
             return None
 
+    async def load_pil_images_concurrently(self, image_refs: List[str], context_description: str = "图片") -> List[Optional[PILImage.Image]]:
+        """
+        并发解析一组图片引用，并发数受 reference_fetch_concurrency 限制。
+        返回列表与 image_refs 顺序一一对应，加载失败的位置为 None。
+        """
+        if not image_refs:
+            return []
+        semaphore = asyncio.Semaphore(self.reference_fetch_concurrency)
+
+        async def _load(image_ref: str) -> Optional[PILImage.Image]:
+            async with semaphore:
+                return await self._load_pil_from_image_ref(image_ref, context_description)
+
+        return list(await asyncio.gather(*(_load(image_ref) for image_ref in image_refs)))
+
+    async def _recent_history_refs(self, user_id: str, group_id: str, count: int) -> List[str]:
+        """
+        返回该用户在该会话中最新的 count 条图片引用 (从新到旧)。
+        启用持久化时，每个键首次查询会从数据库加载本次启动前的记录。
+        """
+        if self.history_db and self.image_history_cache.needs_load(user_id, group_id):
+            # 同一个键的并发查询共用一次加载，都等到记录合并后再读取
+            key = (user_id, group_id)
+            load = self._history_loads.get(key)
+            if load is None:
+                load = asyncio.ensure_future(self._load_history_key(user_id, group_id))
+                self._history_loads[key] = load
+                load.add_done_callback(lambda _future, key=key: self._history_loads.pop(key, None))
+            await asyncio.shield(load)
+        return self.image_history_cache.recent(user_id, group_id, count)
+
+    async def _load_history_key(self, user_id: str, group_id: str) -> None:
+        """从数据库加载该键本次启动前的记录并合并到内存缓存，完成后 (包括失败时) 才标记为已加载。"""
+        ttl = self.image_history_cache.ttl_seconds
+        try:
+            rows = await self.history_db.load_recent(
+                user_id, group_id, self.max_cached_images,
+                created_after=time.time() - ttl if ttl > 0 else 0.0,
+                created_before=self._history_started_at,
+                # 引用机器人的图片时只取机器人生成的记录
+                is_bot=True if self.ingress_filter.is_robot(user_id) else None,
+            )
+            self.image_history_cache.seed(user_id, group_id, rows)
+            if rows:
+                logger.info(f"从图片历史数据库加载了用户 {user_id} (上下文 {group_id}) 的 {len(rows)} 条记录。")
+        except Exception as e:
+            logger.error(f"从图片历史数据库加载记录失败: {e}", exc_info=True)
+        finally:
+            self.image_history_cache.mark_loaded(user_id, group_id)
+
+    async def get_user_recent_images_pil_from_cache(self, user_id: str, group_id: str, count: int) -> List[Optional[PILImage.Image]]:
+        """
+        并发获取用户缓存中最新的 count 张图片。
+        返回顺序为从新到旧 (倒数第1张, 倒数第2张, ...)，加载失败的位置为 None。
+        """
+        image_refs = await self._recent_history_refs(user_id, group_id, count)
+        if not image_refs:
+            logger.debug(f"缓存中未找到用户 {user_id} group_id {group_id} 的图片URL。")
+            return []
+        logger.info(f"并发加载用户 {user_id} (上下文 {group_id}) 缓存中最新的 {len(image_refs)} 张图片 (并发上限 {self.reference_fetch_concurrency})")
+        return await self.load_pil_images_concurrently(image_refs, "缓存图片")
+
     @filter.event_message_type(EventMessageType.ALL)
-    async def cache_user_images(self, event: AstrMessageEvent):
+    async def on_message(self, event: AstrMessageEvent):
         """
-        监听所有消息，将用户发送的图片URL缓存起来。
+        所有消息的统一入口：只做一次规范化与白名单判断，再分派给图片缓存与 /draw 会话收集。
+        不含图片且没有进行中的 /draw 会话的消息在此直接返回。
         """
-        if not hasattr(event, 'message_obj') or not hasattr(event.message_obj, 'type'):
-            return
-        user_id = event.get_sender_id()
-        if self.robot_id_from_config and user_id == self.robot_id_from_config:
+        ingress = self.ingress_filter.normalize(event)
+        if ingress is None:
             return
-        group_id = event.message_obj.group_id
-        if self.group_whitelist:
-            identifier_to_check = event.message_obj.group_id if event.message_obj.group_id else user_id
-            if str(identifier_to_check) not in [str(whitelisted_id) for whitelisted_id in self.group_whitelist]:
-                return
-        if group_id == "":
-            group_id = user_id
-            logger.debug(f"收到来自用户 {user_id} group_id {group_id} 的消息。")
-        for msg_component in event.get_messages():
-            if isinstance(msg_component, Image) and hasattr(msg_component, 'url') and msg_component.url:
-                self.store_user_image(user_id, group_id, msg_component.url, getattr(msg_component, 'file', None))
+        if ingress.image_refs:
+            await self.cache_user_images(ingress)
+        if self.waiting_users and ingress.session_key in self.waiting_users:
+            try:
+                async for result in self.collect_user_inputs(event, ingress):
+                    yield result
+            finally:
+                self._finish_trace()
+
+    async def cache_user_images(self, ingress: IngressMessage):
+        """
+        将用户发送的图片URL缓存起来。大的 data URL 在线程中解码写盘，不阻塞事件循环。
+        """
+        for image_url, original_filename in ingress.image_refs:
+            spill_path = None
+            if self.image_history_cache.should_spill(image_url):
+                spill_path = await asyncio.to_thread(self.image_history_cache.spill, image_url)
+            self.store_user_image(ingress.user_id, ingress.context_id, image_url, original_filename, spill_path=spill_path)
 
     @filter.llm_tool(name="gemini_draw")
-    async def gemini_draw(self, event: AstrMessageEvent, prompt: str, image_index: int = 0, reference_bot: bool = False) -> AsyncGenerator[Any, None]:
+    async def gemini_draw(self, event: AstrMessageEvent, prompt: str, image_index: int = 0, reference_bot: bool = False, count: int = 1) -> AsyncGenerator[Any, None]:
         '''
         AI图像生成与编辑工具。支持文生图、图生图、图像编辑等多种功能。
         Args:
             prompt (string): 图像生成或编辑的详细描述，当用户使用"再画一张"、"重新生成一张"时使用之前绘画的提示词。
             image_index (number, optional): 引用历史图片数量。0=不引用，1=引用最新1张，2=引用最新2张，依此类推。默认为0。
             reference_bot (boolean, optional): 是否引用机器人之前生成的图片。True=引用机器人生成的，False=引用用户发送的。默认为False。
+            count (number, optional): 同一提示词生成的变体数量，用户要求"画几张/多来几个版本"时使用。默认为1。
         '''
+        try:
+            async for result in self._gemini_draw(event, prompt, image_index, reference_bot, count):
+                yield result
+        finally:
+            self._finish_trace()
+
+    async def _gemini_draw(self, event: AstrMessageEvent, prompt: str, image_index: int, reference_bot: bool, count: int = 1) -> AsyncGenerator[Any, None]:
+        """gemini_draw 的实现；追踪在截止时间创建时开始，由 gemini_draw 结束。"""
         if not self.api_keys:
             yield event.plain_result("请联系管理员配置Gemini API密钥。")
             return
@@ -307,17 +607,20 @@ class GeminiArtist(Star):
         command_sender_id = event.get_sender_id()
         group_id = event.message_obj.group_id
 
-        if self.group_whitelist and str(event.message_obj.group_id or command_sender_id) not in map(str, self.group_whitelist):
+        if not self.ingress_filter.allows(event.message_obj.group_id or command_sender_id):
             return
-        if self.robot_id_from_config and command_sender_id == self.robot_id_from_config:
+        if self.ingress_filter.is_robot(command_sender_id):
             return
 
+        # 端到端截止时间，覆盖参考图下载、预处理、API调用与结果保存
+        deadline = RequestDeadline(self.request_timeout_seconds)
+        count = self._clamp_variant_count(count)
+        self.tracer.start("gemini_draw", user=command_sender_id, group=str(group_id or command_sender_id), image_index=image_index, reference_bot=reference_bot, count=count)
         all_text = prompt.strip()
         all_images_pil: List[PILImage.Image] = []
         used_default_image = False # 新增：标记是否使用了默认参考图
 
         # 优先处理回复消息中的图片
-        replied_image_pil: Optional[PILImage.Image] = None
         message_chain = event.get_messages()
 
         for msg_component in message_chain:
@@ -339,13 +642,22 @@ class GeminiArtist(Star):
                     logger.debug("Reply component has 'source.message_chain' attribute.")
 
                 if source_chain:
-                    for replied_part in source_chain:
-                        if isinstance(replied_part, Image) and hasattr(replied_part, 'url') and replied_part.url:
-                            replied_image_pil = await self.download_pil_image_from_url(replied_part.url, "直接引用的消息中的图片")
-                            if replied_image_pil:
-                                logger.info("成功从直接引用的消息中加载了图片作为参考。")
-                                all_images_pil.append(replied_image_pil)
-                if replied_image_pil:
+                    replied_urls = [
+                        replied_part.url for replied_part in source_chain
+                        if isinstance(replied_part, Image) and hasattr(replied_part, 'url') and replied_part.url
+                    ]
+                    try:
+                        replied_images = await deadline.run(self.load_pil_images_concurrently(replied_urls, "直接引用的消息中的图片"))
+                    except RequestTimeoutError:
+                        logger.warning("gemini_draw: 下载引用的图片时超过请求截止时间。")
+                        yield event.plain_result(self._format_timeout_message())
+                        return
+                    for replied_image_pil in replied_images:
+                        if replied_image_pil:
+                            all_images_pil.append(replied_image_pil)
+                    if all_images_pil:
+                        logger.info(f"成功从直接引用的消息中加载了 {len(all_images_pil)} 张图片作为参考。")
+                if all_images_pil:
                     logger.info("使用直接引用的图片作为唯一参考，忽略 image_index 和 reference_user_id。")
                     image_index = 0
                     reference_bot = False
@@ -362,43 +674,43 @@ class GeminiArtist(Star):
             group_id_for_cache_lookup = event.message_obj.group_id or command_sender_id
             logger.info(f"尝试从用户 {user_id_for_cache_lookup} (上下文 {group_id_for_cache_lookup}) 缓存获取最新的 {num_images_to_fetch} 张图片。")
 
-            key_for_cache = (user_id_for_cache_lookup, group_id_for_cache_lookup)
-            if key_for_cache not in self.image_history_cache or not self.image_history_cache[key_for_cache]:
+            try:
+                cached_images = await deadline.run(self.get_user_recent_images_pil_from_cache(
+                    user_id_for_cache_lookup,
+                    group_id_for_cache_lookup,
+                    num_images_to_fetch
+                ))
+            except RequestTimeoutError:
+                logger.warning("gemini_draw: 加载缓存图片时超过请求截止时间。")
+                yield event.plain_result(self._format_timeout_message())
+                return
+            if not cached_images:
                 message = f"缓存中未找到用户 {user_id_for_cache_lookup} (上下文 {group_id_for_cache_lookup}) 的图片历史。"
                 logger.warning(message)
-                # 直接跳过获取缓存图片的逻辑
             else:
-                cached_items_list = list(self.image_history_cache[key_for_cache])
-                # 确保不要请求超过缓存数量的图片
-                actual_num_to_fetch = min(num_images_to_fetch, len(cached_items_list))
-
-                if actual_num_to_fetch == 0:
-                    message = f"用户 {user_id_for_cache_lookup} (上下文 {group_id_for_cache_lookup}) 的图片历史为空，无法按数量 {num_images_to_fetch} 获取参考图。"
-                    logger.warning(message)
-
                 fetched_count = 0
-                # 从最新的开始获取 (倒数第1, 倒数第2, ..., 倒数第 actual_num_to_fetch)
-                for i in range(1, actual_num_to_fetch + 1):
-                    pil_image_from_cache = await self.get_user_recent_image_pil_from_cache(
-                        user_id_for_cache_lookup,
-                        group_id_for_cache_lookup,
-                        i 
-                    )
+                # 结果顺序为从最新的开始 (倒数第1, 倒数第2, ...)
+                for i, pil_image_from_cache in enumerate(cached_images, start=1):
                     if pil_image_from_cache:
                         all_images_pil.append(pil_image_from_cache)
-                        fetched_count +=1
+                        fetched_count += 1
                     else:
                         logger.warning(f"未能加载用户 {user_id_for_cache_lookup} (上下文 {group_id_for_cache_lookup}) 的倒数第 {i} 张图片。")
-                
+
                 if fetched_count == 0 and num_images_to_fetch > 0 : # 如果指定要图但一张都没取到
                     message = f"尝试获取最新的 {num_images_to_fetch} 张图片，但未能成功加载任何一张。"
                     logger.warning(message)
-                
+
                 logger.info(f"成功从缓存加载了 {fetched_count} 张参考图片。")
 
         # 如果没有任何用户提供的参考图，则尝试加载默认参考图
         if not all_images_pil and self.enable_base_reference_image:
-            base_image = self._load_base_reference_image()
+            try:
+                base_image = await deadline.run(self._load_base_reference_image())
+            except RequestTimeoutError:
+                logger.warning("gemini_draw: 加载默认参考图时超过请求截止时间。")
+                yield event.plain_result(self._format_timeout_message())
+                return
             if base_image:
                 all_images_pil.append(base_image)
                 used_default_image = True # 设置标记
@@ -413,19 +725,24 @@ class GeminiArtist(Star):
         if all_text:
             all_text = f"Generate/modify images using the following prompt: {all_text}"
 
-        if self.enable_hinting:
-            yield event.plain_result("正在生成图片，请稍候...")
-
+        # 进入全局准入队列，按群组公平调度
+        admission_ticket = self.admission.enqueue(str(group_id or command_sender_id))
         try:
+            if self.enable_hinting:
+                yield event.plain_result(self._format_variant_hint("正在生成图片", count) + "，请稍候..." + self._format_queue_hint(admission_ticket))
             logger.debug(f"gemini_draw: 调用 API 生成 (API类型: {self.api_type}, 文本: '{all_text[:100]}...', PIL图片数: {len(all_images_pil)})")
-            
-            # 根据API类型调用相应的生成方法
-            if self.api_type == "OpenRouter":
-                result = await self.openrouter_generate(all_text, all_images_pil)
-            else:
-                # 默认使用 Google Gemini API
-                result = await self.gemini_generate(all_text, all_images_pil)
-            
+
+            result = None
+            async for kind, payload in self._generate_images_streaming(all_text, all_images_pil, admission_ticket, str(group_id or command_sender_id), deadline, count=count):
+                if kind == 'text':
+                    yield event.plain_result(payload)
+                elif kind == 'image':
+                    send_started = time.monotonic()
+                    yield event.chain_result([Image.fromFileSystem(payload)])
+                    self._observe_stage("message_send", send_started)
+                else:
+                    result = payload
+
             logger.debug(f"gemini_draw: API 调用完成。")
 
             if result is None or not isinstance(result, dict):
@@ -447,7 +764,8 @@ class GeminiArtist(Star):
                         command_sender_id, # 图片归属于触发操作的用户
                         group_id, # 在当前会话上下文中
                         img_path, # 缓存的是本地文件路径
-                        f"gemini_generated_{i+1}_{os.path.basename(img_path)}"
+                        f"gemini_generated_{i+1}_{os.path.basename(img_path)}",
+                        is_bot=True
                     )
                 else:
                     logger.warning(f"Gemini生成的图片路径无效，无法缓存或发送: {img_path}")
@@ -457,6 +775,11 @@ class GeminiArtist(Star):
                 event.stop_event()
                 return
 
+            # 流式生成时图文已在生成过程中逐条发送，只需把结果反馈给LLM
+            if result.get('streamed'):
+                yield self._format_llm_feedback(text_response, len(image_paths), used_default_image)
+                return
+
             # 如果只有一张图片或没有图片，则直接发送
             if len(image_paths) < 2:
                 chain = []
@@ -466,22 +789,11 @@ class GeminiArtist(Star):
                     if img_path and os.path.exists(img_path) and os.path.getsize(img_path) > 0:
                         chain.append(Image.fromFileSystem(img_path))
                 if chain:
-                    # 构建给LLM的反馈信息
-                    llm_feedback = f"你生成了 {len(image_paths)} 张图片。"
-                    if used_default_image:
-                        llm_feedback += "由于用户没有提供参考图，你使用了插件预设的默认参考图进行创作。"
-                    llm_feedback += ("这些图片已经发送给用户，并且用户可以通过图片索引（例如，image_index=1 代表最新生成的这张/这些图片）来引用它们进行后续操作。"
-                                     "请根据用户的原始意图和这些新生成的图文内容继续对话。")
-
-                    tool_output_data = {
-                        "generated_text": text_response,
-                        "number_of_images_generated": len(image_paths),
-                        "user_instruction_for_llm": llm_feedback
-                        }
-                            # 工具的返回值应该是这个JSON字符串
-                            # 当LLM调用此工具后，这个字符串会作为工具结果进入LLM的上下文
-                    yield json.dumps(tool_output_data, ensure_ascii=False)
+                    # 工具的返回值是这个JSON字符串，当LLM调用此工具后，它会作为工具结果进入LLM的上下文
+                    yield self._format_llm_feedback(text_response, len(image_paths), used_default_image)
+                    send_started = time.monotonic()
                     yield event.chain_result(chain)
+                    self._observe_stage("message_send", send_started)
                 else:
                     if text_response:
                         yield event.plain_result(text_response)
@@ -501,7 +813,9 @@ class GeminiArtist(Star):
                         if img_path and os.path.exists(img_path) and os.path.getsize(img_path) > 0:
                             chain.append(Image.fromFileSystem(img_path))
                     if chain:
+                        send_started = time.monotonic()
                         yield event.chain_result(chain)
+                        self._observe_stage("message_send", send_started)
                     else:
                         yield event.plain_result("抱歉，未能生成有效内容。")
                     return
@@ -530,29 +844,317 @@ class GeminiArtist(Star):
                             content=content
                         ))
                 if ns:
-                    # 构建给LLM的反馈信息
-                    llm_feedback = f"你生成了 {len(image_paths)} 张图片。"
-                    if used_default_image:
-                        llm_feedback += "由于用户没有提供参考图，你使用了插件预设的默认参考图进行创作。"
-                    llm_feedback += ("这些图片已经发送给用户，并且用户可以通过图片索引（例如，image_index=1 代表最新生成的这张/这些图片）来引用它们进行后续操作。"
-                                     "请根据用户的原始意图和这些新生成的图文内容继续对话。")
-
-                    tool_output_data = {
-                        "generated_text": text_response,
-                        "number_of_images_generated": len(image_paths),
-                        "user_instruction_for_llm": llm_feedback
-                    }
-                    yield json.dumps(tool_output_data, ensure_ascii=False)
+                    yield self._format_llm_feedback(text_response, len(image_paths), used_default_image)
+                    send_started = time.monotonic()
                     yield event.chain_result([ns])
+                    self._observe_stage("message_send", send_started)
                 else:
                     yield event.plain_result("抱歉，未能生成有效内容。")
 
+        except RequestTimeoutError:
+            logger.warning(f"gemini_draw: 请求超过 {self.request_timeout_seconds} 秒的截止时间，已取消。")
+            yield event.plain_result(self._format_timeout_message())
         except Exception as e:
             logger.error(f"gemini_draw 未知错误: {e}", exc_info=True)
             yield event.plain_result(f"处理请求时发生意外错误: {str(e)}")
+        finally:
+            # 截止时间可能在 _generate_images 开始执行前就已耗尽，此时它不会归还名额，在此兜底
+            admission_ticket.release()
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("draw_stats")
+    async def show_draw_stats(self, event: AstrMessageEvent):
+        """管理员查看绘图各阶段耗时、请求结果、上游调用与当前负载的统计摘要。"""
+        lines = self.metrics.summary_lines()
+        tracer_stats = self.tracer.stats()
+        lines.append(f"[追踪] 慢请求 {tracer_stats['slow_requests']} 次 (阈值 {self.tracer.slow_threshold_seconds} 秒)")
+        batch_stats = self.batch_runner.stats()
+        lines.append(f"[批量任务] 进行中 {len(self._batch_tasks)} 个，已启动提示词 {batch_stats['started_items']} 条 (并发 {batch_stats['concurrency']})")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("draw_job")
+    async def submit_draw_job(self, event: AstrMessageEvent):
+        """
+        管理员提交批量生成任务：/draw_job [nodes|archive] 后每行一条提示词。
+        消息中 (或被回复消息中) 的图片作为所有提示词共享的参考图。
+        """
+        if not self.api_keys:
+            yield event.plain_result("请联系管理员配置Gemini API密钥 (api_keys)")
+            return
+        lines = [line.strip() for line in re.sub(r'^/?draw_job', '', event.message_str.strip()).splitlines()]
+        delivery = None
+        if lines and lines[0].lower() in ("nodes", "archive"):
+            delivery = lines.pop(0).lower()
+        prompts = [line for line in lines if line]
+        if not prompts:
+            yield event.plain_result("用法：/draw_job [nodes|archive]，之后每行一条提示词。可附带或回复图片作为共享参考图。")
+            return
+        if len(prompts) > self.batch_max_prompts:
+            yield event.plain_result(f"提示词数量 {len(prompts)} 超过上限 {self.batch_max_prompts}，请拆分为多个任务。")
+            return
+        image_refs = self._collect_event_image_refs(event)
+        job = await self.submit_batch_job(prompts, image_refs, event.unified_msg_origin, delivery)
+        reference_note = f"，共享参考图 {len(image_refs)} 张" if image_refs else ""
+        yield event.plain_result(
+            f"已创建批量任务 {job.job_id}：{len(prompts)} 条提示词{reference_note}，结果将以{'压缩包' if job.delivery == 'archive' else '合并转发消息'}发送。\n"
+            f"使用 /draw_job_status 查看进度，/draw_job_cancel {job.job_id} 取消任务。"
+        )
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("draw_job_status")
+    async def show_draw_job_status(self, event: AstrMessageEvent):
+        """管理员查看批量生成任务的进度。"""
+        if not self.batch_jobs:
+            yield event.plain_result("当前没有批量任务。")
+            return
+        lines = []
+        for job in sorted(self.batch_jobs.values(), key=lambda j: j.created):
+            counts = job.counts()
+            state = job.status if job.finished is None else f"{job.status}, 已投递"
+            lines.append(
+                f"{job.job_id} [{state}] 完成 {counts[ITEM_DONE]}/{counts['total']}，失败 {counts[ITEM_FAILED]}，"
+                f"进行中 {counts[ITEM_RUNNING]}，待处理 {counts[ITEM_PENDING]}"
+            )
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("draw_job_cancel")
+    async def cancel_draw_job(self, event: AstrMessageEvent, job_id: str = ""):
+        """管理员取消批量生成任务，已生成的结果仍会发送。"""
+        job = self.batch_jobs.get(job_id.strip())
+        if job is None:
+            yield event.plain_result(f"未找到批量任务 {job_id}。")
+            return
+        if job.status != JOB_RUNNING:
+            yield event.plain_result(f"批量任务 {job.job_id} 已结束 ({job.status})。")
+            return
+        job.status = JOB_CANCELLED
+        task = self._batch_tasks.get(job.job_id)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        counts = job.counts()
+        yield event.plain_result(f"已取消批量任务 {job.job_id}，已完成的 {counts[ITEM_DONE]} 条结果即将发送。")
+        await self._deliver_batch_results(job, final=True)
+
+    def _collect_event_image_refs(self, event: AstrMessageEvent) -> List[str]:
+        """收集消息本身与被回复消息中的图片 URL。"""
+        image_refs = []
+        for component in event.get_messages():
+            if isinstance(component, Image) and getattr(component, 'url', None):
+                image_refs.append(component.url)
+            elif isinstance(component, Reply):
+                source_chain = getattr(component, 'chain', None) or getattr(component, 'message', None)
+                if isinstance(source_chain, list):
+                    image_refs.extend(part.url for part in source_chain if isinstance(part, Image) and getattr(part, 'url', None))
+        return image_refs
+
+    async def submit_batch_job(self, prompts: List[str], image_refs: List[str], origin: str, delivery: Optional[str] = None) -> BatchJob:
+        """
+        创建并开始批量生成任务，结果发送到 origin (unified_msg_origin)。
+        delivery 为 "nodes" (分批合并转发) 或 "archive" (任务结束后发送一个压缩包)，默认取配置。
+        """
+        if delivery not in ("nodes", "archive"):
+            delivery = self.batch_delivery if self.batch_delivery in ("nodes", "archive") else "nodes"
+        job = BatchJob.create(prompts, image_refs, origin, delivery)
+        self.batch_jobs[job.job_id] = job
+        await self._save_batch_job(job)
+        logger.info(f"已创建批量任务 {job.job_id}：{len(prompts)} 条提示词，共享参考图 {len(image_refs)} 张，投递方式 {delivery}。")
+        self._start_batch_job(job)
+        return job
+
+    async def _save_batch_job(self, job: BatchJob) -> None:
+        """
+        写入任务检查点。快照在事件循环中生成，避免线程序列化时其他提示词同时修改状态；
+        同一任务的保存按顺序串行执行，较早的快照不会覆盖较新的。
+        """
+        payload = job.dumps()
+        async with self._batch_save_locks.setdefault(job.job_id, asyncio.Lock()):
+            await asyncio.to_thread(self.batch_store.save, job.job_id, payload)
+
+    def _start_batch_job(self, job: BatchJob) -> None:
+        self._batch_tasks[job.job_id] = asyncio.create_task(self._run_batch_job(job))
+
+    async def _resume_batch_jobs(self) -> None:
+        """加载任务检查点：继续执行未完成的任务，重新投递已结束但未发送完的结果。"""
+        try:
+            jobs = await asyncio.to_thread(self.batch_store.load_all)
+        except Exception as e:
+            logger.error(f"加载批量任务检查点失败: {e}", exc_info=True)
+            return
+        for job in jobs:
+            self.batch_jobs[job.job_id] = job
+            if job.finished is None:
+                logger.info(f"恢复批量任务 {job.job_id} ({job.status})，剩余 {len(job.pending_indices())}/{len(job.items)} 条提示词。")
+                self._start_batch_job(job)
+        await self._prune_batch_jobs()
+
+    async def _prune_batch_jobs(self) -> None:
+        """删除结束时间超过临时文件保留时长的批量任务记录。"""
+        if self.cleanup_older_than_seconds <= 0:
+            return
+        now = time.time()
+        for job in list(self.batch_jobs.values()):
+            if job.finished is not None and now - job.finished > self.cleanup_older_than_seconds:
+                self.batch_jobs.pop(job.job_id, None)
+                self._batch_delivery_locks.pop(job.job_id, None)
+                self._batch_save_locks.pop(job.job_id, None)
+                await asyncio.to_thread(self.batch_store.remove_job, job.job_id)
+
+    async def _run_batch_job(self, job: BatchJob) -> None:
+        """执行批量任务中未完成的提示词，结束 (或被取消) 后完成最终投递。"""
+        try:
+            if job.status == JOB_RUNNING:
+                images_pil: List[PILImage.Image] = []
+                if job.image_refs:
+                    loaded_images = await self.load_pil_images_concurrently(job.image_refs, "批量任务的共享参考图")
+                    images_pil = [img for img in loaded_images if img is not None]
+                    if len(images_pil) < len(job.image_refs):
+                        logger.warning(f"批量任务 {job.job_id}: {len(job.image_refs) - len(images_pil)}/{len(job.image_refs)} 张共享参考图加载失败，已忽略。")
+                if not images_pil and self.enable_base_reference_image:
+                    base_image = await self._load_base_reference_image()
+                    if base_image:
+                        images_pil.append(base_image)
+                await self.batch_runner.run(job, functools.partial(self._run_batch_item, images_pil))
+                if job.status == JOB_RUNNING:
+                    job.status = JOB_DONE
+                logger.info(f"批量任务 {job.job_id} 结束: {job.counts()}")
+            await self._deliver_batch_results(job, final=True)
+        except asyncio.CancelledError:
+            # 被中断的提示词回到待处理状态：插件重启时继续执行，被取消时计为未执行
+            for item in job.items:
+                if item['status'] == ITEM_RUNNING:
+                    item['status'] = ITEM_PENDING
+            await self._save_batch_job(job)
+            raise
+        except Exception as e:
+            logger.error(f"批量任务 {job.job_id} 执行出错: {e}", exc_info=True)
+        finally:
+            self._batch_tasks.pop(job.job_id, None)
+
+    async def _run_batch_item(self, images_pil: List[PILImage.Image], job: BatchJob, index: int) -> None:
+        """
+        生成批量任务中的一条提示词。与聊天请求一样经过全局准入队列 (群组 "batch")，
+        使批量任务不会挤占各群组的公平份额；结果图片存入任务目录并写入检查点。
+        """
+        item = job.items[index]
+        item['status'] = ITEM_RUNNING
+        deadline = RequestDeadline(self.request_timeout_seconds)
+        self.tracer.start("batch", job=job.job_id, index=index + 1)
+        admission_ticket = self.admission.enqueue("batch")
+        outcome = "cancelled"
+        try:
+            result = await deadline.run(self._generate_images(
+                f"Generate/modify images using the following prompt: {job.prompts[index]}", images_pil, admission_ticket, "batch"
+            ))
+            image_paths = [path for path in result.get('image_paths', []) if os.path.exists(path)]
+            item['images'] = await asyncio.to_thread(
+                lambda: [self.batch_store.adopt_image(job.job_id, index, seq, path) for seq, path in enumerate(image_paths, start=1)]
+            )
+            item['text'] = result.get('text', '').strip()
+            outcome = "success" if item['images'] else "no_image"
+            item['status'] = ITEM_DONE if item['images'] else ITEM_FAILED
+            if not item['images']:
+                item['error'] = "未生成图片"
+        except RequestTimeoutError:
+            outcome = "timeout"
+            item['status'], item['error'] = ITEM_FAILED, self._format_timeout_message()
+        except Exception as e:
+            outcome = "safety" if isinstance(e, SafetyBlockedError) else "error"
+            item['status'], item['error'] = ITEM_FAILED, str(e)
+            logger.warning(f"批量任务 {job.job_id} 第 {index + 1} 条提示词生成失败: {e}")
+        finally:
+            admission_ticket.release()
+            self._record_request("batch", outcome, deadline)
+            self._finish_trace()
+        await self._save_batch_job(job)
+        await self._deliver_batch_results(job)
+
+    async def _deliver_batch_results(self, job: BatchJob, final: bool = False) -> None:
+        """
+        投递批量任务的结果。
+        - nodes：已结束的提示词每满 batch_nodes_size 条发送一条合并转发消息，最终投递时发送剩余部分；
+        - archive：最终投递时把全部图片与结果清单打包为一个 zip 文件发送。
+        最终投递成功后发送汇总并删除任务目录中的图片；发送失败的结果保留，重启后重新投递。
+        """
+        async with self._batch_delivery_locks.setdefault(job.job_id, asyncio.Lock()):
+            if job.finished is not None:
+                return
+            if job.delivery == "archive":
+                if not final:
+                    return
+                archive_path = await asyncio.to_thread(self.batch_store.write_archive, job)
+                if not await self._send_batch_message(job, [File(name=os.path.basename(archive_path), file=archive_path)]):
+                    return
+                for item in job.items:
+                    item['delivered'] = item['status'] in (ITEM_DONE, ITEM_FAILED)
+            else:
+                ready = [idx for idx, item in enumerate(job.items) if not item['delivered'] and item['status'] in (ITEM_DONE, ITEM_FAILED)]
+                for start in range(0, len(ready), self.batch_nodes_size):
+                    chunk = ready[start:start + self.batch_nodes_size]
+                    if len(chunk) < self.batch_nodes_size and not final:
+                        break
+                    if not await self._send_batch_chunk(job, chunk):
+                        return
+                    for idx in chunk:
+                        job.items[idx]['delivered'] = True
+                    await self._save_batch_job(job)
+            if not final:
+                return
+            counts = job.counts()
+            summary = f"批量任务 {job.job_id} {'已取消' if job.status == JOB_CANCELLED else '已完成'}：成功 {counts[ITEM_DONE]}/{counts['total']}，失败 {counts[ITEM_FAILED]}"
+            if counts[ITEM_PENDING]:
+                summary += f"，未执行 {counts[ITEM_PENDING]}"
+            await self._send_batch_message(job, [Plain(summary)])
+            await asyncio.to_thread(self.batch_store.remove_outputs, job)
+            job.finished = time.time()
+            await self._save_batch_job(job)
+
+    async def _send_batch_chunk(self, job: BatchJob, indices: List[int]) -> bool:
+        bot_id_str = self.robot_id_from_config or self.config.get("bot_id")
+        bot_id = int(str(bot_id_str).strip()) if bot_id_str and str(bot_id_str).strip().isdigit() else None
+        contents = []
+        for idx in indices:
+            item = job.items[idx]
+            header = f"#{idx + 1} {job.prompts[idx]}"
+            if item['status'] == ITEM_FAILED:
+                contents.append([Plain(f"{header}\n生成失败: {item['error']}")])
+            else:
+                images = [Image.fromFileSystem(path) for path in item['images'] if os.path.exists(path)]
+                contents.append([Plain(header)] + images)
+        if bot_id is None:
+            # 没有可用的数字机器人ID时无法构造合并转发消息，逐条普通发送
+            for content in contents:
+                if not await self._send_batch_message(job, content):
+                    return False
+            return True
+        bot_name = str(self.config.get("bot_name", "绘图助手")).strip() or "绘图助手"
+        nodes = Nodes([Node(user_id=bot_id, nickname=bot_name, content=content) for content in contents])
+        return await self._send_batch_message(job, [nodes])
+
+    async def _send_batch_message(self, job: BatchJob, chain: List[BaseMessageComponent]) -> bool:
+        send_started = time.monotonic()
+        try:
+            sent = await self.context.send_message(job.origin, MessageChain(chain=chain))
+        except Exception as e:
+            logger.error(f"批量任务 {job.job_id} 发送结果失败: {e}", exc_info=True)
+            return False
+        if sent is False:
+            logger.error(f"批量任务 {job.job_id} 发送结果失败: 未找到会话 {job.origin} 对应的平台。")
+            return False
+        self._observe_stage("message_send", send_started)
+        return True
+
     @filter.command("draw")
-    async def initiate_creation_session(self, event: AstrMessageEvent):
-        """处理 /draw 命令，启动绘图会话。(旧版功能)"""
+    async def initiate_creation_session(self, event: AstrMessageEvent, count: str = "1"):
+        """
+        处理 /draw 命令，启动绘图会话。(旧版功能) /draw <数量> 可一次生成多个变体。
+        count 以字符串接收：/draw 后跟的不是数字 (例如 /draw 一只猫) 时按 1 个变体处理，而不是被参数解析拒绝。
+        """
         if not self.api_keys:
             yield event.plain_result("请联系管理员配置Gemini API密钥 (api_keys)")
             return
@@ -572,11 +1174,9 @@ class GeminiArtist(Star):
         if is_group_message:
             group_id = event.message_obj.group_id
         
-        if self.group_whitelist:
-            identifier_to_check = group_id if is_group_message else user_id
-            if str(identifier_to_check) not in [str(whitelisted_id) for whitelisted_id in self.group_whitelist]:
-                logger.info(f"initiate_creation_session: 用户/群组 {identifier_to_check} 不在白名单中，已忽略 /draw 命令。")
-                return # No reply for non-whitelisted
+        if not self.ingress_filter.allows(group_id):
+            logger.info(f"initiate_creation_session: 用户/群组 {group_id} 不在白名单中，已忽略 /draw 命令。")
+            return # No reply for non-whitelisted
 
         session_key = (user_id, str(group_id)) # Ensure group_id is string for key consistency
 
@@ -586,41 +1186,23 @@ class GeminiArtist(Star):
              yield event.plain_result(f"您已经在当前会话有一个正在进行的绘制任务，请先完成或等待超时 ({remaining_time}秒后)。")
              return
         elif session_key in self.waiting_users: # Expired entry
-            del self.waiting_users[session_key]
-            if session_key in self.user_inputs:
-                del self.user_inputs[session_key]
+            self._end_draw_session(session_key)
 
 
         self.waiting_users[session_key] = time.time() + self.wait_time_from_config
-        self.user_inputs[session_key] = {'messages': []}
-        
-        logger.debug(f"Gemini_Draw (Command): User {user_id} started draw. Session ID: {group_id}, Session Key: {session_key}. Waiting state set.")
-        yield event.plain_result(f"好的 {user_name}，请在{self.wait_time_from_config}秒内发送文本描述和可能需要的图片, 然后发送包含'start'或'开始'的消息开始生成。")
-
-    @filter.event_message_type(EventMessageType.ALL)
-    async def collect_user_inputs(self, event: AstrMessageEvent):
-        """处理后续消息，收集用户输入或触发 /draw 会话的生成。(旧版功能)"""
-        if not hasattr(event, 'message_obj') or not hasattr(event.message_obj, 'type'):
-             return 
-
-        user_id = event.get_sender_id()
-        
-        # 忽略机器人自身消息
-        if self.robot_id_from_config and user_id == self.robot_id_from_config:
-            return
-
-        current_group_id = user_id 
-        is_group_message = hasattr(event.message_obj, 'group_id') and event.message_obj.group_id is not None and event.message_obj.group_id != ""
-        if is_group_message:
-            current_group_id = event.message_obj.group_id
+        count = self._clamp_variant_count(count)
+        self.user_inputs[session_key] = {'messages': [], 'bytes': 0, 'count': count}
         
-        # 白名单检查 (同样应用于后续消息，确保只有授权会话可以继续)
-        if self.group_whitelist:
-            identifier_to_check = current_group_id if is_group_message else user_id
-            if str(identifier_to_check) not in [str(whitelisted_id) for whitelisted_id in self.group_whitelist]:
-                return
+        logger.debug(f"Gemini_Draw (Command): User {user_id} started draw. Session ID: {group_id}, Session Key: {session_key}, variants: {count}. Waiting state set.")
+        variant_note = f"（将生成 {count} 个变体）" if count > 1 else ""
+        yield event.plain_result(f"好的 {user_name}{variant_note}，请在{self.wait_time_from_config}秒内发送文本描述和可能需要的图片, 然后发送包含'start'或'开始'的消息开始生成。")
 
-        current_session_key = (user_id, str(current_group_id))
+    async def collect_user_inputs(self, event: AstrMessageEvent, ingress: IngressMessage):
+        """处理后续消息，收集用户输入或触发 /draw 会话的生成。(旧版功能)
+        由 on_message 在消息属于进行中的 /draw 会话时调用，机器人消息与白名单已在入口处过滤。"""
+        user_id = ingress.user_id
+        current_group_id = ingress.context_id
+        current_session_key = ingress.session_key
 
         # logger.debug(f"collect_user_inputs: Processing message. User ID: {user_id}, Session ID: {current_group_id}, Session Key: {current_session_key}")
         # logger.debug(f"collect_user_inputs: Current waiting users keys: {list(self.waiting_users.keys())}")
@@ -633,9 +1215,7 @@ class GeminiArtist(Star):
 
         if time.time() > self.waiting_users[current_session_key]:
             logger.debug(f"collect_user_inputs: Session {current_group_id} for user {user_id} (key {current_session_key}) timed out for /draw flow.")
-            del self.waiting_users[current_session_key]
-            if current_session_key in self.user_inputs:
-                del self.user_inputs[current_session_key]
+            self._end_draw_session(current_session_key)
             yield event.plain_result("等待超时，您的 /draw 会话已结束。请重新使用 /draw 命令。")
             return
 
@@ -652,47 +1232,35 @@ class GeminiArtist(Star):
 
 
         current_text_for_prompt = message_text_raw
-        current_images_pil: List[PILImage.Image] = []
-
-        message_chain = event.get_messages()
-        for msg_component in message_chain:
-            if isinstance(msg_component, Image) and hasattr(msg_component, 'url') and msg_component.url:
-                try:
-                    # 旧版使用 download_image_by_url，返回本地路径
-                    # 然后用 PILImage.open 打开。
-                    # 新版有 download_pil_image_from_url 直接返回 PIL Image。
-                    # 为了保持"整块添加"，我们暂时用旧的方式，或者适配到新的。
-                    # 适配到新的：
-                    pil_img = await self.download_pil_image_from_url(msg_component.url, "用户为/draw会话发送的图片")
-                    if pil_img:
-                        current_images_pil.append(pil_img)
-                        logger.info(f"collect_user_inputs: Successfully downloaded and converted image via new method: {msg_component.url} for /draw session key {current_session_key}")
-                    else:
-                        yield event.plain_result(f"无法处理您发送的一张图片（下载或转换失败），请尝试其他图片。") # Inform user
-                        # return # Optional: stop processing if one image fails
-                except Exception as e:
-                    logger.error(f"collect_user_inputs: 处理 /draw 会话的图片失败 (key {current_session_key}): {str(e)}", exc_info=True)
-                    yield event.plain_result(f"处理图片时发生错误: {str(e)}。请稍后再试或尝试其他图片。")
-                    return # Stop processing on error
+        # 只记录图片引用，下载与解码推迟到收到开始指令时
+        current_image_refs: List[str] = [image_url for image_url, _ in ingress.image_refs]
 
         # 确保 user_inputs 中有此会话 (理论上 initiate 时已创建)
         if current_session_key not in self.user_inputs:
              logger.error(f"collect_user_inputs: 用户 {user_id} 在会话 {current_group_id} (key {current_session_key}) 中等待，但 user_inputs 状态丢失。正在清理。")
-             if current_session_key in self.waiting_users:
-                 del self.waiting_users[current_session_key]
+             self._end_draw_session(current_session_key)
              yield event.plain_result("您的 /draw 会话状态异常，请重试。")
              return
 
         # 存储本次消息的内容
         # 只有在文本或图片非空时才记录，避免空消息污染
-        if current_text_for_prompt or current_images_pil:
-            message_data = {
-              'text': current_text_for_prompt, # Store raw text, keyword removal happens at generation
-              'images': current_images_pil,   # Store PIL images
-              'timestamp': time.time()
-            }
-            self.user_inputs[current_session_key]['messages'].append(message_data)
-            logger.debug(f"collect_user_inputs: Stored message for /draw session {current_session_key}. Text: '{current_text_for_prompt[:30]}...', Images: {len(current_images_pil)}")
+        if current_text_for_prompt or current_image_refs:
+            session_inputs = self.user_inputs[current_session_key]
+            message_bytes = len(current_text_for_prompt.encode("utf-8")) + sum(len(ref) for ref in current_image_refs)
+            if session_inputs['bytes'] + message_bytes > self.draw_session_max_bytes:
+                logger.warning(f"collect_user_inputs: /draw 会话 {current_session_key} 超过 {self.draw_session_max_bytes} 字节上限，已忽略本条消息。")
+                yield event.plain_result("本次 /draw 会话收集的内容已达上限，这条消息未被记录。发送包含'start'或'开始'的消息即可开始生成。")
+                if not contains_keyword:
+                    return
+            else:
+                message_data = {
+                  'text': current_text_for_prompt, # Store raw text, keyword removal happens at generation
+                  'images': current_image_refs,    # Store image refs, downloaded at generation
+                  'timestamp': time.time()
+                }
+                session_inputs['messages'].append(message_data)
+                session_inputs['bytes'] += message_bytes
+                logger.debug(f"collect_user_inputs: Stored message for /draw session {current_session_key}. Text: '{current_text_for_prompt[:30]}...', Images: {len(current_image_refs)}")
 
 
         if contains_keyword:
@@ -704,7 +1272,7 @@ class GeminiArtist(Star):
             collected_session_messages.sort(key=lambda x: x['timestamp'])
 
             all_text_parts = []
-            all_pil_images_for_api: List[PILImage.Image] = []
+            all_image_refs: List[str] = []
 
             for msg_data in collected_session_messages:
                 text_part = msg_data.get('text', '')
@@ -715,17 +1283,39 @@ class GeminiArtist(Star):
                 if text_part:
                     all_text_parts.append(text_part)
                 
-                all_pil_images_for_api.extend(msg_data.get('images', [])) # images are already PIL
+                all_image_refs.extend(msg_data.get('images', []))
 
             final_prompt_text = '\n'.join(all_text_parts).strip()
+            variant_count = self.user_inputs[current_session_key].get('count', 1)
 
             # 清理会话状态
-            del self.waiting_users[current_session_key]
-            del self.user_inputs[current_session_key]
+            self._end_draw_session(current_session_key)
+
+            # 端到端截止时间从收到开始指令时起算
+            deadline = RequestDeadline(self.request_timeout_seconds)
+            self.tracer.start("draw", user=user_id, group=str(current_group_id), images=len(all_image_refs), count=variant_count)
+
+            # 并发下载并解码会话中收集的图片
+            all_pil_images_for_api: List[PILImage.Image] = []
+            if all_image_refs:
+                try:
+                    loaded_images = await deadline.run(self.load_pil_images_concurrently(all_image_refs, "用户为/draw会话发送的图片"))
+                except RequestTimeoutError:
+                    yield event.plain_result(self._format_timeout_message())
+                    return
+                all_pil_images_for_api = [img for img in loaded_images if img is not None]
+                failed_count = len(all_image_refs) - len(all_pil_images_for_api)
+                if failed_count:
+                    logger.warning(f"collect_user_inputs (/draw): {failed_count}/{len(all_image_refs)} 张会话图片加载失败 (key {current_session_key})。")
+                    yield event.plain_result(f"有 {failed_count} 张图片无法处理（下载或转换失败），已忽略。")
 
             # 如果没有任何用户提供的参考图，则尝试加载默认参考图
             if not all_pil_images_for_api and self.enable_base_reference_image:
-                base_image = self._load_base_reference_image()
+                try:
+                    base_image = await deadline.run(self._load_base_reference_image())
+                except RequestTimeoutError:
+                    yield event.plain_result(self._format_timeout_message())
+                    return
                 if base_image:
                     all_pil_images_for_api.append(base_image)
                     logger.info("已使用默认参考图。")
@@ -734,19 +1324,23 @@ class GeminiArtist(Star):
                 yield event.plain_result("您没有提供任何文本描述或图片内容给 /draw 会话。")
                 return
 
-            yield event.plain_result("收到开始指令，正在为您生成图片，请稍候...")
-            
+            admission_ticket = self.admission.enqueue(str(current_group_id))
             try:
+                yield event.plain_result(self._format_variant_hint("收到开始指令，正在为您生成图片", variant_count) + "，请稍候..." + self._format_queue_hint(admission_ticket))
                 # 调用核心的 API 生成方法
                 logger.debug(f"collect_user_inputs: Calling API generate for /draw session (API类型: {self.api_type}). Prompt: '{final_prompt_text[:50]}...', Images: {len(all_pil_images_for_api)}")
-                
-                # 根据API类型调用相应的生成方法
-                if self.api_type == "OpenRouter":
-                    api_result = await self.openrouter_generate(final_prompt_text, all_pil_images_for_api)
-                else:
-                    # 默认使用 Google Gemini API
-                    api_result = await self.gemini_generate(final_prompt_text, all_pil_images_for_api)
-                
+
+                api_result = None
+                async for kind, payload in self._generate_images_streaming(final_prompt_text, all_pil_images_for_api, admission_ticket, str(current_group_id), deadline, entry="draw", count=variant_count):
+                    if kind == 'text':
+                        yield event.plain_result(payload)
+                    elif kind == 'image':
+                        send_started = time.monotonic()
+                        yield event.chain_result([Image.fromFileSystem(payload)])
+                        self._observe_stage("message_send", send_started)
+                    else:
+                        api_result = payload
+
                 if api_result is None or not isinstance(api_result, dict): # Should be caught by gemini_generate raising error
                     logger.error(f"collect_user_inputs: gemini_generate 返回无效结果 for /draw session: {type(api_result)}")
                     yield event.plain_result("处理图片时发生内部错误（生成器未返回有效数据）。")
@@ -767,7 +1361,8 @@ class GeminiArtist(Star):
                                 str(self.robot_id_from_config), # Image belongs to the bot
                                 str(current_group_id),        # In the current chat context
                                 img_path,                   # Store the local file path
-                                f"draw_cmd_generated_{i+1}_{os.path.basename(img_path)}"
+                                f"draw_cmd_generated_{i+1}_{os.path.basename(img_path)}",
+                                is_bot=True
                             )
 
                 if not text_response and not image_paths:
@@ -775,6 +1370,10 @@ class GeminiArtist(Star):
                     yield event.plain_result("未能从API获取任何文本或图片内容。")
                     return
 
+                # 流式生成时图文已在生成过程中逐条发送
+                if api_result.get('streamed'):
+                    return
+
                 # 发送结果给用户 (旧版的发送逻辑)
                 if len(image_paths) < 2: # 单图或无图（只有文本）
                     chain_to_send = []
@@ -785,7 +1384,9 @@ class GeminiArtist(Star):
                             chain_to_send.append(Image.fromFileSystem(img_path))
                     
                     if chain_to_send:
+                        send_started = time.monotonic()
                         yield event.chain_result(chain_to_send)
+                        self._observe_stage("message_send", send_started)
                     else: # Should not happen if previous checks pass
                         yield event.plain_result("抱歉，未能生成有效内容。")
                 else: # 多张图片，使用 Nodes 合并发送
@@ -797,7 +1398,9 @@ class GeminiArtist(Star):
                         if text_response: yield event.plain_result(text_response)
                         for img_path in image_paths:
                             if img_path and os.path.exists(img_path) and os.path.getsize(img_path) > 0:
+                                send_started = time.monotonic()
                                 yield event.chain_result([Image.fromFileSystem(img_path)])
+                                self._observe_stage("message_send", send_started)
                         return
 
                     bot_name_for_node = str(self.config.get("bot_name", "绘图助手")).strip() or "绘图助手"
@@ -824,27 +1427,391 @@ class GeminiArtist(Star):
                             ))
                     
                     if nodes_message_list:
+                        send_started = time.monotonic()
                         yield event.chain_result([Nodes(nodes_message_list)])
+                        self._observe_stage("message_send", send_started)
                     else:
                         yield event.plain_result("抱歉，未能生成有效内容进行合并转发。")
                 return
 
+            except RequestTimeoutError:
+                logger.warning(f"collect_user_inputs (/draw): 请求超过 {self.request_timeout_seconds} 秒的截止时间，已取消。")
+                yield event.plain_result(self._format_timeout_message())
+                return
             except Exception as e_gen:
                 logger.error(f"collect_user_inputs (/draw): 在 /draw 会话的生成或回复阶段发生错误: {str(e_gen)}", exc_info=True)
                 yield event.plain_result(f"处理您的 /draw 请求时发生错误: {str(e_gen)}")
                 # Ensure session is cleaned up on error too
-                if current_session_key in self.waiting_users: del self.waiting_users[current_session_key]
-                if current_session_key in self.user_inputs: del self.user_inputs[current_session_key]
+                self._end_draw_session(current_session_key)
                 return
+            finally:
+                admission_ticket.release()
         
         else: # 未包含触发关键词，且不是命令
-            if current_text_for_prompt.strip() or current_images_pil: 
-                logger.debug(f"collect_user_inputs (/draw): 未检测到开始指令 (key {current_session_key})，收到输入: text='{current_text_for_prompt[:30]}...', images_count={len(current_images_pil)}")
+            if current_text_for_prompt.strip() or current_image_refs: 
+                logger.debug(f"collect_user_inputs (/draw): 未检测到开始指令 (key {current_session_key})，收到输入: text='{current_text_for_prompt[:30]}...', images_count={len(current_image_refs)}")
                 yield event.plain_result("已收到您的输入，请继续发送或发送包含'start'或'开始'的消息结束您的 /draw 会话。")
             # else: (空消息，不回复)
             #    logger.debug(f"collect_user_inputs (/draw): 收到空消息，不含开始指令 (key {current_session_key})，已忽略。")
 
 
+    @staticmethod
+    def _format_llm_feedback(text_response: str, image_count: int, used_default_image: bool) -> str:
+        """构建 gemini_draw 工具返回给LLM的JSON反馈 (图片已发送给用户)。"""
+        llm_feedback = f"你生成了 {image_count} 张图片。"
+        if used_default_image:
+            llm_feedback += "由于用户没有提供参考图，你使用了插件预设的默认参考图进行创作。"
+        llm_feedback += ("这些图片已经发送给用户，并且用户可以通过图片索引（例如，image_index=1 代表最新生成的这张/这些图片）来引用它们进行后续操作。"
+                         "请根据用户的原始意图和这些新生成的图文内容继续对话。")
+        return json.dumps({
+            "generated_text": text_response,
+            "number_of_images_generated": image_count,
+            "user_instruction_for_llm": llm_feedback
+        }, ensure_ascii=False)
+
+    def _format_timeout_message(self) -> str:
+        return f"生成超时（超过 {self.request_timeout_seconds} 秒），已取消本次请求，请稍后重试。"
+
+    def _clamp_variant_count(self, count) -> int:
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            count = 1
+        return max(1, min(count, self.max_variants))
+
+    @staticmethod
+    def _format_variant_hint(message: str, count: int) -> str:
+        return f"{message} ({count} 个变体)" if count > 1 else message
+
+    def _format_queue_hint(self, admission_ticket: AdmissionTicket) -> str:
+        """
+        生成排队提示；请求已获得执行名额时返回空字符串。
+        """
+        position = admission_ticket.position()
+        if position <= 0:
+            return ""
+        hint = f"\n当前排队第 {position} 位"
+        estimated_wait = admission_ticket.estimated_wait_seconds()
+        if estimated_wait is not None:
+            hint += f"，预计等待约 {int(math.ceil(estimated_wait))} 秒"
+        return hint + "。"
+
+    def _result_cache_enabled_for(self, group_id: str) -> bool:
+        return self.result_cache is not None and str(group_id) in self.result_cache_groups
+
+    async def _generate_images(self, text_prompt: str, images_pil: List[PILImage.Image], admission_ticket: AdmissionTicket, group_id: str, on_part=None, count: int = 1) -> Dict[str, Any]:
+        """
+        获得准入名额后根据API类型调用相应的生成方法。
+        - 启用结果缓存的群组在有效期内重复相同请求时直接返回缓存的结果；
+        - 启用请求合并时，相同输入的并发请求只调用一次上游并共享结果；
+        - 传入 on_part 时 Gemini 以流式方式生成，见 _generate_images_streaming；
+        - count 大于 1 时并发生成多个变体 (见 _generate_variants)，整个请求占用一个准入名额，不使用结果缓存与请求合并。
+        """
+        async def _run(ticket: AdmissionTicket) -> Dict[str, Any]:
+            async with ticket:
+                if count > 1:
+                    return await self._generate_variants(text_prompt, images_pil, count, on_part)
+                if self.api_type == "OpenRouter":
+                    return await self.openrouter_generate(text_prompt, images_pil)
+                # 默认使用 Google Gemini API
+                return await self.gemini_generate(text_prompt, images_pil, on_part)
+
+        use_result_cache = self._result_cache_enabled_for(group_id)
+        if count > 1 or (self.request_coalescer is None and not use_result_cache):
+            return await _run(admission_ticket)
+
+        async def _run_shared() -> Dict[str, Any]:
+            # 在合并调用的独立任务中申请自己的名额：请求方被取消或超时不会连带取消共享调用，
+            # 也不会在上游调用仍在进行时提前归还名额
+            return await _run(self.admission.enqueue(group_id))
+
+        shared = False
+        try:
+            digests = await self.image_pool.run(image_digests, images_pil)
+            key = generation_cache_key(self.api_type, self.model_name_from_config, text_prompt, digests)
+            if use_result_cache:
+                cached_result = await asyncio.to_thread(self.result_cache.get, key)
+                if cached_result:
+                    self.temp_storage.register_many(cached_result['image_paths'])
+                    logger.info(f"生成结果缓存命中 (群组 {group_id})，直接返回 {len(cached_result['image_paths'])} 张缓存图片。")
+                    return cached_result
+            if self.request_coalescer:
+                # 等待共享结果期间不占用自己的名额
+                admission_ticket.release()
+                result, shared = await self.request_coalescer.run(key, _run_shared)
+                if shared:
+                    logger.info(f"已合并相同的进行中生成请求，共享其 {len(result.get('image_paths', []))} 张图片。")
+                    # 共享结果未经本请求流式推送，需由调用方完整发送
+                    result = {'text': result.get('text', ''), 'image_paths': list(result.get('image_paths', []))}
+            else:
+                result = await _run(admission_ticket)
+        finally:
+            # 命中缓存或共享他人结果的请求从未使用自己的名额，在此归还
+            admission_ticket.release()
+
+        if use_result_cache and not shared and result.get('image_paths'):
+            try:
+                await asyncio.to_thread(self.result_cache.put, key, result)
+            except Exception as e:
+                logger.warning(f"写入生成结果缓存失败: {e}")
+        return result
+
+    async def _generate_images_streaming(self, text_prompt: str, images_pil: List[PILImage.Image], admission_ticket: AdmissionTicket, group_id: str, deadline: RequestDeadline, entry: str = "gemini_draw", count: int = 1) -> AsyncGenerator[Tuple[str, Any], None]:
+        """
+        边生成边产出 ('text', 文本段落) 与 ('image', 图片路径)，最后产出 ('result', 完整结果)。
+        完整结果中 streamed 为 True 表示内容已逐段产出，调用方无需再次发送；
+        未启用流式生成、使用 OpenRouter (多变体除外)、命中缓存或共享他人结果时只产出 ('result', ...)。
+        超过 deadline 时取消生成并抛出 RequestTimeoutError。
+        请求结果与从 deadline 起算的耗时按 entry (入口) 记入指标。
+        """
+        outcome = None
+        stream = self._stream_generation(text_prompt, images_pil, admission_ticket, group_id, deadline, count)
+        try:
+            async for kind, payload in stream:
+                if kind == 'result':
+                    outcome = "success" if payload.get('image_paths') else "no_image"
+                    self._record_request(entry, outcome, deadline)
+                yield kind, payload
+        except RequestTimeoutError:
+            outcome = "timeout"
+            self._record_request(entry, outcome, deadline)
+            raise
+        except Exception as e:
+            outcome = "safety" if isinstance(e, SafetyBlockedError) else "error"
+            self._record_request(entry, outcome, deadline)
+            raise
+        finally:
+            await stream.aclose()
+            if outcome is None:
+                self._record_request(entry, "cancelled", deadline)
+
+    def _record_request(self, entry: str, outcome: str, deadline: RequestDeadline) -> None:
+        trace = current_trace()
+        if trace is not None:
+            trace.result = outcome
+        self.metrics.requests.inc(entry=entry, outcome=outcome)
+        self.metrics.request_seconds.observe(deadline.elapsed(), entry=entry, outcome=outcome)
+
+    async def _stream_generation(self, text_prompt: str, images_pil: List[PILImage.Image], admission_ticket: AdmissionTicket, group_id: str, deadline: RequestDeadline, count: int = 1) -> AsyncGenerator[Tuple[str, Any], None]:
+        # 多变体按完成顺序推送整张图片，不依赖 Gemini 的流式接口
+        if not self.enable_streaming or (self.api_type == "OpenRouter" and count == 1):
+            yield 'result', await deadline.run(self._generate_images(text_prompt, images_pil, admission_ticket, group_id, count=count))
+            return
+
+        parts: asyncio.Queue = asyncio.Queue()
+
+        async def on_part(kind: str, payload: Any) -> None:
+            await parts.put((kind, payload))
+
+        task = asyncio.create_task(self._generate_images(text_prompt, images_pil, admission_ticket, group_id, on_part, count))
+        getter = None
+        try:
+            while True:
+                getter = asyncio.ensure_future(parts.get())
+                done, _ = await asyncio.wait({getter, task}, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 等待取消完成，确保未发送的临时文件已被清理
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    raise deadline.error()
+                if getter not in done:
+                    break
+                yield getter.result()
+            while not parts.empty():
+                yield parts.get_nowait()
+            yield 'result', task.result()
+        finally:
+            if getter is not None and not getter.done():
+                getter.cancel()
+            if not task.done():
+                task.cancel()
+
+    def _record_upstream_call(self, key_idx: int, outcome: str, seconds: float) -> None:
+        """按 API 类型、密钥序号 (不记录密钥本身)、模型与结果记录一次上游调用。"""
+        labels = {"api": self.api_type, "key": key_idx, "model": self.model_name_from_config, "outcome": outcome}
+        self.metrics.upstream_calls.inc(**labels)
+        self.metrics.upstream_seconds.observe(seconds, **labels)
+        self._observe_stage("upstream_call", time.monotonic() - seconds, key=key_idx, outcome=outcome)
+
+    def _record_saved_image(self, temp_fp: str, started: float) -> None:
+        """登记新保存的生成图片，并记录保存耗时与字节数。"""
+        self.temp_storage.register(temp_fp)
+        self.metrics.images_generated.inc(api=self.api_type, model=self.model_name_from_config)
+        try:
+            size = os.path.getsize(temp_fp)
+        except OSError:
+            size = 0
+        self.metrics.bytes.inc(size, direction="in", kind="generated_image")
+        self._observe_stage("result_save", started, bytes=size)
+
+    async def _run_key_attempt(self, api_name: str, key_idx: int, attempt_func) -> Dict[str, Any]:
+        """
+        使用指定索引的 API Key 执行一次调用，并将结果反馈给调度器与对冲策略。
+        """
+        attempt_started = time.monotonic()
+        try:
+            result = await attempt_func(self.api_keys[key_idx])
+        except asyncio.CancelledError:
+            logger.info(f"{trace_tag()}{api_name}: 密钥 {key_idx} 的请求已取消。")
+            self._record_upstream_call(key_idx, "cancelled", time.monotonic() - attempt_started)
+            raise
+        except GenerationContentError as e:
+            # 调用本身成功，内容问题与 Key 无关
+            logger.warning(f"{trace_tag()}{api_name}: 密钥 {key_idx} 返回内容不可用: {e}")
+            self.key_scheduler.record_success(key_idx, time.monotonic() - attempt_started)
+            self._record_upstream_call(key_idx, classify_retry_error(e)[0], time.monotonic() - attempt_started)
+            raise
+        except Exception as e:
+            logger.error(f"{trace_tag()}{api_name}: API处理失败 (密钥 {key_idx}): {str(e)}", exc_info=True)
+            self.key_scheduler.record_failure(key_idx, time.monotonic() - attempt_started, e)
+            self._record_upstream_call(key_idx, classify_retry_error(e)[0], time.monotonic() - attempt_started)
+            raise
+        latency = time.monotonic() - attempt_started
+        self._record_upstream_call(key_idx, "success", latency)
+        self.key_scheduler.record_success(key_idx, latency)
+        if self.hedge_policy:
+            self.hedge_policy.record_latency(latency)
+        return result
+
+    async def _generate_with_retry(self, api_name: str, attempt_func, allow_hedge: bool = True, key_spread: int = 0) -> Dict[str, Any]:
+        """
+        按统一重试策略执行 _generate_with_key_failover：每轮失败后按错误类别的重试次数、
+        指数退避与全抖动 (或 Retry-After) 决定是否重试，整个请求受同一截止时间约束。
+        无图片的重试次数用尽时返回最后一次的响应内容。key_spread 见 ApiKeyScheduler.order。
+        """
+        retry_state = self.retry_policy.start()
+        while True:
+            try:
+                return await asyncio.wait_for(
+                    self._generate_with_key_failover(api_name, attempt_func, allow_hedge, key_spread),
+                    timeout=retry_state.remaining()
+                )
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError) and retry_state.remaining() == 0:
+                    raise asyncio.TimeoutError(f"生成请求超过重试截止时间 ({self.retry_policy.deadline_seconds} 秒)") from e
+                if isinstance(e, InvalidImageDataError):
+                    logger.error(f"{trace_tag()}{api_name}: {e}，不再重试。")
+                    raise
+                delay = retry_state.next_delay(e)
+                if delay is None:
+                    if isinstance(e, NoImageError) and e.result is not None:
+                        logger.warning(f"{api_name}: 重试后仍未生成图片，返回最后一次的响应内容。")
+                        return e.result
+                    raise
+                self.retry_policy.retries += 1
+                kind, _ = classify_retry_error(e)
+                record_event("retry", attempt=retry_state.attempts, kind=kind, delay=round(delay, 2), error=str(e)[:200])
+                logger.info(f"{trace_tag()}{api_name}: 第 {retry_state.attempts} 次重试 (错误类别 {kind})，{delay:.1f} 秒后重试: {e}")
+                await asyncio.sleep(delay)
+
+    async def _generate_with_key_failover(self, api_name: str, attempt_func, allow_hedge: bool = True, key_spread: int = 0) -> Dict[str, Any]:
+        """
+        按调度器给出的顺序依次用各 API Key 调用 attempt_func(api_key)，直到成功。
+        启用对冲请求时，若当前请求超过对冲延迟仍未完成，会在下一个 Key 上并行发起一次对冲请求，
+        先返回结果者胜出，另一个请求被取消。流式请求会边生成边推送，需传入 allow_hedge=False。
+        """
+        if not self.api_keys:
+            raise ValueError("没有配置API密钥 (api_keys)")
+        key_indices_to_try = deque(self.key_scheduler.order(key_spread))
+        max_retries = len(key_indices_to_try)
+        hedge_enabled = allow_hedge and self.hedge_policy is not None and max_retries > 1
+        if hedge_enabled:
+            self.hedge_policy.note_request()
+
+        last_exception = None
+        pending: Dict[asyncio.Task, Tuple[int, bool]] = {}  # task -> (key_idx, is_hedge)
+        attempt_num = 0
+        hedge_considered = False
+
+        def launch(is_hedge: bool = False) -> None:
+            nonlocal attempt_num
+            key_idx = key_indices_to_try.popleft()
+            attempt_num += 1
+            logger.info(f"{trace_tag()}{api_name}: 尝试API密钥索引 {key_idx} (尝试 {attempt_num}/{max_retries}{', 对冲请求' if is_hedge else ''})")
+            task = asyncio.create_task(self._run_key_attempt(api_name, key_idx, attempt_func))
+            pending[task] = (key_idx, is_hedge)
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if hedge_enabled and not hedge_considered and key_indices_to_try:
+                    timeout = self.hedge_policy.delay()
+                done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 每个请求最多对冲一次
+                    hedge_considered = True
+                    if self.hedge_policy.try_acquire():
+                        record_event("hedge", key=key_indices_to_try[0])
+                        logger.info(f"{trace_tag()}{api_name}: 请求超过 {timeout:.1f} 秒仍未完成，在下一个API密钥上发起对冲请求。")
+                        launch(is_hedge=True)
+                    else:
+                        logger.debug(f"{api_name}: 对冲预算不足，继续等待当前请求。")
+                    continue
+                for task in done:
+                    key_idx, is_hedge = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        last_exception = e
+                        continue
+                    if is_hedge:
+                        self.hedge_policy.hedges_won += 1
+                    return result
+                # 内容类错误换 Key 也无济于事，交给重试策略处理
+                if not pending and key_indices_to_try and not isinstance(last_exception, GenerationContentError):
+                    logger.info(f"{trace_tag()}{api_name}: 尝试下个API密钥 (下个索引: {key_indices_to_try[0]})")
+                    launch()
+        finally:
+            # 取消仍在进行的落后请求
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if isinstance(last_exception, GenerationContentError):
+            raise last_exception
+        logger.error(f"{api_name}: 所有API密钥均尝试失败。")
+        if last_exception:
+            raise last_exception
+        logger.error(f"{api_name}: 未能从API获取数据且无明确异常。")
+        raise ValueError("API处理失败，无可用密钥或未记录错误。")
+
+    async def _encode_reference_images(self, images_pil: List[PILImage.Image], alpha_format: str) -> List[Tuple[bytes, str]]:
+        """
+        按当前模型的尺寸限制缩小参考图并重新编码，返回 [(图片字节, MIME 类型)]。
+        处理失败的图片会被跳过。
+        """
+        max_side, max_pixels = self.reference_image_model_limits.get(
+            self.model_name_from_config,
+            (self.reference_image_max_side, self.reference_image_max_pixels)
+        )
+        if not images_pil:
+            return []
+        with self._stage("upload_encode", sizes=[f"{img.width}x{img.height}" for img in images_pil]) as trace_span:
+            encoded = await self.image_pool.run(
+                encode_reference_images, images_pil, max_side, max_pixels, alpha_format, self.reference_image_jpeg_quality
+            )
+            if trace_span is not None:
+                trace_span.attrs["bytes"] = [len(img_bytes) for img_bytes, _ in encoded]
+        self.metrics.bytes.inc(sum(len(img_bytes) for img_bytes, _ in encoded), direction="out", kind="reference_upload")
+        return encoded
+
+    def _resolve_openai_base_url(self) -> str:
+        """
+        返回 OpenAI 兼容接口的 base_url；OpenRouter 地址会自动补全为 /api/v1。
+        """
+        base_url = self.api_base_url_from_config
+        # 检查是否是 OpenRouter（通过 URL 判断）
+        if 'openrouter' in base_url.lower():
+            # OpenRouter 使用 chat completions 端点
+            if not base_url.endswith('/v1') and not base_url.endswith('/v1/'):
+                if base_url.endswith('/'):
+                    base_url = base_url + 'api/v1'
+                else:
+                    base_url = base_url + '/api/v1'
+        return base_url
+
     async def openrouter_generate(self, text_prompt: str, images_pil: Optional[List[PILImage.Image]] = None):
         """
         调用OpenAI格式的API生成图片。
@@ -852,274 +1819,356 @@ class GeminiArtist(Star):
         """
         if not self.api_keys:
             raise ValueError("没有配置API密钥 (api_keys)")
+        message_content = await self._build_openrouter_content(text_prompt, images_pil or [])
+        return await self._generate_with_retry(
+            "openrouter_generate",
+            functools.partial(self._openrouter_generate_with_key, text_prompt, message_content)
+        )
+
+    async def _build_openrouter_content(self, text_prompt: str, images_pil: List[PILImage.Image]) -> List[Dict[str, Any]]:
+        """
+        构建 chat completions 的消息内容。参考图只编码一次，所有 Key 的尝试、对冲请求与变体共用。
+        """
+        message_content = []
         
-        images_pil = images_pil or []
-        max_retries, last_exception = len(self.api_keys), None
-        key_indices_to_try = list(range(len(self.api_keys)))
-        
-        if self.random_api_key_selection:
-            random.shuffle(key_indices_to_try)
-        else:
-            key_indices_to_try = [(self.current_api_key_index + i) % len(self.api_keys) for i in range(len(self.api_keys))]
-        
-        for attempt_num, key_idx_to_use in enumerate(key_indices_to_try):
-            current_key_to_try = self.api_keys[key_idx_to_use]
-            try:
-                logger.info(f"openrouter_generate: 尝试API密钥索引 {key_idx_to_use} (尝试 {attempt_num + 1}/{max_retries})")
-                
-                # 创建 OpenAI 客户端
-                # 确保 base_url 格式正确
-                base_url = self.api_base_url_from_config
-                
-                # 检查是否是 OpenRouter（通过 URL 判断）
-                is_openrouter = 'openrouter' in base_url.lower()
-                
-                if is_openrouter:
-                    # OpenRouter 使用 chat completions 端点
-                    if not base_url.endswith('/v1') and not base_url.endswith('/v1/'):
-                        if base_url.endswith('/'):
-                            base_url = base_url + 'api/v1'
-                        else:
-                            base_url = base_url + '/api/v1'
-                    
-                    logger.info(f"使用 OpenRouter base_url: {base_url}")
-                    
-                    client = OpenAI(
-                        api_key=current_key_to_try,
-                        base_url=base_url
-                    )
-                    
-                    # OpenRouter 使用 chat.completions 生成图片
-                    logger.info(f"调用 OpenRouter chat completions，模型: {self.model_name_from_config}, 提示词: {text_prompt[:50]}...")
-                    
-                    # 构建消息内容
-                    message_content = []
-                    
-                    # 添加文本提示
-                    message_content.append({
-                        "type": "text",
-                        "text": text_prompt
-                    })
-                    
-                    # 如果有参考图片，添加到消息中（OpenRouter 支持多模态输入）
-                    if images_pil:
-                        logger.info(f"将 {len(images_pil)} 张参考图片加入 OpenRouter 请求上下文")
-                        for idx, img in enumerate(images_pil):
-                            try:
-                                # 将 PIL 图片转换为 base64
-                                buffered = BytesIO()
-                                img.save(buffered, format="PNG")
-                                img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                                
-                                # 添加图片到消息
-                                message_content.append({
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/png;base64,{img_base64}"
-                                    }
-                                })
-                                logger.debug(f"成功添加第 {idx + 1} 张参考图片到请求")
-                            except Exception as e:
-                                logger.error(f"处理参考图片 {idx + 1} 失败: {e}")
-                    
-                    result = {'text': '', 'image_paths': []}
-                    
-                    # 重试机制：能需要多次尝试才能生成图片
-                    max_generation_retries = 5
-                    retry_delay = 3  # 秒
-                    
-                    for generation_attempt in range(max_generation_retries):
-                        if generation_attempt > 0:
-                            logger.info(f"第 {generation_attempt + 1} 次尝试生成图片...")
-                            await asyncio.sleep(retry_delay)
-                        
-                        # 发送请求
-                        response = await asyncio.to_thread(
-                            client.chat.completions.create,
-                            model=self.model_name_from_config,
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": message_content if len(message_content) > 1 else text_prompt
-                                }
-                            ]
-                        )
-                        
-                        # 处理 OpenRouter 的响应
-                        if response.choices and len(response.choices) > 0:
-                            choice = response.choices[0]
-                            message = choice.message
-                            
-                            # 打印调试信息
-                            # logger.debug(f"OpenRouter message 对象: {message}")
-                            
-                            # 处理文本内容
-                            text_content = ""
-                            if hasattr(message, 'content') and message.content:
-                                text_content = message.content
-                                logger.debug(f"找到文本内容: {text_content[:100]}...")
-                            
-                            # 处理图片 - OpenRouter 在 message.images 字段返回图片
-                            if hasattr(message, 'images') and message.images:
-                                logger.info(f"找到 {len(message.images)} 张图片在 message.images 字段")
-                                
-                                for img_item in message.images:
-                                    if isinstance(img_item, dict):
-                                        # 获取图片数据
-                                        image_data = None
-                                        
-                                        # 检查不同的可能格式
-                                        if img_item.get('type') == 'image_url' and 'image_url' in img_item:
-                                            image_url_obj = img_item['image_url']
-                                            if isinstance(image_url_obj, dict) and 'url' in image_url_obj:
-                                                image_data = image_url_obj['url']
-                                        elif 'url' in img_item:
-                                            image_data = img_item['url']
-                                        elif 'data' in img_item:
-                                            image_data = img_item['data']
-                                        
-                                        if image_data:
-                                            # 处理 data URL (base64)
-                                            if image_data.startswith('data:image'):
-                                                try:
-                                                    # 提取 base64 数据
-                                                    header, encoded = image_data.split(',', 1)
-                                                    img_bytes = base64.b64decode(encoded)
-                                                    img_pil = PILImage.open(BytesIO(img_bytes))
-                                                    
-                                                    # 保存图片
-                                                    os.makedirs(self.temp_dir, exist_ok=True)
-                                                    temp_fp = os.path.join(
-                                                        self.temp_dir,
-                                                        f"openrouter_gen_{time.time()}_{random.randint(100,999)}.png"
-                                                    )
-                                                    img_pil.save(temp_fp)
-                                                    result['image_paths'].append(temp_fp)
-                                                    logger.info(f"OpenRouter 生成并保存图片(base64): {temp_fp}")
-                                                except Exception as e:
-                                                    logger.error(f"处理 base64 图片失败: {e}")
-                                
-                                # 检查是否成功生成了图片，如果有则跳出重试循环
-                                if result['image_paths']:
-                                    logger.info(f"成功生成 {len(result['image_paths'])} 张图片，停止重试")
-                                    break
-                        
-                        # 如果有图片生成成功，也要跳出外层的重试循环
-                        if result['image_paths']:
-                            break
-                    
-                    # 结束所有重试后，检查结果
-                    if not result['image_paths']:
-                        logger.warning(f"经过 {max_generation_retries} 次尝试后仍未生成图片")
-                    
-                if not self.random_api_key_selection:
-                    self.current_api_key_index = (key_idx_to_use + 1) % len(self.api_keys)
-                return result
-                    
-            except Exception as e:
-                logger.error(f"openrouter_generate: API处理失败 (密钥 {key_idx_to_use}): {str(e)}", exc_info=True)
-                last_exception = e
-                
-            if attempt_num < max_retries - 1:
-                logger.info(f"openrouter_generate: 尝试下个API密钥 (下个索引: {key_indices_to_try[attempt_num+1]})")
-            else:
-                logger.error("openrouter_generate: 所有API密钥均尝试失败。")
+        # 添加文本提示
+        message_content.append({
+            "type": "text",
+            "text": text_prompt
+        })
         
-        if last_exception:
-            raise last_exception
-        logger.error("openrouter_generate: 未能从API获取数据且无明确异常。")
-        raise ValueError("OpenAI API处理失败，无可用密钥或未记录错误。")
+        # 如果有参考图片，添加到消息中（OpenRouter 支持多模态输入）
+        if images_pil:
+            logger.info(f"将 {len(images_pil)} 张参考图片加入 OpenRouter 请求上下文")
+            # 透明图片使用 PNG，兼容更多 OpenAI 格式的服务
+            for idx, (img_bytes, mime_type) in enumerate(await self._encode_reference_images(images_pil, "PNG")):
+                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+
+                # 添加图片到消息
+                message_content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{img_base64}"
+                    }
+                })
+                logger.debug(f"成功添加第 {idx + 1} 张参考图片到请求")
+        return message_content
+
+    async def _openrouter_generate_with_key(self, text_prompt: str, message_content: List[Dict[str, Any]], api_key: str) -> Dict[str, Any]:
+        """
+        使用单个 API Key 调用 chat completions 生成图片。
+        """
+        client = self.api_client_pool.get_openai_client(api_key, self._resolve_openai_base_url())
+
+        # OpenRouter 使用 chat.completions 生成图片
+        logger.info(f"调用 OpenRouter chat completions，模型: {self.model_name_from_config}, 提示词: {text_prompt[:50]}...")
+
+        result = {'text': '', 'image_paths': []}
+
+        # 发送请求；未生成图片等情况的重试由统一重试策略处理
+        response = await client.chat.completions.create(
+            model=self.model_name_from_config,
+            messages=[
+                {
+                    "role": "user",
+                    "content": message_content if len(message_content) > 1 else text_prompt
+                }
+            ]
+        )
 
-    async def gemini_generate(self, text_prompt: str, images_pil: Optional[List[PILImage.Image]] = None):
+        try:
+            # 处理 OpenRouter 的响应
+            if response.choices and len(response.choices) > 0:
+                choice = response.choices[0]
+                message = choice.message
+
+                if getattr(choice, 'finish_reason', None) == 'content_filter':
+                    raise SafetyBlockedError("内容因安全策略被阻止 (finish_reason: content_filter)")
+
+                # 处理文本内容
+                if hasattr(message, 'content') and message.content:
+                    result['text'] = message.content
+                    logger.debug(f"找到文本内容: {message.content[:100]}...")
+
+                # 处理图片 - OpenRouter 在 message.images 字段返回图片
+                if hasattr(message, 'images') and message.images:
+                    logger.info(f"找到 {len(message.images)} 张图片在 message.images 字段")
+
+                    for img_item in message.images:
+                        if isinstance(img_item, dict):
+                            # 获取图片数据
+                            image_data = None
+
+                            # 检查不同的可能格式
+                            if img_item.get('type') == 'image_url' and 'image_url' in img_item:
+                                image_url_obj = img_item['image_url']
+                                if isinstance(image_url_obj, dict) and 'url' in image_url_obj:
+                                    image_data = image_url_obj['url']
+                            elif 'url' in img_item:
+                                image_data = img_item['url']
+                            elif 'data' in img_item:
+                                image_data = img_item['data']
+
+                            # 处理 data URL (base64)
+                            if image_data and image_data.startswith('data:image'):
+                                try:
+                                    # 直接写入原始字节，不解码重编码
+                                    save_started = time.monotonic()
+                                    temp_fp = await self.image_pool.run(write_data_url_image, image_data, self.temp_storage.shard_dir(), "openrouter_gen", discard=remove_file_quietly)
+                                    result['image_paths'].append(temp_fp)
+                                    self._record_saved_image(temp_fp, save_started)
+                                    logger.info(f"OpenRouter 生成并保存图片(base64): {temp_fp}")
+                                except Exception as e:
+                                    logger.error(f"处理 base64 图片失败: {e}")
+        except BaseException:
+            self._discard_partial_images(result)
+            raise
+
+        if not result['image_paths']:
+            raise NoImageError("OpenRouter 响应中没有图片", result)
+        logger.info(f"成功生成 {len(result['image_paths'])} 张图片")
+        return result
+
+    def _discard_partial_images(self, result: Dict[str, Any]) -> None:
+        """请求被取消 (超时、对冲落败) 或出错时，删除本次已写入的图片。"""
+        for image_path in result.get('image_paths', []):
+            remove_file_quietly(image_path)
+            self.temp_storage.forget(image_path)
+        result['image_paths'] = []
+
+    async def gemini_generate(self, text_prompt: str, images_pil: Optional[List[PILImage.Image]] = None, on_part=None):
         """
         调用Gemini API生成文本和图片。
-        支持多API密钥轮询和随机选择。
+        支持多API密钥健康调度与对冲请求；传入 on_part 时改用流式生成，不发起对冲请求。
+        """
+        if not self.api_keys:
+            raise ValueError("没有配置API密钥 (api_keys)")
+        contents = await self._build_gemini_contents(text_prompt, images_pil or [])
+
+        if on_part is not None:
+            return await self._generate_with_retry(
+                "gemini_generate_stream",
+                functools.partial(self._gemini_stream_with_key, contents, on_part),
+                allow_hedge=False
+            )
+        return await self._generate_with_retry(
+            "gemini_generate",
+            functools.partial(self._gemini_generate_with_key, contents)
+        )
+
+    async def _build_gemini_contents(self, text_prompt: str, images_pil: List[PILImage.Image]) -> List[Any]:
+        """构建 generate_content 的 contents，参考图只编码一次。"""
+        contents = []
+        if text_prompt:
+            contents.append(text_prompt)
+            # +"。请使用中文回复,文字段与图片对应,除非特意要求，图片中不要有文字。"
+        # Gemini 支持 WEBP，透明图片用它代替体积更大的 PNG
+        for img_bytes, mime_type in await self._encode_reference_images(images_pil, "WEBP"):
+            contents.append(genai.types.Part.from_bytes(data=img_bytes, mime_type=mime_type))
+        if not contents:
+            raise ValueError("没有有效的内容发送给Gemini API")
+        return contents
+
+    async def _generate_variants(self, text_prompt: str, images_pil: List[PILImage.Image], count: int, on_part=None) -> Dict[str, Any]:
+        """
+        并发生成 count 个变体：参考图只编码一次，各变体从不同的 API Key 开始尝试，
+        同一请求同时进行的上游调用不超过 variant_concurrency。
+        结果按完成顺序合并；传入 on_part 时每个变体一完成就推送其图片。
+        部分变体失败时返回其余变体的结果，全部失败时抛出第一个异常。
         """
         if not self.api_keys:
             raise ValueError("没有配置API密钥 (api_keys)")
-        images_pil = images_pil or []
-        http_options = HttpOptions(base_url=self.api_base_url_from_config)
-        max_retries, last_exception = len(self.api_keys), None
-        key_indices_to_try = list(range(len(self.api_keys)))
-        if self.random_api_key_selection:
-            random.shuffle(key_indices_to_try)
+        if self.api_type == "OpenRouter":
+            api_name = "openrouter_generate"
+            message_content = await self._build_openrouter_content(text_prompt, images_pil)
+            attempt_func = functools.partial(self._openrouter_generate_with_key, text_prompt, message_content)
         else:
-            key_indices_to_try = [(self.current_api_key_index + i) % len(self.api_keys) for i in range(len(self.api_keys))]
+            api_name = "gemini_generate"
+            contents = await self._build_gemini_contents(text_prompt, images_pil)
+            attempt_func = functools.partial(self._gemini_generate_with_key, contents)
 
-        for attempt_num, key_idx_to_use in enumerate(key_indices_to_try):
-            current_key_to_try = self.api_keys[key_idx_to_use]
-            try:
-                logger.info(f"gemini_generate: 尝试API密钥索引 {key_idx_to_use} (尝试 {attempt_num + 1}/{max_retries})")
-                client = genai.Client(api_key=current_key_to_try, http_options=http_options)
-                contents = []
-                if text_prompt:
-                    contents.append(text_prompt)
-                    # +"。请使用中文回复,文字段与图片对应,除非特意要求，图片中不要有文字。"
-                for img_item in images_pil:
-                    contents.append(img_item)
-                if not contents:
-                    raise ValueError("没有有效的内容发送给Gemini API")
-
-                response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model="models/" + self.model_name_from_config,
-                    contents=contents,
-                    config=genai.types.GenerateContentConfig(response_modalities=['Text', 'Image'])
-                )
-                result = {'text': '', 'image_paths': []}
-                if not response:
-                    logger.warning("gemini_generate: API响应为空。")
-                    raise ValueError("Gemini API返回空响应。")
+        semaphore = asyncio.Semaphore(self.variant_concurrency)
 
+        async def run_variant(index: int) -> Dict[str, Any]:
+            async with semaphore:
+                return await self._generate_with_retry(f"{api_name}[{index + 1}/{count}]", attempt_func, key_spread=index)
 
-                if not hasattr(response, 'candidates') or not response.candidates:
-                    logger.warning("gemini_generate: API响应中无候选。")
-                    raise ValueError("Gemini API响应中无有效候选。")
+        tasks = [asyncio.create_task(run_variant(index)) for index in range(count)]
+        merged: Dict[str, Any] = {'text': '', 'image_paths': [], 'variants': 0}
+        texts: List[str] = []
+        errors: List[BaseException] = []
+        merged_results: List[Dict[str, Any]] = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    result = await next_done
+                except Exception as e:
+                    logger.warning(f"{trace_tag()}{api_name}: 一个变体生成失败: {e}")
+                    errors.append(e)
+                    continue
+                merged_results.append(result)
+                if result.get('text', '').strip():
+                    texts.append(result['text'].strip())
+                if not result.get('image_paths'):
+                    continue
+                merged['variants'] += 1
+                merged['image_paths'].extend(result['image_paths'])
+                if on_part is not None:
+                    for image_path in result['image_paths']:
+                        await on_part('image', image_path)
+                    merged['streamed'] = True
+        except BaseException:
+            # 超时或取消：停止其余变体，删除尚未推送的图片
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if not merged.get('streamed'):
+                self._discard_partial_images(merged)
+            # 已完成但尚未合并的变体的图片同样删除
+            for task in tasks:
+                if task.cancelled() or task.exception() is not None:
+                    continue
+                result = task.result()
+                if not any(result is merged_result for merged_result in merged_results):
+                    self._discard_partial_images(result)
+            raise
+        merged['text'] = '\n\n'.join(texts)
+        logger.info(f"{trace_tag()}{api_name}: {count} 个变体中 {merged['variants']} 个生成了图片，共 {len(merged['image_paths'])} 张。")
+        if not merged['image_paths'] and errors:
+            raise errors[0]
+        return merged
+
+    async def _gemini_stream_with_key(self, contents: List[Any], on_part, api_key: str) -> Dict[str, Any]:
+        """
+        使用单个 API Key 调用 Gemini generate_content_stream。
+        每张图片一到达就保存并通过 on_part 推送，文本按空行分段推送。
+        已推送过内容后出错不再切换 Key 重试 (否则会重复推送)，而是返回已收到的部分结果。
+        SDK 不支持流式接口时退回非流式调用。
+        """
+        client = self.api_client_pool.get_gemini_client(api_key, self.api_base_url_from_config)
+        if not hasattr(client.aio.models, 'generate_content_stream'):
+            logger.warning("gemini_generate: 当前 google-genai 版本不支持流式生成，改用非流式调用。")
+            return await self._gemini_generate_with_key(contents, api_key)
 
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'finish_reason') and candidate.finish_reason.name == 'SAFETY':
-                    s_info = f" 安全评级: {candidate.safety_ratings}" if hasattr(candidate, 'safety_ratings') else ""
-                    msg = f"内容因安全策略被阻止 (finish_reason: SAFETY).{s_info}"
-                    logger.warning(f"gemini_generate: {msg}")
-                    raise genai.types.SafetyFeedbackError(msg)
+        result = {'text': '', 'image_paths': [], 'streamed': False}
+        pending_text = ''
 
-                if not (hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts') and candidate.content.parts):
-                    f_info = f"(finish_reason: {candidate.finish_reason.name})" if hasattr(candidate, 'finish_reason') else ""
-                    logger.warning(f"gemini_generate: Candidate content/parts为空 {f_info}.")
-                    raise ValueError(f"Gemini API返回候选内容或部分为空 {f_info}.")
+        async def flush_text() -> None:
+            nonlocal pending_text
+            if pending_text.strip():
+                await on_part('text', pending_text.strip())
+                result['streamed'] = True
+            pending_text = ''
 
+        try:
+            stream = client.aio.models.generate_content_stream(
+                model="models/" + self.model_name_from_config,
+                contents=contents,
+                config=genai.types.GenerateContentConfig(response_modalities=['Text', 'Image'])
+            )
+            # 新版 SDK 需先 await 才得到异步迭代器
+            if inspect.isawaitable(stream):
+                stream = await stream
+            async for chunk in stream:
+                if not getattr(chunk, 'candidates', None):
+                    continue
+                candidate = chunk.candidates[0]
+                if getattr(candidate, 'finish_reason', None) is not None and candidate.finish_reason.name == 'SAFETY':
+                    s_info = f" 安全评级: {candidate.safety_ratings}" if hasattr(candidate, 'safety_ratings') else ""
+                    raise SafetyBlockedError(f"内容因安全策略被阻止 (finish_reason: SAFETY).{s_info}")
+                if not (getattr(candidate, 'content', None) and candidate.content.parts):
+                    continue
                 for part in candidate.content.parts:
-                    if hasattr(part, 'text') and part.text is not None:
+                    if getattr(part, 'text', None) is not None:
                         result['text'] += part.text
-                    elif hasattr(part, 'inline_data') and part.inline_data and hasattr(part.inline_data, 'mime_type') and part.inline_data.mime_type.startswith('image/'):
-                        img_data = part.inline_data.data
-                        gen_img = PILImage.open(BytesIO(img_data))
-                        ext = part.inline_data.mime_type.split('/')[-1]
-                        if ext not in ['png', 'jpeg', 'jpg', 'webp', 'gif']:
-                            ext = 'png'
-                        os.makedirs(self.temp_dir, exist_ok=True)
-                        temp_fp = os.path.join(self.temp_dir, f"gemini_gen_{time.time()}_{random.randint(100,999)}.{ext}")
-                        gen_img.save(temp_fp)
+                        pending_text += part.text
+                        # 完整的段落立即推送，不完整的留待后续片段
+                        while '\n\n' in pending_text:
+                            paragraph, pending_text = pending_text.split('\n\n', 1)
+                            if paragraph.strip():
+                                await on_part('text', paragraph.strip())
+                                result['streamed'] = True
+                    elif getattr(part, 'inline_data', None) and (part.inline_data.mime_type or '').startswith('image/'):
+                        # 先推送图片之前的文字，保持图文顺序
+                        await flush_text()
+                        save_started = time.monotonic()
+                        temp_fp = await self.image_pool.run(
+                            write_image_bytes, part.inline_data.data, self.temp_storage.shard_dir(), "gemini_gen", part.inline_data.mime_type,
+                            discard=remove_file_quietly
+                        )
                         result['image_paths'].append(temp_fp)
-                        logger.info(f"Gemini API 生成并保存图片: {temp_fp} (MIME: {part.inline_data.mime_type})")
-
-                if not result['text'] and not result['image_paths']:
-                    logger.warning(f"Gemini API返回空文本和图片. Candidate: {candidate}")
-                if not self.random_api_key_selection:
-                    self.current_api_key_index = (key_idx_to_use + 1) % len(self.api_keys)
-                return result
-            except Exception as e:
-                logger.error(f"gemini_generate: API处理失败 (密钥 {key_idx_to_use}): {str(e)}", exc_info=True)
-                last_exception = e
+                        self._record_saved_image(temp_fp, save_started)
+                        logger.info(f"Gemini API 流式生成并保存图片: {temp_fp} (MIME: {part.inline_data.mime_type})")
+                        await on_part('image', temp_fp)
+                        result['streamed'] = True
+        except Exception as e:
+            if not result['streamed']:
+                raise
+            logger.warning(f"gemini_generate: 流式生成在推送部分内容后中断，返回已收到的结果: {e}")
+        await flush_text()
+
+        if not result['text'] and not result['image_paths']:
+            logger.warning("gemini_generate: 流式生成未返回文本或图片。")
+        # 已推送文字时无法撤回，不再重试
+        if not result['image_paths'] and not result['streamed']:
+            raise NoImageError("Gemini API 流式响应中没有图片", result)
+        return result
+
+    async def _gemini_generate_with_key(self, contents: List[Any], api_key: str) -> Dict[str, Any]:
+        """
+        使用单个 API Key 调用 Gemini generate_content。
+        """
+        client = self.api_client_pool.get_gemini_client(api_key, self.api_base_url_from_config)
+        response = await client.aio.models.generate_content(
+            model="models/" + self.model_name_from_config,
+            contents=contents,
+            config=genai.types.GenerateContentConfig(response_modalities=['Text', 'Image'])
+        )
+        result = {'text': '', 'image_paths': []}
+        if not response:
+            logger.warning("gemini_generate: API响应为空。")
+            raise ValueError("Gemini API返回空响应。")
+
+
+        if not hasattr(response, 'candidates') or not response.candidates:
+            logger.warning("gemini_generate: API响应中无候选。")
+            raise ValueError("Gemini API响应中无有效候选。")
+
+        candidate = response.candidates[0]
+        if hasattr(candidate, 'finish_reason') and candidate.finish_reason.name == 'SAFETY':
+            s_info = f" 安全评级: {candidate.safety_ratings}" if hasattr(candidate, 'safety_ratings') else ""
+            msg = f"内容因安全策略被阻止 (finish_reason: SAFETY).{s_info}"
+            logger.warning(f"gemini_generate: {msg}")
+            raise SafetyBlockedError(msg)
+
+        if not (hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts') and candidate.content.parts):
+            f_info = f"(finish_reason: {candidate.finish_reason.name})" if hasattr(candidate, 'finish_reason') else ""
+            logger.warning(f"gemini_generate: Candidate content/parts为空 {f_info}.")
+            raise NoImageError(f"Gemini API返回候选内容或部分为空 {f_info}.")
 
-            if attempt_num < max_retries - 1:
-                logger.info(f"gemini_generate: 尝试下个API密钥 (下个索引: {key_indices_to_try[attempt_num+1]})")
-            else:
-                logger.error("gemini_generate: 所有API密钥均尝试失败。")
-        if last_exception:
-            raise last_exception
-        logger.error("gemini_generate: 未能从API获取数据且无明确异常。")
-        raise ValueError("Gemini API处理失败，无可用密钥或未记录错误。")
+        try:
+            for part in candidate.content.parts:
+                if hasattr(part, 'text') and part.text is not None:
+                    result['text'] += part.text
+                elif hasattr(part, 'inline_data') and part.inline_data and hasattr(part.inline_data, 'mime_type') and part.inline_data.mime_type.startswith('image/'):
+                    # 直接写入原始字节，仅校验文件头
+                    save_started = time.monotonic()
+                    temp_fp = await self.image_pool.run(
+                        write_image_bytes, part.inline_data.data, self.temp_storage.shard_dir(), "gemini_gen", part.inline_data.mime_type,
+                        discard=remove_file_quietly
+                    )
+                    result['image_paths'].append(temp_fp)
+                    self._record_saved_image(temp_fp, save_started)
+                    logger.info(f"Gemini API 生成并保存图片: {temp_fp} (MIME: {part.inline_data.mime_type})")
+        except BaseException:
+            self._discard_partial_images(result)
+            raise
+
+        if not result['text'] and not result['image_paths']:
+            logger.warning(f"Gemini API返回空文本和图片. Candidate: {candidate}")
+        if not result['image_paths']:
+            raise NoImageError("Gemini API 响应中没有图片", result)
+        return result
 
     async def terminate(self):
         """
@@ -1145,9 +2194,55 @@ class GeminiArtist(Star):
                 logger.error(f"等待后台清理任务结束时异常: {e}", exc_info=True)
         else:
             logger.info("无活动后台清理任务或已完成。")
+        if self._draw_session_sweeper_task and not self._draw_session_sweeper_task.done():
+            self._draw_session_sweeper_task.cancel()
+            try:
+                await self._draw_session_sweeper_task
+            except asyncio.CancelledError:
+                pass
+        # 先停止恢复流程，避免它在下面的中断之后再启动新的批量任务
+        if not self._batch_resume_task.done():
+            self._batch_resume_task.cancel()
+            try:
+                await self._batch_resume_task
+            except asyncio.CancelledError:
+                pass
+        # 中断进行中的批量任务，检查点保持 running 状态，插件重启后继续执行
+        batch_tasks = list(self._batch_tasks.values())
+        for task in batch_tasks:
+            task.cancel()
+        if batch_tasks:
+            await asyncio.gather(*batch_tasks, return_exceptions=True)
+            logger.info(f"已中断 {len(batch_tasks)} 个批量任务，重启后继续执行。")
+        if self.metrics_server:
+            await self.metrics_server.close()
+        await asyncio.to_thread(self.tracer.close)
+        try:
+            await self.api_client_pool.aclose()
+        except Exception as e:
+            logger.error(f"关闭 API 客户端失败: {e}", exc_info=True)
+        if self.download_cache:
+            logger.info(f"下载缓存统计: {self.download_cache.stats()}")
+        logger.info(f"图片工作池统计: {self.image_pool.stats()}")
+        self.image_pool.shutdown()
+        if self.result_cache:
+            await asyncio.to_thread(self.result_cache.clear)
+        if self.history_db:
+            try:
+                await self.history_db.close()
+                logger.info(f"图片历史数据库已关闭: {self.history_db.stats()}")
+            except Exception as e:
+                logger.error(f"关闭图片历史数据库失败: {e}", exc_info=True)
+        # 启用历史持久化时保留未过期的文件，供重启后继续引用机器人生成的图片
+        final_cleanup_age = self.cleanup_older_than_seconds if self.history_db else 0
+        # 线程中的扫描无法取消，等它完成后再做最终清理，避免清单在清理后又被补充
+        try:
+            await self._temp_rebuild_task
+        except Exception as e:
+            logger.error(f"重建临时文件清单失败: {e}", exc_info=True)
         logger.info(f"最终临时文件清理 ({self.temp_dir})...")
         try:
-            await asyncio.to_thread(self._blocking_cleanup_temp_dir_logic, 0)
+            await asyncio.to_thread(self.temp_storage.evict, final_cleanup_age)
         except Exception as e:
             logger.error(f"最终清理失败: {e}", exc_info=True)
         # 仅当临时目录是插件特有的且为空时才尝试移除
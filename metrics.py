@@ -0,0 +1,298 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from astrbot.api import logger
+
+DEFAULT_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"] + self._render_samples()
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """单调递增计数器。"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def _render_samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in sorted(self.values().items())]
+
+
+class Gauge(_Metric):
+    """抓取时由回调取值的仪表，回调返回 {标签值元组: 数值}。"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (), callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, help_text, label_names)
+        self.callback = callback
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        if self.callback is None:
+            return {}
+        try:
+            return self.callback()
+        except Exception as e:
+            logger.warning(f"Metrics: 读取指标 {self.name} 失败: {e}")
+            return {}
+
+    def _render_samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in sorted(self.values().items())]
+
+
+class _HistogramSeries:
+    __slots__ = ("bucket_counts", "count", "sum", "max")
+
+    def __init__(self, bucket_count: int):
+        self.bucket_counts = [0] * bucket_count
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Histogram(_Metric):
+    """固定分桶直方图，支持按分桶估算分位数。"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = _HistogramSeries(len(self.buckets) + 1)
+                self._series[key] = series
+            series.bucket_counts[index] += 1
+            series.count += 1
+            series.sum += value
+            series.max = max(series.max, value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """记录 with 语句块的耗时 (秒)，块内抛出异常时同样记录。"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def summary(self) -> Dict[Tuple[str, ...], Dict[str, float]]:
+        """每个标签组合的 count、平均值、p50/p95 估计值 (所在分桶上界) 与最大值。"""
+        with self._lock:
+            snapshot = {key: (list(s.bucket_counts), s.count, s.sum, s.max) for key, s in self._series.items()}
+        result = {}
+        for key, (bucket_counts, count, total, maximum) in snapshot.items():
+            if not count:
+                continue
+            result[key] = {
+                "count": count,
+                "avg": total / count,
+                "p50": self._quantile(bucket_counts, count, 0.5, maximum),
+                "p95": self._quantile(bucket_counts, count, 0.95, maximum),
+                "max": maximum,
+            }
+        return result
+
+    def _quantile(self, bucket_counts: List[int], count: int, q: float, maximum: float) -> float:
+        target, seen = q * count, 0
+        for index, bucket_count in enumerate(bucket_counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(self.buckets[index], maximum) if index < len(self.buckets) else maximum
+        return maximum
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            snapshot = {key: (list(s.bucket_counts), s.count, s.sum) for key, s in self._series.items()}
+        lines = []
+        for key, (bucket_counts, count, total) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，按注册顺序以 Prometheus 文本格式输出。"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, label_names: Sequence[str] = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, help_text, label_names, callback))
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ArtistMetrics(MetricsRegistry):
+    """
+    插件的各阶段耗时、各 API Key/模型的上游调用、请求结果、字节数与并发状态指标。
+    """
+
+    STAGES = ("reference_download", "image_decode", "upload_encode", "upstream_call", "result_save", "message_send")
+
+    def __init__(self):
+        super().__init__()
+        self.stage_seconds = self.histogram(
+            "gemini_artist_stage_seconds", "各处理阶段耗时 (秒)", ("stage",))
+        self.upstream_seconds = self.histogram(
+            "gemini_artist_upstream_seconds", "单次上游调用耗时 (秒)", ("api", "key", "model", "outcome"))
+        self.upstream_calls = self.counter(
+            "gemini_artist_upstream_calls_total", "上游调用次数", ("api", "key", "model", "outcome"))
+        self.request_seconds = self.histogram(
+            "gemini_artist_request_seconds", "绘图请求端到端耗时 (秒)", ("entry", "outcome"))
+        self.requests = self.counter(
+            "gemini_artist_requests_total", "绘图请求数", ("entry", "outcome"))
+        self.bytes = self.counter(
+            "gemini_artist_bytes_total", "传输与保存的字节数", ("direction", "kind"))
+        self.images_generated = self.counter(
+            "gemini_artist_images_generated_total", "生成的图片数", ("api", "model"))
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        self.stage_seconds.observe(seconds, stage=stage)
+
+    def stage(self, stage: str):
+        return self.stage_seconds.time(stage=stage)
+
+    def add_state_gauges(self, callbacks: Dict[str, Tuple[str, Callable[[], float]]]) -> None:
+        """注册抓取时读取的状态仪表：{指标名: (说明, 取值回调)}。"""
+        for name, (help_text, callback) in callbacks.items():
+            self.gauge(name, help_text, (), lambda callback=callback: {(): callback()})
+
+    def summary_lines(self) -> List[str]:
+        """供管理员命令输出的文字摘要。"""
+        lines = ["[阶段耗时] 次数 / 平均 / p50 / p95 / 最大 (秒)"]
+        for (stage,), s in sorted(self.stage_seconds.summary().items()):
+            lines.append(f"  {stage}: {s['count']} / {s['avg']:.2f} / {s['p50']:.2f} / {s['p95']:.2f} / {s['max']:.2f}")
+        lines.append("[请求结果]")
+        request_summary = self.request_seconds.summary()
+        for (entry, outcome), count in sorted(self.requests.values().items()):
+            avg = request_summary.get((entry, outcome), {}).get("avg", 0.0)
+            lines.append(f"  {entry} {outcome}: {int(count)} 次，平均 {avg:.2f} 秒")
+        lines.append("[上游调用] 次数 / 平均 / p95 (秒)")
+        for (api, key, model, outcome), s in sorted(self.upstream_seconds.summary().items()):
+            lines.append(f"  {api} 密钥{key} {model} {outcome}: {s['count']} / {s['avg']:.2f} / {s['p95']:.2f}")
+        lines.append("[字节数]")
+        for (direction, kind), value in sorted(self.bytes.values().items()):
+            lines.append(f"  {direction} {kind}: {int(value)}")
+        lines.append("[当前状态]")
+        for metric in self._metrics:
+            if isinstance(metric, Gauge) and not metric.label_names:
+                value = metric.values().get((), 0)
+                lines.append(f"  {metric.name}: {_format_value(value)}")
+        return lines
+
+
+class MetricsServer:
+    """在本地端口上以 Prometheus 文本格式提供 /metrics。"""
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"MetricsServer: 指标已发布在 http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # 读完请求头
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if not line or line in (b"\r\n", b"\n"):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.registry.render().encode("utf-8")
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"MetricsServer: 处理请求失败: {e}")
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,141 @@
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from astrbot.api import logger
+
+from .key_scheduler import ERROR_NETWORK, ERROR_RATE_LIMIT, ERROR_SERVER, classify_api_error
+
+
+# 与具体 API Key 无关的内容类错误
+ERROR_NO_IMAGE = "no_image"
+ERROR_SAFETY = "safety"
+# 本地无法识别返回的图片数据，重试与换 Key 均无意义
+ERROR_INVALID_IMAGE = "invalid_image"
+
+DEFAULT_RETRY_BUDGETS = {
+    ERROR_RATE_LIMIT: 3,
+    ERROR_SERVER: 3,
+    ERROR_NETWORK: 2,
+    ERROR_NO_IMAGE: 2,
+    ERROR_SAFETY: 1,
+}
+
+
+class GenerationContentError(Exception):
+    """API 调用成功但返回内容不可用。这类错误与所用的 API Key 无关，不触发换 Key。"""
+
+
+class NoImageError(GenerationContentError):
+    """响应中没有图片。result 保存该次响应，重试次数用尽时作为最终结果返回。"""
+
+    def __init__(self, message: str, result: Optional[Dict[str, Any]] = None):
+        super().__init__(message)
+        self.result = result
+
+
+class SafetyBlockedError(GenerationContentError):
+    """内容因安全策略被阻止。"""
+
+
+class InvalidImageDataError(GenerationContentError):
+    """返回的图片数据无法识别。属于本地解码问题，不重试也不换 Key。"""
+
+
+def classify_retry_error(error: BaseException) -> Tuple[str, Optional[float]]:
+    if isinstance(error, InvalidImageDataError):
+        return ERROR_INVALID_IMAGE, None
+    if isinstance(error, SafetyBlockedError):
+        return ERROR_SAFETY, None
+    if isinstance(error, NoImageError):
+        return ERROR_NO_IMAGE, None
+    return classify_api_error(error)
+
+
+class RetryState:
+    """单个请求的重试状态：各错误类别已用次数与整体截止时间。"""
+
+    __slots__ = ("policy", "deadline", "attempts", "used")
+
+    def __init__(self, policy: "RetryPolicy"):
+        self.policy = policy
+        self.deadline = time.monotonic() + policy.deadline_seconds if policy.deadline_seconds > 0 else None
+        self.attempts = 0
+        self.used: Dict[str, int] = {}
+
+    def remaining(self) -> Optional[float]:
+        """距离截止时间的剩余秒数；未设置截止时间时返回 None。"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def next_delay(self, error: BaseException) -> Optional[float]:
+        """
+        根据错误决定是否重试。返回重试前需要等待的秒数，不应重试时返回 None。
+        """
+        kind, retry_after = classify_retry_error(error)
+        budget = self.policy.budgets.get(kind, 0)
+        used = self.used.get(kind, 0)
+        if used >= budget:
+            logger.debug(f"RetryPolicy: 错误类别 {kind} 的重试次数已用尽 ({used}/{budget})。")
+            return None
+        delay = self.policy.backoff(self.attempts, retry_after)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            logger.debug(f"RetryPolicy: 等待 {delay:.1f} 秒将超过整体截止时间 (剩余 {remaining:.1f} 秒)，不再重试。")
+            return None
+        self.used[kind] = used + 1
+        self.attempts += 1
+        return delay
+
+
+class RetryPolicy:
+    """
+    生成请求的统一重试策略。
+
+    - 指数退避加全抖动：第 n 次重试前等待 [0, min(max_delay, base_delay * 2^n)] 内的随机时长，
+      避免大量请求同时重试；服务端给出 Retry-After 时以其为准；
+    - 各错误类别 (限流、服务端错误、网络错误、无图片、安全拦截) 有各自的重试次数；
+    - 整个请求有统一的截止时间，等待时间会超过截止时间时不再重试。
+    """
+
+    def __init__(
+        self,
+        base_delay_seconds: float = 1.0,
+        max_delay_seconds: float = 30.0,
+        deadline_seconds: float = 240.0,
+        budgets: Optional[Dict[str, int]] = None,
+    ):
+        self.base_delay_seconds = max(0.0, base_delay_seconds)
+        self.max_delay_seconds = max(self.base_delay_seconds, max_delay_seconds)
+        self.deadline_seconds = deadline_seconds
+        self.budgets = dict(DEFAULT_RETRY_BUDGETS)
+        self.budgets.update(budgets or {})
+        self.retries = 0
+
+    @staticmethod
+    def parse_budgets(raw_budgets: List[str]) -> Dict[str, int]:
+        """解析配置中形如 "错误类别:次数" 的列表。"""
+        budgets = {}
+        for item in raw_budgets or []:
+            kind, sep, count = str(item).rpartition(":")
+            if not sep or kind.strip() not in DEFAULT_RETRY_BUDGETS:
+                logger.warning(f"RetryPolicy: 无法解析重试次数配置 '{item}'，错误类别应为 {', '.join(DEFAULT_RETRY_BUDGETS)} 之一，已忽略。")
+                continue
+            try:
+                budgets[kind.strip()] = max(0, int(count))
+            except ValueError:
+                logger.warning(f"RetryPolicy: 无法解析重试次数配置 '{item}'，已忽略。")
+        return budgets
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return retry_after
+        cap = min(self.max_delay_seconds, self.base_delay_seconds * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    def start(self) -> RetryState:
+        return RetryState(self)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"retries": self.retries, "budgets": self.budgets, "deadline_seconds": self.deadline_seconds}
@@ -0,0 +1,163 @@
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from astrbot.api import logger
+
+
+class TempStorage:
+    """
+    临时文件管理器：生成与下载的图片分散写入 files/ 下的分片子目录，
+    内存清单按登记顺序记录每个文件的大小与时间，清理时无需遍历目录。
+
+    - 文件超过 max_age_seconds，或总大小超过 max_bytes (0 表示不限制) 时从最旧的开始淘汰；
+    - is_referenced(path) 返回 True 的文件 (仍被图片历史引用) 不会被淘汰，
+      其时间刷新为当前时间并移到清单末尾，因此每次清理只检查需要处理的文件；
+    - 登记不足 min_age_seconds 的文件不会因配额被淘汰，避免删除正在发送的图片；
+    - 未登记的文件不会被删除，启动时扫描一次目录重建清单 (包括旧版本直接写在根目录下的文件)。
+    所有方法均为同步阻塞实现，清理与重建应通过 asyncio.to_thread 调用。
+    """
+
+    FILES_DIRNAME = "files"
+
+    def __init__(
+        self,
+        base_dir: str,
+        max_bytes: int,
+        max_age_seconds: float,
+        is_referenced: Optional[Callable[[str], bool]] = None,
+        shard_count: int = 16,
+        min_age_seconds: float = 300,
+    ):
+        self.base_dir = base_dir
+        self.files_dir = os.path.join(base_dir, self.FILES_DIRNAME)
+        self.max_bytes = max(0, max_bytes)
+        self.max_age_seconds = max_age_seconds
+        self.is_referenced = is_referenced
+        self.min_age_seconds = min_age_seconds
+        self._lock = threading.Lock()
+        # 路径 -> (字节数, 登记时间)，按登记时间排列
+        self._manifest: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._total_bytes = 0
+        self._shard_dirs = [os.path.join(self.files_dir, f"{i:02x}") for i in range(max(1, shard_count))]
+        for shard_dir in self._shard_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+        self._next_shard = itertools.cycle(self._shard_dirs)
+        self.evicted_by_age = 0
+        self.evicted_by_quota = 0
+        self.kept_referenced = 0
+
+    def shard_dir(self) -> str:
+        """返回下一个用于写入新文件的分片目录。"""
+        return next(self._next_shard)
+
+    def _add(self, path: str, size: int, registered_at: float) -> None:
+        previous = self._manifest.pop(path, None)
+        if previous is not None:
+            self._total_bytes -= previous[0]
+        self._manifest[path] = (size, registered_at)
+        self._total_bytes += size
+
+    def register(self, path: str) -> None:
+        """登记新写入的文件。"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            self._add(path, size, time.time())
+
+    def register_many(self, paths: Iterable[str]) -> None:
+        for path in paths:
+            self.register(path)
+
+    def forget(self, path: str) -> None:
+        """文件已被移走或删除时从清单中移除。"""
+        with self._lock:
+            entry = self._manifest.pop(path, None)
+            if entry is not None:
+                self._total_bytes -= entry[0]
+
+    def rebuild(self) -> int:
+        """扫描根目录与分片目录中的文件重建清单，返回登记的文件数。"""
+        found = []
+        scan_dirs = [self.base_dir] + self._shard_dirs
+        for scan_dir in scan_dirs:
+            try:
+                with os.scandir(scan_dir) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_file(follow_symlinks=False):
+                                stat = entry.stat(follow_symlinks=False)
+                                found.append((stat.st_mtime, entry.path, stat.st_size))
+                        except OSError:
+                            continue
+            except OSError as e:
+                logger.warning(f"TempStorage: 扫描目录 {scan_dir} 失败: {e}")
+        found.sort()
+        with self._lock:
+            for mtime, path, size in found:
+                if path not in self._manifest:
+                    self._add(path, size, mtime)
+            # 保持清单按时间排列
+            self._manifest = OrderedDict(sorted(self._manifest.items(), key=lambda item: item[1][1]))
+        logger.info(f"TempStorage: 已登记 {len(found)} 个现有临时文件 ({sum(f[2] for f in found)} 字节) @ {self.base_dir}")
+        return len(found)
+
+    def evict(self, max_age_seconds: Optional[float] = None, respect_references: bool = True) -> Tuple[int, int]:
+        """
+        淘汰过期或超出配额的文件，返回 (删除数, 错误数)。
+        max_age_seconds 为 None 时使用初始化时的值；为 0 时删除所有文件 (插件终止时)。
+        """
+        max_age = self.max_age_seconds if max_age_seconds is None else max_age_seconds
+        min_age = min(self.min_age_seconds, max_age)
+        now = time.time()
+        victims = []
+        with self._lock:
+            # 被引用的文件会移到末尾，最多检查一轮
+            for _ in range(len(self._manifest)):
+                path, (size, registered_at) = next(iter(self._manifest.items()))
+                age = now - registered_at
+                too_old = age >= max_age
+                over_quota = self.max_bytes > 0 and self._total_bytes > self.max_bytes and age >= min_age
+                if not too_old and not over_quota:
+                    break
+                if respect_references and self.is_referenced and self.is_referenced(path):
+                    self._manifest.move_to_end(path)
+                    self._manifest[path] = (size, now)
+                    self.kept_referenced += 1
+                    continue
+                del self._manifest[path]
+                self._total_bytes -= size
+                victims.append(path)
+                if too_old:
+                    self.evicted_by_age += 1
+                else:
+                    self.evicted_by_quota += 1
+        removed, errors = 0, 0
+        for path in victims:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"清理临时文件 {path} 时出错: {e}")
+                errors += 1
+        if removed or errors:
+            logger.info(f"临时目录清理: 移除 {removed} 文件, 发生 {errors} 错误 @ {self.base_dir}")
+        return removed, errors
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "files": len(self._manifest),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "evicted_by_age": self.evicted_by_age,
+                "evicted_by_quota": self.evicted_by_quota,
+                "kept_referenced": self.kept_referenced,
+            }
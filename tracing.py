@@ -0,0 +1,232 @@
+import contextvars
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from astrbot.api import logger
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # 可选依赖
+    otel_trace = None
+
+# 单个请求最多记录的跨度数，避免异常重试时无限增长
+MAX_SPANS_PER_TRACE = 200
+
+_current_trace: "contextvars.ContextVar[Optional[Trace]]" = contextvars.ContextVar("gemini_artist_trace", default=None)
+
+
+class Span:
+    """一段计时记录；attrs 可在计时过程中补充 (如字节数、图片尺寸)。"""
+
+    __slots__ = ("name", "started", "duration", "attrs")
+
+    def __init__(self, name: str, started: float, attrs: Dict[str, Any]):
+        self.name = name
+        self.started = started
+        self.duration: Optional[float] = None
+        self.attrs = attrs
+
+
+class Trace:
+    """
+    单次 gemini_draw 或 /draw 调用的追踪记录：跨度 (下载、解码、编码、各 Key 的上游调用、保存、发送)
+    与事件 (重试原因等)。通过 contextvars 传递，调用链中新建的 asyncio 任务会自动继承。
+    """
+
+    def __init__(self, entry: str, attrs: Optional[Dict[str, Any]] = None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.entry = entry
+        self.attrs: Dict[str, Any] = dict(attrs or {})
+        self.started = time.monotonic()
+        self.wall_started_ns = time.time_ns()
+        self.spans: List[Span] = []
+        self.events: List[Dict[str, Any]] = []
+        self.dropped_spans = 0
+        # 生成阶段的结果 (success / no_image / safety / timeout / error)，由调用方填写
+        self.result: Optional[str] = None
+        self.outcome: Optional[str] = None
+        self.duration: Optional[float] = None
+        self.token: Optional[contextvars.Token] = None
+
+    @property
+    def tag(self) -> str:
+        return f"[trace {self.trace_id}]"
+
+    def add_span(self, name: str, started: float, duration: float, **attrs) -> None:
+        if len(self.spans) >= MAX_SPANS_PER_TRACE:
+            self.dropped_spans += 1
+            return
+        span = Span(name, started, attrs)
+        span.duration = duration
+        self.spans.append(span)
+
+    def add_event(self, name: str, **attrs) -> None:
+        if len(self.events) >= MAX_SPANS_PER_TRACE:
+            return
+        self.events.append({"name": name, "at_ms": round((time.monotonic() - self.started) * 1000), **attrs})
+
+    def to_dict(self) -> Dict[str, Any]:
+        """紧凑的 JSON 结构，时间单位为毫秒，起点为请求开始时刻。"""
+        data: Dict[str, Any] = {
+            "trace_id": self.trace_id,
+            "entry": self.entry,
+            "outcome": self.outcome,
+            "duration_ms": round((self.duration or 0) * 1000),
+            "attrs": self.attrs,
+            "spans": [
+                {"name": s.name, "start_ms": round((s.started - self.started) * 1000), "ms": round((s.duration or 0) * 1000), **s.attrs}
+                for s in self.spans
+            ],
+        }
+        if self.events:
+            data["events"] = self.events
+        if self.dropped_spans:
+            data["dropped_spans"] = self.dropped_spans
+        return data
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def trace_tag() -> str:
+    """当前追踪的日志前缀，不在追踪中时为空字符串。"""
+    trace = _current_trace.get()
+    return f"{trace.tag} " if trace else ""
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """记录 with 语句块为当前追踪的一个跨度；不在追踪中时只产出 None。"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    started = time.monotonic()
+    record = Span(name, started, attrs)
+    try:
+        yield record
+    except BaseException as e:
+        record.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        trace.add_span(name, started, time.monotonic() - started, **record.attrs)
+
+
+def record_span(name: str, started: float, duration: float, **attrs) -> None:
+    """补记一个已结束的跨度 (started 为 time.monotonic() 时刻)。"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started, duration, **attrs)
+
+
+def record_event(name: str, **attrs) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_event(name, **attrs)
+
+
+def _otel_value(value: Any) -> Any:
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)) and all(isinstance(v, (str, bool, int, float)) for v in value):
+        return list(value)
+    return str(value)
+
+
+class Tracer:
+    """
+    创建与结束请求追踪。耗时超过 slow_threshold_seconds (0 表示不记录) 的请求以单行 JSON
+    写入日志与 slow_log_path (超过 max_log_bytes 时轮转为 .1)，文件写入在单独的单线程执行器中按顺序进行，不阻塞事件循环；
+    启用 OpenTelemetry 导出且已安装 opentelemetry-api 时，每个请求结束后按记录的时间补发跨度。
+    """
+
+    def __init__(self, slow_threshold_seconds: float, slow_log_path: Optional[str], enable_otel: bool = False, max_log_bytes: int = 5 * 1024 * 1024):
+        self.slow_threshold_seconds = slow_threshold_seconds
+        self.slow_log_path = slow_log_path
+        self.max_log_bytes = max_log_bytes
+        self.slow_requests = 0
+        self._otel_tracer = None
+        if enable_otel:
+            if otel_trace is None:
+                logger.warning("Tracer: 已启用 OpenTelemetry 导出，但未安装 opentelemetry-api，已忽略。")
+            else:
+                self._otel_tracer = otel_trace.get_tracer("gemini_artist")
+        self._log_writer: Optional[ThreadPoolExecutor] = None
+        if slow_log_path:
+            os.makedirs(os.path.dirname(slow_log_path), exist_ok=True)
+            self._log_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini_artist_slow_log")
+
+    def start(self, entry: str, **attrs) -> Trace:
+        trace = Trace(entry, attrs)
+        trace.token = _current_trace.set(trace)
+        logger.info(f"{trace.tag} {entry} 开始")
+        return trace
+
+    def finish(self, trace: Trace, outcome: str) -> None:
+        """结束追踪；同一追踪只处理一次。"""
+        if trace.outcome is not None:
+            return
+        trace.outcome = outcome
+        trace.duration = time.monotonic() - trace.started
+        try:
+            _current_trace.reset(trace.token)
+        except ValueError:
+            # 在其他上下文中结束 (如生成器被回收)，无需恢复
+            pass
+        logger.info(f"{trace.tag} {trace.entry} 结束: {outcome}，耗时 {trace.duration:.2f} 秒")
+        if self.slow_threshold_seconds > 0 and trace.duration >= self.slow_threshold_seconds:
+            self.slow_requests += 1
+            self._write_slow_trace(trace)
+        if self._otel_tracer is not None:
+            try:
+                self._export_otel(trace)
+            except Exception as e:
+                logger.warning(f"Tracer: 导出 OpenTelemetry 跨度失败: {e}")
+
+    def _write_slow_trace(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_dict(), ensure_ascii=False, separators=(",", ":"), default=str)
+        logger.warning(f"慢请求 {trace.tag}: {line}")
+        if self._log_writer is not None:
+            self._log_writer.submit(self._append_slow_log, line)
+
+    def _append_slow_log(self, line: str) -> None:
+        try:
+            if os.path.exists(self.slow_log_path) and os.path.getsize(self.slow_log_path) > self.max_log_bytes:
+                os.replace(self.slow_log_path, self.slow_log_path + ".1")
+            with open(self.slow_log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except Exception as e:
+            logger.warning(f"Tracer: 写入慢请求日志失败: {e}")
+
+    def _export_otel(self, trace: Trace) -> None:
+        def to_ns(monotonic_time: float) -> int:
+            return trace.wall_started_ns + int((monotonic_time - trace.started) * 1e9)
+
+        attributes = {"gemini_artist.trace_id": trace.trace_id, "gemini_artist.outcome": trace.outcome}
+        attributes.update({f"gemini_artist.{k}": _otel_value(v) for k, v in trace.attrs.items()})
+        root = self._otel_tracer.start_span(trace.entry, start_time=trace.wall_started_ns, attributes=attributes)
+        context = otel_trace.set_span_in_context(root)
+        for s in trace.spans:
+            child = self._otel_tracer.start_span(
+                s.name, context=context, start_time=to_ns(s.started),
+                attributes={k: _otel_value(v) for k, v in s.attrs.items()},
+            )
+            child.end(end_time=to_ns(s.started + (s.duration or 0)))
+        for event in trace.events:
+            root.add_event(event["name"], {k: _otel_value(v) for k, v in event.items() if k != "name"})
+        root.end(end_time=to_ns(trace.started + trace.duration))
+
+    def close(self) -> None:
+        """等待尚未写入的慢请求日志写完。阻塞实现，应通过 asyncio.to_thread 调用。"""
+        if self._log_writer is not None:
+            self._log_writer.shutdown(wait=True)
+            self._log_writer = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"slow_requests": self.slow_requests, "otel_export": self._otel_tracer is not None}